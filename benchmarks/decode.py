@@ -0,0 +1,49 @@
+"""Measures how long each response type takes to decode with the stdlib, orjson and pysimdjson.
+
+Run with ``python -m benchmarks.decode`` from the repository root. Backends that
+aren't installed are skipped.
+"""
+from __future__ import annotations
+import json
+import timeit
+from typing import Any, Callable, Dict, List, Tuple
+from utils import http
+from . import payloads
+
+
+def encoded_payloads() -> List[Tuple[str, bytes, Tuple[str, ...]]]:
+    # (name, body, subtree a caller actually needs)
+    return [
+        ("user", json.dumps(payloads.user()).encode(), ()),
+        ("user stats", json.dumps(payloads.user()).encode(), ("statistics",)),
+        ("scores x100", json.dumps([payloads.score(n) for n in range(100)]).encode(), ()),
+        ("beatmaps x50", json.dumps({"beatmaps": [payloads.beatmap(n) for n in range(50)]}).encode(), ("beatmaps",)),
+        ("skins x400", json.dumps(payloads.skins_page()).encode(), ("skins",)),
+        ("render lookup", json.dumps({"renders": [{"renderID": 1, "videoUrl": "x", "progress": "Done."}], "maxRenders": 1}).encode(), ("renders",)),
+    ]
+
+
+def decoders(path: Tuple[str, ...]) -> Dict[str, Callable[[bytes], Any]]:
+    found: Dict[str, Callable[[bytes], Any]] = {"json": json.loads}
+    if http.orjson is not None:
+        found["orjson"] = http.orjson.loads
+    if path and http.simdjson is not None:
+        found["simdjson subtree"] = lambda body: http.decode_json(body, *path)
+    return found
+
+
+def main():
+    print(f"default backend: {http.JSON_BACKEND}, pysimdjson: {'yes' if http.simdjson else 'no'}\n")
+    print(f"{'payload':<14} {'size':>9} {'decoder':<17} {'per call':>10} {'saved':>10}")
+
+    for name, body, path in encoded_payloads():
+        number = max(10, 2_000_000 // len(body))
+        baseline = None
+        for label, decode in decoders(path).items():
+            took = min(timeit.repeat(lambda: decode(body), number=number, repeat=5)) / number * 1e6
+            baseline = took if baseline is None else baseline
+            print(f"{name:<14} {len(body):>8}B {label:<17} {took:>8.1f}us {baseline - took:>8.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Load tests the osu cog end to end against the stand-ins in :mod:`benchmarks.standins`.
+
+The real bot, cog, queue, caches and limiters run unchanged, only osu!, o!rdr and
+Discord are replaced. Every scenario reports throughput, p50/p99 latency as a user
+would see it and how many requests reached each upstream, so a change that makes
+the bot slower or chattier shows up before it ships.
+
+Postgres is the one thing that isn't stood in for, the benchmark creates a scratch
+schema from ``schema.sql`` and drops it afterwards. The bot also imports ``config``
+as usual. Run with::
+
+    python -m benchmarks.load --dsn postgresql://localhost/aswo replay_flood user_burst
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import math
+import os
+import pathlib
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Tuple
+import asyncpg
+import utils
+from bot import Aswo
+from cogs.osu import Osu
+from . import payloads
+from .standins import DiscordDriver, FakeMessage, FakeUser, OrdrStandIn, OsuStandIn, StandInOsu, redirect_ordr
+
+SCHEMA = pathlib.Path(__file__).resolve().parent.parent / "schema.sql"
+
+
+class Result(NamedTuple):
+    scenario: str
+    wall: float
+    latencies: List[float]
+    outcomes: Counter[str]
+    upstream: Dict[str, Counter[str]]
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest rank, so p99 of a small run is an observed value and not an interpolation.
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)] if ordered else 0.0
+
+
+class LoadTest:
+    """Starts the stand-ins, a scratch schema and a bot with the osu cog loaded."""
+    def __init__(self, dsn: str, *, render_time: float, latency: float, unthrottled: bool):
+        self.dsn = dsn
+        self.unthrottled = unthrottled
+        self.osu = OsuStandIn(latency=latency)
+        self.ordr = OrdrStandIn(render_time=render_time, progress_every=min(0.5, render_time), latency=latency)
+        self.driver = DiscordDriver(latency=latency)
+        self.schema = f"aswo_bench_{os.getpid()}"
+        self._cleanup: List[Callable[[], Awaitable[Any]]] = []
+
+    async def __aenter__(self) -> LoadTest:
+        try:
+            await self._start()
+        except BaseException:
+            await self.__aexit__()
+            raise
+        return self
+
+    async def _start(self):
+        for stand_in in (self.osu, self.ordr, self.driver):
+            await stand_in.start()
+            self._cleanup.append(stand_in.close)
+        redirect_ordr(self.ordr.url)
+
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            await conn.execute(f"CREATE SCHEMA {self.schema}")
+        finally:
+            await conn.close()
+        self._cleanup.append(self._drop_schema)
+
+        self.pool = await asyncpg.create_pool(self.dsn, init=utils.instrument_connection, server_settings={"search_path": self.schema})
+        self._cleanup.append(self.pool.close)
+        await self.pool.execute(SCHEMA.read_text())
+
+        self.pools = await utils.HTTPPools().__aenter__()
+        self._cleanup.append(self.pools.close)
+
+        self.bot = Aswo(pools=self.pools, osu=StandInOsu(self.osu.url, session=self.pools.session("osu")), pool=self.pool, cache_mode="lean")
+        await self.bot.__aenter__()
+        self._cleanup.append(self.bot.close)
+        if self.unthrottled:
+            for limiter in (self.bot.osu_limiter, self.bot.ordr_limiter):
+                limiter.rate, limiter.burst = 1e6, 1_000_000
+
+        # Edits land on the driver instead of Discord, everything before them is the real coalescer.
+        self.bot.edits = utils.EditCoalescer(self.driver.edit_message)
+        # setup_hook needs a logged in user for the prefixes, this is the part of it the osu cog relies on.
+        self.bot.render_disabled = set()
+        self.bot.settings = utils.UserSettings(self.pool)
+        await self.bot.beatmaps.start()
+        self.cog = Osu(self.bot)
+        await self.bot.add_cog(self.cog)
+
+        await asyncio.wait_for(self.cog.skins.wait_until_ready(), timeout=10)
+        while not self.cog.renders.connected:
+            await asyncio.sleep(0.05)
+
+    async def __aexit__(self, *args: Any):
+        while self._cleanup:
+            try:
+                await self._cleanup.pop()()
+            except Exception as e:
+                print(f"cleanup failed: {e!r}")
+
+    async def _drop_schema(self):
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            await conn.execute(f"DROP SCHEMA {self.schema} CASCADE")
+        finally:
+            await conn.close()
+
+    def upstream(self) -> Dict[str, Counter[str]]:
+        return {"osu!": Counter(self.osu.calls), "o!rdr": Counter(self.ordr.calls), "discord": Counter(self.driver.stats())}
+
+    async def run(self, name: str, jobs: List[Callable[[], Awaitable[Tuple[float, str]]]]) -> Result:
+        before = self.upstream()
+        start = time.perf_counter()
+        results = await asyncio.gather(*(job() for job in jobs))
+        wall = time.perf_counter() - start
+        after = self.upstream()
+        return Result(
+            name,
+            wall,
+            [latency for latency, _ in results],
+            Counter(outcome for _, outcome in results),
+            {upstream: after[upstream] - before[upstream] for upstream in after},
+        )
+
+
+async def _answered(message: FakeMessage, timeout: float) -> str:
+    try:
+        content = await asyncio.wait_for(asyncio.shield(message.final), timeout)
+    except asyncio.TimeoutError:
+        return "timeout"
+    return "video" if "rendered video" in content else "refused"
+
+
+async def replay_flood(test: LoadTest, *, scale: float = 1.0, timeout: float = 600.0) -> Result:
+    """Lots of users posting .osr files across a handful of guilds at once, a fifth of them reposts."""
+    posts, users, guilds = int(200 * scale), max(int(60 * scale), 1), 10
+    unique = max(int(posts * 0.8), 1)
+    replays = [payloads.replay(frames=500, replay_md5=f"{n:032x}") for n in range(unique)]
+    channels = [test.driver.channel(100 + guild, 1000 + guild) for guild in range(guilds)]
+    authors = [FakeUser(10_000 + user) for user in range(users)]
+
+    def post(n: int) -> Callable[[], Awaitable[Tuple[float, str]]]:
+        async def job() -> Tuple[float, str]:
+            attachment = test.driver.attach("replay.osr", replays[n % unique])
+            message = test.driver.message(channels[n % guilds], authors[n % users], attachments=[attachment])
+            start = time.perf_counter()
+            replies = await test.driver.replies(test.cog.on_message(message))
+            if not replies:
+                return time.perf_counter() - start, "ignored"
+            outcome = await _answered(replies[-1], timeout)
+            return time.perf_counter() - start, outcome
+        return job
+
+    return await test.run("replay_flood", [post(n) for n in range(posts)])
+
+
+async def _command_burst(test: LoadTest, name: str, command: Any, requests: int, users: int) -> Result:
+    channel = test.driver.channel(200, 2000)
+
+    def invoke(n: int) -> Callable[[], Awaitable[Tuple[float, str]]]:
+        async def job() -> Tuple[float, str]:
+            interaction = test.driver.interaction(channel, FakeUser(20_000 + n))
+            start = time.perf_counter()
+            await command.callback(test.cog, interaction, f"player{n % users + 1}")
+            response = interaction.response
+            outcome = "refused" if response.message is None or response.kwargs.get("ephemeral") else "ok"
+            return time.perf_counter() - start, outcome
+        return job
+
+    return await test.run(name, [invoke(n) for n in range(requests)])
+
+
+async def user_burst(test: LoadTest, *, scale: float = 1.0) -> Result:
+    """``/user`` for a small set of players over and over, mostly served from the response cache."""
+    return await _command_burst(test, "user_burst", test.cog.user, int(500 * scale), max(int(50 * scale), 1))
+
+
+async def recent_burst(test: LoadTest, *, scale: float = 1.0) -> Result:
+    """``/recent`` for many players, each one a score sync and a Postgres read."""
+    return await _command_burst(test, "recent_burst", test.cog.recent, int(300 * scale), max(int(100 * scale), 1))
+
+
+SCENARIOS: Dict[str, Callable[..., Awaitable[Result]]] = {
+    "replay_flood": replay_flood,
+    "user_burst": user_burst,
+    "recent_burst": recent_burst,
+}
+
+
+def report(result: Result):
+    count = len(result.latencies)
+    outcomes = " ".join(f"{outcome}={n}" for outcome, n in sorted(result.outcomes.items()))
+    print(
+        f"{result.scenario:<14} {count:>6} {count / result.wall:>9.1f}/s "
+        f"{percentile(result.latencies, 0.5) * 1000:>9.1f}ms {percentile(result.latencies, 0.99) * 1000:>9.1f}ms  {outcomes}"
+    )
+    for upstream, calls in result.upstream.items():
+        if calls:
+            print(f"    {upstream:<8} " + ", ".join(f"{route}: {n}" for route, n in sorted(calls.items())))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load tests the osu cog against local stand-ins for osu!, o!rdr and Discord.")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}, all of them by default")
+    parser.add_argument("--dsn", default=os.environ.get("ASWO_BENCH_DSN"), help="Postgres to create the scratch schema in, or ASWO_BENCH_DSN")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies every scenario's request count")
+    parser.add_argument("--render-time", type=float, default=1.0, help="seconds the o!rdr stand-in takes per render")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every stand-in waits before answering")
+    parser.add_argument("--unthrottled", action="store_true", help="lift the bot's osu! and o!rdr rate limits to measure the bot alone")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - SCENARIOS.keys()
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if not args.dsn:
+        parser.error("a Postgres DSN is needed, pass --dsn or set ASWO_BENCH_DSN")
+
+    async with LoadTest(args.dsn, render_time=args.render_time, latency=args.latency, unthrottled=args.unthrottled) as test:
+        print(f"{'scenario':<14} {'ops':>6} {'throughput':>11} {'p50':>11} {'p99':>11}")
+        for name in args.scenarios or SCENARIOS:
+            report(await SCENARIOS[name](test, scale=args.scale))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,161 @@
+"""Measures how much memory discord.py's cache holds per guild in each utils.CacheProfile mode.
+
+Feeds synthetic GUILD_CREATE and MESSAGE_CREATE payloads into a bare ConnectionState,
+shaped like what the gateway sends with that mode's intents: full mode gets every member
+(what chunking ends up with) plus presences for the online ones, lean mode only gets our
+own member and no presences.
+
+Run with ``python -m benchmarks.memory`` from the repository root.
+"""
+from __future__ import annotations
+import gc
+import tracemalloc
+from typing import Any, Dict, List
+import discord
+from discord.state import ConnectionState
+from utils.cachemode import CacheProfile, cache_profile
+
+BOT_ID = 1_000_000
+MEMBERS_PER_GUILD = 500
+ONLINE = 0.2
+CHANNELS_PER_GUILD = 20
+MESSAGES_PER_GUILD = 50
+
+
+def user(user_id: int) -> Dict[str, Any]:
+    return {
+        "id": str(user_id),
+        "username": f"player{user_id}",
+        "global_name": f"Player {user_id}",
+        "discriminator": "0",
+        "avatar": "a" * 32,
+        "public_flags": 0,
+    }
+
+
+def member(user_id: int) -> Dict[str, Any]:
+    return {
+        "user": user(user_id),
+        "nick": None,
+        "roles": [],
+        "joined_at": "2022-08-01T12:00:00.000000+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def presence(user_id: int) -> Dict[str, Any]:
+    return {
+        "user": {"id": str(user_id)},
+        "status": "online",
+        "client_status": {"desktop": "online"},
+        "activities": [{"name": "osu!", "type": 0, "created_at": 1660000000000, "details": "FREEDOM DiVE [FOUR DIMENSIONS]"}],
+    }
+
+
+def guild(guild_id: int, profile: CacheProfile) -> Dict[str, Any]:
+    first_member = guild_id * 10_000
+    member_ids = range(first_member, first_member + MEMBERS_PER_GUILD)
+
+    data: Dict[str, Any] = {
+        "id": str(guild_id),
+        "name": f"osu! guild {guild_id}",
+        "owner_id": str(first_member),
+        "member_count": MEMBERS_PER_GUILD + 1,
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "channels": [
+            {"id": str(guild_id * 100 + index), "type": 0, "name": f"channel-{index}", "position": index, "permission_overwrites": []}
+            for index in range(CHANNELS_PER_GUILD)
+        ],
+        "members": [member(BOT_ID)],
+        "presences": [],
+        "voice_states": [],
+        "threads": [],
+    }
+
+    if profile.intents.members:
+        data["members"].extend(member(member_id) for member_id in member_ids)
+    if profile.intents.presences:
+        data["presences"] = [presence(member_id) for member_id in member_ids[:int(MEMBERS_PER_GUILD * ONLINE)]]
+
+    return data
+
+
+def message(message_id: int, channel_id: int, guild_id: int) -> Dict[str, Any]:
+    author = guild_id * 10_000 + message_id % MEMBERS_PER_GUILD
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": user(author),
+        "member": {k: v for k, v in member(author).items() if k != "user"},
+        "content": "check out my new play https://osu.ppy.sh/scores/osu/4000000000",
+        "timestamp": "2022-08-01T12:00:00.000000+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+
+def build_state(profile: CacheProfile) -> ConnectionState:
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None, **profile.options())  # type: ignore
+    state.user = discord.ClientUser(state=state, data=user(BOT_ID))  # type: ignore
+    return state
+
+
+def populate(state: ConnectionState, profile: CacheProfile, guilds: int):
+    for guild_id in range(1, guilds + 1):
+        state._add_guild_from_data(guild(guild_id, profile))  # type: ignore
+
+        if state._messages is None:
+            continue
+
+        channel = state._get_guild(guild_id).text_channels[0]  # type: ignore
+        for index in range(MESSAGES_PER_GUILD):
+            state._messages.append(discord.Message(state=state, channel=channel, data=message(guild_id * 1000 + index, channel.id, guild_id)))  # type: ignore
+
+
+def memory_per_guild(mode: str, guilds: int) -> float:
+    profile = cache_profile(mode)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    state = build_state(profile)
+    populate(state, profile, guilds)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del state
+    return size / guilds
+
+
+def main():
+    guilds = 200
+    results: List[float] = []
+
+    print(f"{'mode':<6} {'intents':>8} {'members':>8} {'messages':>9} {'KiB/guild':>10}")
+    for mode in ("full", "lean"):
+        profile = cache_profile(mode)
+        results.append(memory_per_guild(mode, guilds))
+        print(
+            f"{mode:<6} {profile.intents.value:>8} {'all' if profile.member_cache_flags.joined else 'self':>8}"
+            f" {profile.max_messages or 0:>9} {results[-1] / 1024:>10.1f}"
+        )
+
+    print(f"lean keeps {results[1] / results[0]:.1%} of the full cache")
+
+
+if __name__ == "__main__":
+    main()
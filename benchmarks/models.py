@@ -0,0 +1,150 @@
+"""Compares the lazy slotted models in utils.old_osu with the eager classes they replaced.
+
+Run with ``python -m benchmarks.models`` from the repository root.
+"""
+from __future__ import annotations
+import datetime
+import gc
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+from utils.old_osu import Beatmap, Score, User
+from . import payloads
+
+
+# The eager implementations as they were before the models became lazy, kept here as the baseline.
+class EagerUser:
+    def __init__(self, data):
+        self.data = data
+        self.username = data['username']
+        self.global_rank = data.get('statistics').get("global_rank") if data.get('statistics').get("global_rank") is not None else 0
+        self.pp = data.get("statistics").get("pp")  if data.get('statistics') else "None"
+        self._rank = data.get("statistics").get("grade_counts") if data.get('statistics') else "None"
+        self.accuracy = f"{data.get('statistics').get('hit_accuracy'):,.2f}"  if data.get('statistics') else "None"
+        self.country_rank = data.get('statistics').get("country_rank") if data.get('statistics').get("country_rank") is not None else 0
+        self._profile_order = data['profile_order'] if data['profile_order'] else "Cant Get Profile Order!"
+        self.country_emoji = f":flag_{data.get('country_code').lower()}:" if data.get("country_code") else "None"
+        self.country_code = data.get("country_code") if data.get("country_code") else "None"
+        self._country = data.get("country")
+        self.avatar_url = data.get("avatar_url")
+        self.id = data.get("id")
+        self.playstyle = data.get("playstyle")
+        self.playmode = data.get("playmode")
+        self.max_combo = data.get("statistics").get("maximum_combo")
+        self.level = data.get("statistics").get("level")
+        self.follower_count = data.get("follower_count")
+        self.total_hits = data.get("statistics").get("total_hits")
+        self.total_score = data.get("statistics").get("total_score")
+        self.play_count = data.get("statistics").get("play_count")
+
+
+class EagerBeatmap:
+    def __init__(self, data):
+        self.data = data
+        self.artist = data['beatmapset']['artist']
+        self.title = data['beatmapset']['title']
+        self.beatmapset = data['beatmapset']
+        self.beatmapset_id = data['beatmapset_id']
+        self.difficulty_rating = data['difficulty_rating']
+        self.id = data['id']
+        self.mode = data['mode']
+        self.status = data['status']
+        self.difficulty = data['version']
+        self.cs = data['cs']
+        self.drain = data['drain']
+        self.last_updated = datetime.datetime.fromisoformat(data['last_updated'].replace('Z', '')) if data['last_updated'] else None
+        self.pass_count = data['passcount']
+        self.play_count = data['playcount']
+        self.url = data['url']
+        self.favorite_count = data['beatmapset']['favourite_count']
+        self.nsfw = data['beatmapset']['nsfw']
+        self.ranked_date = datetime.datetime.fromisoformat(data['beatmapset']['ranked_date'].replace('Z', '')) if data['beatmapset']['ranked_date'] else None
+        self.submitted_date = datetime.datetime.fromisoformat(data['beatmapset']['submitted_date'].replace('Z', ''))  if data['beatmapset']['submitted_date'] else None
+        self.max_combo = data['max_combo']
+        self.creator = data['beatmapset']['creator']
+        self.ar = data['ar']
+        self.bpm = data['bpm']
+
+
+class EagerBeatmapCompact:
+    __slots__ = ("beatmapset_id", "difficulty_rating", "id", "mode", "status", "total_length", "user_id", "version")
+
+    def __init__(self, data: dict):
+        keys = {k: v for k, v in data.items() if k in self.__slots__}
+        for k, v in keys.items():
+            setattr(self, k, v)
+
+
+class EagerBeatmapset:
+    __slots__ = (
+        "artist", "artist_unicode", "creator", "favourite_count", "hype", "id", "nsfw", "offset", "play_count",
+        "preview_url", "source", "spotlight", "status", "title", "title_unicode", "track_id", "user_id", "video", "data",
+    )
+
+    def __init__(self, data: dict):
+        keys = {k: v for k, v in data.items() if k in self.__slots__}
+        for k, v in keys.items():
+            setattr(self, k, v)
+        self.data = data
+
+
+class EagerScore:
+    def __init__(self, data: dict):
+        keys = {k: v for k, v in data.items()}
+        for k, v in keys.items():
+            setattr(self, k, v)
+
+        self.beatmapset = EagerBeatmapset(data['beatmapset'])
+        self.beatmap = EagerBeatmapCompact(data['beatmap'])
+
+
+def construct_time(cls: Callable[[dict], Any], payload: dict, number: int) -> float:
+    return min(timeit.repeat(lambda: cls(payload), number=number, repeat=5)) / number
+
+
+def view_time(cls: Callable[[dict], Any], payload: dict, attributes: Tuple[str, ...], number: int) -> float:
+    # What a dropdown or embed typically does: build the model and read a handful of fields.
+    def run():
+        model = cls(payload)
+        for attribute in attributes:
+            getattr(model, attribute)
+
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def memory_per_object(cls: Callable[[dict], Any], payload: dict, count: int) -> float:
+    # Every object shares one payload dict, so this is what each model adds on top of it.
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [cls(payload) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del objects
+    return (size - count * 8) / count  # minus the list's pointers
+
+
+CASES: List[Tuple[str, Callable[[dict], Any], Callable[[dict], Any], Dict[str, Any], Tuple[str, ...]]] = [
+    ("User", EagerUser, User, payloads.user(), ("username", "id", "avatar_url")),
+    ("Beatmap", EagerBeatmap, Beatmap, payloads.beatmap(), ("title", "artist", "status")),
+    ("Score", EagerScore, Score, payloads.score(), ("id", "accuracy", "beatmapset")),
+]
+
+
+def main():
+    number = 20_000
+    count = 10_000
+
+    print(f"{'model':<8} {'impl':<6} {'construct':>12} {'+3 fields':>12} {'bytes/obj':>10}")
+    for name, eager, lazy, payload, attributes in CASES:
+        for label, cls in (("eager", eager), ("lazy", lazy)):
+            construct = construct_time(cls, payload, number) * 1e9
+            view = view_time(cls, payload, attributes, number) * 1e9
+            memory = memory_per_object(cls, payload, count)
+            print(f"{name:<8} {label:<6} {construct:>10.0f}ns {view:>10.0f}ns {memory:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""How long validating an .osr locally takes compared to what it replaces, an o!rdr round trip.
+
+Run with ``python -m benchmarks.osr`` from the repository root.
+"""
+from __future__ import annotations
+import asyncio
+import time
+from typing import AsyncIterator, Callable, List, Tuple
+from utils.osr import MOD_AUTOPLAY, MOD_TARGET_PRACTICE, read_replay
+from utils.osu_errors import InvalidReplay
+from . import payloads
+
+CHUNK = 16384
+
+
+async def chunked(data: bytes) -> AsyncIterator[bytes]:
+    # Feeds the file the way aiohttp's iter_chunked hands out a download.
+    for index in range(0, len(data), CHUNK):
+        yield data[index:index + CHUNK]
+
+
+CASES: List[Tuple[str, Callable[[], bytes]]] = [
+    ("valid", lambda: payloads.replay()),
+    ("taiko", lambda: payloads.replay(mode=1)),
+    ("autoplay", lambda: payloads.replay(mods=MOD_AUTOPLAY)),
+    ("target practice", lambda: payloads.replay(mods=MOD_TARGET_PRACTICE)),
+    ("bad username", lambda: payloads.replay(player="名前")),
+    ("no input", lambda: payloads.replay(frames=0)),
+    ("truncated", lambda: payloads.replay()[:40]),
+]
+
+
+async def main():
+    number = 500
+    print(f"{'case':<16} {'size':>8} {'result':>10} {'time':>10}")
+    for name, build in CASES:
+        data = build()
+        result = "ok"
+        start = time.perf_counter()
+        for _ in range(number):
+            try:
+                await read_replay(chunked(data))
+            except InvalidReplay as e:
+                result = f"code {e.error_code}"
+        elapsed = (time.perf_counter() - start) / number
+        print(f"{name:<16} {len(data):>8} {result:>10} {elapsed * 1e6:>8.0f}µs")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
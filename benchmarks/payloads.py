@@ -0,0 +1,197 @@
+"""Synthetic osu! API v2 payloads shaped like the real responses, used by the benchmarks."""
+from __future__ import annotations
+import random
+from typing import Any, Dict
+
+COVERS = {
+    name: f"https://assets.ppy.sh/beatmaps/1/covers/{name}.jpg?1"
+    for name in ("cover", "cover@2x", "card", "card@2x", "list", "list@2x", "slimcover", "slimcover@2x")
+}
+
+
+def beatmapset(beatmapset_id: int = 1) -> Dict[str, Any]:
+    return {
+        "artist": "xi",
+        "artist_unicode": "xi",
+        "covers": COVERS,
+        "creator": "Nakagawa-Kanon",
+        "favourite_count": 12345,
+        "hype": None,
+        "id": beatmapset_id,
+        "nsfw": False,
+        "offset": 0,
+        "play_count": 9876543,
+        "preview_url": f"//b.ppy.sh/preview/{beatmapset_id}.mp3",
+        "source": "",
+        "spotlight": False,
+        "status": "ranked",
+        "title": "FREEDOM DiVE",
+        "title_unicode": "FREEDOM DiVE",
+        "track_id": None,
+        "user_id": 87065,
+        "video": False,
+        "ranked_date": "2012-07-14T12:34:56Z",
+        "submitted_date": "2012-06-01T01:02:03Z",
+        "ratings": [random.randint(0, 5000) for _ in range(11)],
+    }
+
+
+def beatmap(beatmap_id: int = 129891) -> Dict[str, Any]:
+    return {
+        "beatmapset_id": 39804,
+        "difficulty_rating": 7.07,
+        "id": beatmap_id,
+        "mode": "osu",
+        "status": "ranked",
+        "total_length": 258,
+        "user_id": 87065,
+        "version": "FOUR DIMENSIONS",
+        "accuracy": 9,
+        "ar": 10,
+        "bpm": 222.22,
+        "convert": False,
+        "count_circles": 1983,
+        "count_sliders": 333,
+        "count_spinners": 3,
+        "cs": 4,
+        "deleted_at": None,
+        "drain": 8,
+        "hit_length": 256,
+        "is_scoreable": True,
+        "last_updated": "2014-05-18T17:22:13Z",
+        "mode_int": 0,
+        "passcount": 543210,
+        "playcount": 12345678,
+        "ranked": 1,
+        "url": f"https://osu.ppy.sh/beatmaps/{beatmap_id}",
+        "checksum": "da8aae79c8f3306b5d65ec951874a7fb",
+        "max_combo": 2385,
+        "beatmapset": beatmapset(39804),
+        "failtimes": {"fail": [0] * 100, "exit": [0] * 100},
+    }
+
+
+def user(user_id: int = 2) -> Dict[str, Any]:
+    return {
+        "avatar_url": f"https://a.ppy.sh/{user_id}?1.png",
+        "country_code": "AU",
+        "id": user_id,
+        "is_bot": False,
+        "username": f"player{user_id}",
+        "discord": None,
+        "join_date": "2007-08-28T04:09:51+00:00",
+        "playmode": "osu",
+        "playstyle": ["mouse", "keyboard"],
+        "profile_order": ["me", "recent_activity", "top_ranks", "medals", "historical", "beatmaps", "kudosu"],
+        "follower_count": 12345,
+        "country": {"code": "AU", "name": "Australia"},
+        "statistics": {
+            "level": {"current": 100, "progress": 12},
+            "global_rank": 1234,
+            "pp": 9876.54,
+            "ranked_score": 12345678901,
+            "hit_accuracy": 98.7654,
+            "play_count": 54321,
+            "play_time": 9876543,
+            "total_score": 98765432101,
+            "total_hits": 12345678,
+            "maximum_combo": 4321,
+            "replays_watched_by_others": 1234,
+            "is_ranked": True,
+            "grade_counts": {"ss": 12, "ssh": 34, "s": 567, "sh": 890, "a": 1234},
+            "country_rank": 12,
+        },
+        "monthly_playcounts": [{"start_date": f"2020-{month:02}-01", "count": month * 10} for month in range(1, 13)] * 10,
+        "replays_watched_counts": [{"start_date": f"2020-{month:02}-01", "count": month} for month in range(1, 13)] * 10,
+        "rank_history": {"mode": "osu", "data": list(range(1234, 1324))},
+        "user_achievements": [{"achieved_at": "2020-01-01T00:00:00Z", "achievement_id": n} for n in range(150)],
+        "page": {"html": "<div>" + "hello " * 500 + "</div>", "raw": "hello " * 500},
+    }
+
+
+def score(score_id: int = 1) -> Dict[str, Any]:
+    data = beatmap()
+    return {
+        "accuracy": 0.9876,
+        "best_id": score_id,
+        "created_at": "2022-01-01T00:00:00Z",
+        "id": score_id,
+        "max_combo": 2385,
+        "mode": "osu",
+        "mode_int": 0,
+        "mods": ["HD", "HR"],
+        "passed": True,
+        "perfect": False,
+        "pp": 812.3,
+        "rank": "SH",
+        "replay": True,
+        "score": 98765432,
+        "statistics": {"count_100": 12, "count_300": 2300, "count_50": 0, "count_geki": 300, "count_katu": 10, "count_miss": 1},
+        "user_id": 2,
+        "current_user_attributes": {"pin": None},
+        "beatmap": {key: value for key, value in data.items() if key not in ("beatmapset", "failtimes")},
+        "beatmapset": data["beatmapset"],
+        "user": {key: user()[key] for key in ("avatar_url", "country_code", "id", "is_bot", "username")},
+        "weight": {"percentage": 100, "pp": 812.3},
+    }
+
+
+def skin(skin_id: int = 1) -> Dict[str, Any]:
+    return {
+        "id": skin_id,
+        "skin": f"skin-{skin_id}",
+        "presentationName": f"Skin {skin_id}",
+        "url": f"https://link.issou.best/skin{skin_id}",
+        "highResPreview": f"https://link.issou.best/skin{skin_id}/full.png",
+        "lowResPreview": f"https://link.issou.best/skin{skin_id}/low.png",
+        "gridPreview": f"https://link.issou.best/skin{skin_id}/grid.png",
+        "hasCursorMiddle": True,
+        "author": "someone",
+        "modified": False,
+        "version": "1.0",
+        "alphabeticalId": skin_id,
+        "timesUsed": skin_id * 10,
+    }
+
+
+def skins_page(count: int = 400) -> Dict[str, Any]:
+    return {"skins": [skin(n) for n in range(1, count + 1)], "maxSkins": count}
+
+
+def _osr_string(value: str) -> bytes:
+    if not value:
+        return b"\x00"
+
+    data = value.encode()
+    length = bytearray()
+    size = len(data)
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        length.append(byte | (0x80 if size else 0))
+        if not size:
+            break
+    return b"\x0b" + bytes(length) + data
+
+
+def replay(*, mode: int = 0, mods: int = 0, player: str = "peppy", frames: int = 5000, replay_md5: str = "0123456789abcdef0123456789abcdef") -> bytes:
+    """An .osr file with ``frames`` cursor movements, shaped like one osu! writes."""
+    import lzma
+    import struct
+
+    body = ["0|256|-500|0", "-1|256|-500|0"]
+    body += [f"16|{i % 512}|{i % 384}|{1 if i % 7 else 0}" for i in range(frames)]
+    body.append("-12345|0|0|4242")
+    data = lzma.compress((",".join(body) + ",").encode(), format=lzma.FORMAT_ALONE)
+
+    return b"".join((
+        struct.pack("<bi", mode, 20230101),
+        _osr_string("da8aae79c8f3306b5d65ec951874a7fb"),
+        _osr_string(player),
+        _osr_string(replay_md5),
+        struct.pack("<hhhhhhihbi", 2300, 12, 0, 300, 10, 1, 98765432, 2385, 0, mods),
+        _osr_string("0|1,1000|1," * 200),
+        struct.pack("<qi", 638000000000000000, len(data)),
+        data,
+        struct.pack("<q", 4000000000),
+    ))
@@ -0,0 +1,360 @@
+"""Local stand-ins for osu!, o!rdr and Discord, so the bot can be load tested without any of them.
+
+The osu! and o!rdr stand-ins are real HTTP servers on localhost that serve the
+payloads from :mod:`benchmarks.payloads` and count every request per route. The
+Discord side is a driver that hands synthetic messages and interactions straight
+to the cog and records what the bot sends back.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import datetime
+import importlib
+import itertools
+import zlib
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import aiohttp
+import socketio
+from aiohttp import web
+import utils.ordr
+from utils import old_osu
+from . import payloads
+
+
+class StandIn:
+    """An aiohttp app on a free local port that counts requests by route and can add latency to them."""
+    def __init__(self, *, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.app = web.Application(middlewares=[self._count])
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+        self.calls[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _user_id(value: str) -> int:
+    # payloads.user(n) is called "player{n}", other names get a stable made up id.
+    name = value.lower()
+    if name.isdigit():
+        return int(name)
+    if name.startswith("player") and name[6:].isdigit():
+        return int(name[6:])
+    return zlib.crc32(name.encode()) % 10_000_000 + 1
+
+
+class OsuStandIn(StandIn):
+    """Serves ``/oauth/token`` and the parts of ``/api/v2`` the bot uses."""
+    def __init__(self, *, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.app.router.add_post("/oauth/token", self.token)
+        self.app.router.add_get("/api/v2/users/{user}", self.user)
+        self.app.router.add_get("/api/v2/users/{user}/{mode}", self.user)
+        self.app.router.add_get("/api/v2/users/{user}/scores/{type}", self.scores)
+        self.app.router.add_get("/api/v2/users/{user}/beatmapsets/{type}", self.beatmapsets)
+        self.app.router.add_get("/api/v2/beatmaps", self.beatmaps)
+        self.app.router.add_get("/api/v2/beatmaps/{beatmap}", self.beatmap)
+
+    async def token(self, request: web.Request) -> web.Response:
+        return web.json_response({"token_type": "Bearer", "expires_in": 86400, "access_token": "stand-in"})
+
+    async def user(self, request: web.Request) -> web.Response:
+        return web.json_response(payloads.user(_user_id(request.match_info['user'])))
+
+    async def scores(self, request: web.Request) -> web.Response:
+        user_id = _user_id(request.match_info['user'])
+        limit = int(request.query.get("limit", 5))
+        scores = []
+        for index in range(limit):
+            score = payloads.score(user_id * 1000 + index)
+            score["user_id"] = user_id
+            score["created_at"] = f"2022-01-01T00:{index // 60:02}:{index % 60:02}Z"
+            scores.append(score)
+        return web.json_response(scores)
+
+    async def beatmapsets(self, request: web.Request) -> web.Response:
+        limit = int(request.query.get("limit", 5))
+        return web.json_response([payloads.beatmapset(index) for index in range(1, limit + 1)])
+
+    async def beatmaps(self, request: web.Request) -> web.Response:
+        return web.json_response({"beatmaps": [payloads.beatmap(int(beatmap_id)) for beatmap_id in request.query.getall("ids[]", [])]})
+
+    async def beatmap(self, request: web.Request) -> web.Response:
+        return web.json_response(payloads.beatmap(int(request.match_info['beatmap'])))
+
+
+class OrdrStandIn(StandIn):
+    """Takes renders over HTTP and finishes them over Socket.IO after ``render_time`` seconds.
+
+    Like the real o!rdr every progress and done event is broadcast to every client.
+    """
+    def __init__(self, *, render_time: float = 2.0, progress_every: float = 0.5, skins: int = 400, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.render_time = render_time
+        self.progress_every = progress_every
+        self.skins = payloads.skins_page(skins)["skins"]
+        self.renders: Dict[int, Dict[str, Any]] = {}
+        self.events: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+        self._tasks: set[asyncio.Task] = set()
+        self.sio = socketio.AsyncServer(async_mode="aiohttp")
+        self.sio.attach(self.app)
+        self.app.router.add_post("/renders", self.submit)
+        self.app.router.add_get("/renders", self.lookup)
+        self.app.router.add_get("/skins", self.skin_page)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await super().close()
+
+    async def submit(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        render_id = next(self._ids)
+        self.renders[render_id] = {"renderID": render_id, "replayURL": data.get("replayURL"), "skin": data.get("skin"), "progress": "In queue...", "videoUrl": None}
+
+        task = asyncio.create_task(self._render(render_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({"message": "Render added successfully", "renderID": render_id, "errorCode": 0})
+
+    async def _emit(self, event: str, data: Dict[str, Any]):
+        self.events[event] += 1
+        await self.sio.emit(event, data)
+
+    async def _render(self, render_id: int):
+        render = self.renders[render_id]
+        steps = max(int(self.render_time / self.progress_every), 1)
+        for step in range(steps):
+            await asyncio.sleep(self.render_time / steps)
+            render["progress"] = f"Rendering... ({(step + 1) * 100 // steps}%)"
+            await self._emit("render_progress_json", {"renderID": render_id, "progress": render["progress"], "username": "Aswo", "renderer": "stand-in"})
+
+        render["progress"] = "Done."
+        render["videoUrl"] = f"https://link.issou.best/stand-in/{render_id}"
+        await self._emit("render_done_json", {"renderID": render_id, "videoUrl": render["videoUrl"]})
+
+    async def lookup(self, request: web.Request) -> web.Response:
+        render = self.renders.get(int(request.query.get("renderID", 0)))
+        return web.json_response({"renders": [render] if render else [], "maxRenders": 1 if render else 0})
+
+    async def skin_page(self, request: web.Request) -> web.Response:
+        size = int(request.query.get("pageSize", 100))
+        page = int(request.query.get("page", 1))
+        return web.json_response({"skins": self.skins[(page - 1) * size:page * size], "maxSkins": len(self.skins)})
+
+
+def redirect_ordr(url: str):
+    """Points the o!rdr constants at ``url``, the cog and utils.ordr read them at call time."""
+    # cogs.osu re-exports the cog class under the module's name, so go through importlib.
+    cog_module = importlib.import_module("cogs.osu.osu")
+    utils.ordr.ORDR_API = url
+    utils.ordr.ORDR_WS = url
+    cog_module.ORDR_API = url
+
+
+class StandInOsu(old_osu.Osu):
+    """The bot's osu! client pointed at :class:`OsuStandIn`, throttled by its own limiter like in production."""
+    def __init__(self, url: str, *, session: aiohttp.ClientSession):
+        super().__init__(client_id=1, client_secret="stand-in", session=session)
+        self.API_URL = f"{url}/api/v2"
+        self.TOKEN_URL = self.tokens.token_url = f"{url}/oauth/token"
+
+
+_sent: contextvars.ContextVar[List[FakeMessage]] = contextvars.ContextVar("sent")
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = self.display_name = f"player{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id: int, filename: str, url: str, size: int):
+        self.id = attachment_id
+        self.filename = filename
+        self.url = url
+        self.size = size
+
+
+class FakeMessage:
+    def __init__(self, driver: DiscordDriver, message_id: int, channel: FakeChannel, author: FakeUser, content: str, attachments: List[FakeAttachment]):
+        self.driver = driver
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.attachments = attachments
+        self.final = asyncio.get_running_loop().create_future()
+        self.edits = 0
+
+    async def edit(self, *, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        await self.driver.edit_message(self.channel.id, self.id, content)
+        return self
+
+
+class FakeChannel:
+    def __init__(self, driver: DiscordDriver, channel_id: int, guild: Optional[FakeGuild]):
+        self.driver = driver
+        self.id = channel_id
+        self.guild = guild
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        return self.driver.record(self, self.driver.bot_user, content or "")
+
+
+class FakeResponse:
+    def __init__(self, interaction: FakeInteraction):
+        self.interaction = interaction
+        self.message: Optional[FakeMessage] = None
+        self.kwargs: Dict[str, Any] = {}
+        self.deferred = False
+
+    def is_done(self) -> bool:
+        return self.deferred or self.message is not None
+
+    async def defer(self, **kwargs: Any):
+        self.deferred = True
+
+    async def send_message(self, content: Optional[str] = None, **kwargs: Any):
+        self.kwargs = kwargs
+        self.message = self.interaction.channel.driver.record(self.interaction.channel, self.interaction.channel.driver.bot_user, content or "")
+
+
+class FakeFollowup:
+    """Followups land where the response would have, the harness only looks at the first reply."""
+    def __init__(self, interaction: FakeInteraction):
+        self.interaction = interaction
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        response = self.interaction.response
+        await response.send_message(content, **kwargs)
+        return response.message
+
+
+class FakeInteraction:
+    def __init__(self, interaction_id: int, user: FakeUser, channel: FakeChannel):
+        self.id = interaction_id
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id if channel.guild else None
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def original_response(self) -> FakeMessage:
+        return self.response.message
+
+    async def edit_original_response(self, *, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:
+        return await self.response.message.edit(content=content)
+
+
+class DiscordDriver:
+    """Builds synthetic messages and interactions and collects whatever the bot sends and edits.
+
+    A message counts as answered once its content is something other than the
+    "detected" or progress text, that's the point a user would see their video or error.
+    """
+    PENDING_PREFIXES = ("Osu replay file detected", "Your replay is being rendered")
+
+    def __init__(self, *, latency: float = 0.0):
+        self.latency = latency
+        self.cdn = StandIn()
+        self.cdn.app.router.add_get("/attachments/{name}", self._attachment)
+        self.bot_user = FakeUser(1)
+        self.files: Dict[str, bytes] = {}
+        self.messages: Dict[int, FakeMessage] = {}
+        self.sent = 0
+        self.edits = 0
+        self._ids = itertools.count(10_000)
+
+    async def start(self):
+        await self.cdn.start()
+
+    async def close(self):
+        await self.cdn.close()
+
+    async def _attachment(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.files[request.match_info['name']])
+
+    def channel(self, channel_id: int, guild_id: Optional[int]) -> FakeChannel:
+        return FakeChannel(self, channel_id, FakeGuild(guild_id) if guild_id is not None else None)
+
+    def attach(self, filename: str, data: bytes) -> FakeAttachment:
+        name = f"{next(self._ids)}-{filename}"
+        self.files[name] = data
+        return FakeAttachment(next(self._ids), filename, f"{self.cdn.url}/attachments/{name}", len(data))
+
+    def message(self, channel: FakeChannel, author: FakeUser, *, content: str = "", attachments: List[FakeAttachment] = ()) -> FakeMessage:
+        message = FakeMessage(self, next(self._ids), channel, author, content, list(attachments))
+        self.messages[message.id] = message
+        return message
+
+    def interaction(self, channel: FakeChannel, user: FakeUser) -> FakeInteraction:
+        return FakeInteraction(next(self._ids), user, channel)
+
+    def record(self, channel: FakeChannel, author: FakeUser, content: str) -> FakeMessage:
+        self.sent += 1
+        message = self.message(channel, author, content=content)
+        self._settle(message, content)
+        sent = _sent.get(None)
+        if sent is not None:
+            sent.append(message)
+        return message
+
+    async def edit_message(self, channel_id: int, message_id: int, content: str):
+        """What the bot's EditCoalescer sends edits through during a load test."""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        self.edits += 1
+        message = self.messages[message_id]
+        message.edits += 1
+        message.content = content
+        self._settle(message, content)
+
+    def _settle(self, message: FakeMessage, content: str):
+        if not message.final.done() and not content.startswith(self.PENDING_PREFIXES):
+            message.final.set_result(content)
+
+    async def replies(self, handler: Awaitable[Any]) -> List[FakeMessage]:
+        """Awaits ``handler`` and returns every message the bot sent while handling it."""
+        sent: List[FakeMessage] = []
+        token = _sent.set(sent)
+        try:
+            await handler
+        finally:
+            _sent.reset(token)
+        return sent
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sent": self.sent, "edits": self.edits}
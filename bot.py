@@ -1,5 +1,7 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import json
 import sys
 from typing import TYPE_CHECKING
 from typing_extensions import Self
@@ -13,59 +15,157 @@ import os
 import asyncpg
 import socketio
 from config import replay_key
-from osu import Client
 import utils
+from utils.old_osu import Osu
 
 
 
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.typing = False
-intents.presences = True
+PREFIX_CHANNEL = "aswo_prefix"
 
 
-class Aswo(commands.Bot):
+class Aswo(commands.AutoShardedBot):
     """Base aswo bot subclass!"""
     def __init__(
         self, 
         *, 
-        session: aiohttp.ClientSession,
-        osu: Client,
-        pool: asyncpg.Pool
+        pools: utils.HTTPPools,
+        osu: Osu,
+        pool: asyncpg.Pool,
+        shard_ids: typing.Optional[typing.List[int]] = None,
+        shard_count: typing.Optional[int] = None,
+        cache_mode: str = "full",
+        cache_options: typing.Optional[typing.Dict[str, typing.Any]] = None
     ):
-        self.session = session
+        self.pools = pools
+        self.session = pools.session("default")
+        self.osu_session = pools.session("osu")
+        self.ordr_session = pools.session("ordr")
         self._connected = False
-        self.osu: Client = osu
+        self.osu: Osu = osu
         self.pool = pool
         self.startup_time: typing.Optional[datetime.timedelta] = None
         self.start_time = discord.utils.utcnow()
         self.logger = logging.getLogger(__name__)
         self.replay_key = replay_key
+        # The osu! client caches users and beatmaps itself, the cog's beatmap mirror lookups share it.
+        self.cache = osu.cache
+        self.views = utils.ViewRegistry()
+        self.edits = utils.EditCoalescer(self._edit_message)
+        # The osu! client throttles its own requests, this is the same limiter for stats and priorities.
+        self.osu_limiter = osu.limiter
+        self.ordr_limiter = utils.RateLimiter("o!rdr", rate=1.0, burst=10)
+        self.scores = utils.ScoreStore(pool, osu=osu)
+        self.beatmaps = utils.BeatmapMirror(pool, osu=osu)
 
         self._default_prefixes = (">>",)
+        self._prefix_listener: typing.Optional[asyncpg.Connection] = None
+        self.cluster: typing.Optional[utils.ClusterReporter] = None
+        self.metrics_server: typing.Optional[utils.MetricsServer] = None
+        self.loop_lag = utils.LoopLagMonitor()
+        self.cache_profile = utils.cache_profile(cache_mode, **(cache_options or {}))
 
 
         os.environ["JISHAKU_NO_UNDERSCORE"] = "True"
         os.environ["JISHAKU_NO_DM_TRACEBACK"] = "True"
         
-        super().__init__(command_prefix=self.get_pre,intents=intents, activity=discord.Activity(type=discord.ActivityType.playing, name="Click on the circles!"), owner_ids = [894794517079793704, 739219467455823921])
+        super().__init__(command_prefix=self.get_pre, **self.cache_profile.options(), activity=discord.Activity(type=discord.ActivityType.playing, name="Click on the circles!"), owner_ids = [894794517079793704, 739219467455823921], shard_ids=shard_ids, shard_count=shard_count)
 
 
 
     async def get_pre(self, bot, message: discord.Message):
-        if not message:
-            return commands.when_mentioned_or(*self._default_prefixes)(bot, message)
-        if not message.guild:
-            return commands.when_mentioned_or(*self._default_prefixes)(bot, message)
-
-        try:
-            prefix = (*self._default_prefixes, self.prefixes[message.guild.id], )
-        except KeyError:
-            prefix = self._default_prefixes
-
-        return commands.when_mentioned_or(*prefix)(bot, message)
+        # Prefix lists are built once per guild in _compile_prefixes, this only looks them up.
+        if not message or not message.guild:
+            return self._compiled_default
+
+        return self._compiled_prefixes.get(message.guild.id, self._compiled_default)
+
+    def _compile_prefixes(self, prefix: typing.Optional[str] = None) -> typing.Tuple[str, ...]:
+        mentions = (f'<@{self.user.id}> ', f'<@!{self.user.id}> ')
+        return (*mentions, *self._default_prefixes, prefix) if prefix else (*mentions, *self._default_prefixes)
+
+    async def _edit_message(self, channel_id: int, message_id: int, content: str):
+        await self.get_partial_messageable(channel_id).get_partial_message(message_id).edit(content=content)
+
+    def _cache_prefix(self, guild_id: int, prefix: str):
+        self.prefixes[guild_id] = prefix
+        self._compiled_prefixes[guild_id] = self._compile_prefixes(prefix)
+
+    async def set_prefix(self, guild_id: int, prefix: str):
+        """Saves a guild's prefix and tells every other bot process about it through NOTIFY"""
+        query = """
+            INSERT INTO prefix (guild_id, prefix) VALUES($1, $2)
+            ON CONFLICT(guild_id) DO 
+            UPDATE SET prefix = excluded.prefix
+        """
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(query, guild_id, prefix)
+            await conn.execute("SELECT pg_notify($1, $2)", PREFIX_CHANNEL, json.dumps({"guild_id": guild_id, "prefix": prefix}))
+
+        self._cache_prefix(guild_id, prefix)
+
+    def _on_prefix_notify(self, conn: asyncpg.Connection, pid: int, channel: str, payload: str):
+        data = json.loads(payload)
+        self._cache_prefix(data['guild_id'], data['prefix'])
+
+    async def _listen_for_changes(self):
+        # Prefixes and user settings share one LISTEN connection.
+        self._prefix_listener = await self.pool.acquire()
+        await self._prefix_listener.add_listener(PREFIX_CHANNEL, self._on_prefix_notify)
+        await self._prefix_listener.add_listener(utils.SETTINGS_CHANNEL, self.settings.on_notify)
+        self._prefix_listener.add_termination_listener(self._on_listener_lost)
+
+    def _on_listener_lost(self, conn: asyncpg.Connection):
+        if self.is_closed():
+            return
+
+        self.logger.warning("Lost the LISTEN connection, reconnecting")
+        self._prefix_listener = None
+        asyncio.create_task(self._relisten(conn))
+
+    async def _relisten(self, lost: asyncpg.Connection):
+        # Hand the dead connection back so the pool can replace it.
+        await self.pool.release(lost)
+
+        while not self.is_closed():
+            try:
+                await self._listen_for_changes()
+                break
+            except (OSError, asyncpg.PostgresError) as e:
+                self.logger.warning(f"Could not LISTEN for prefix and settings changes, retrying: {e}")
+                await asyncio.sleep(5)
+
+        if self.is_closed():
+            return
+
+        # Changes made while we weren't listening are missed, so reload the table once we're back.
+        query = await self.pool.fetch("SELECT * FROM prefix")
+        for x in query:
+            self._cache_prefix(x['guild_id'], x['prefix'])
+        self.settings.cache.clear()
+
+    async def close(self):
+        if self.cluster is not None:
+            self.cluster.stop()
+
+        await self.beatmaps.close()
+        await self.edits.close()
+        self.loop_lag.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+
+        if self._prefix_listener is not None:
+            # Without the termination listener the pool closing this connection would look like a lost one.
+            listener, self._prefix_listener = self._prefix_listener, None
+            listener.remove_termination_listener(self._on_listener_lost)
+            try:
+                await listener.remove_listener(PREFIX_CHANNEL, self._on_prefix_notify)
+                await listener.remove_listener(utils.SETTINGS_CHANNEL, self.settings.on_notify)
+            except (OSError, asyncpg.InterfaceError, asyncpg.PostgresError) as e:
+                self.logger.warning(f"Could not UNLISTEN, the pool resets the connection anyway: {e}")
+            await self.pool.release(listener)
+
+        await super().close()
 
     async def setup_hook(self): 
         query = await self.pool.fetch("SELECT * FROM prefix")
@@ -73,6 +173,46 @@ class Aswo(commands.Bot):
             x['guild_id']: x['prefix']
             for x in query
         }
+        self._compiled_default = self._compile_prefixes()
+        self._compiled_prefixes = {
+            guild_id: self._compile_prefixes(prefix)
+            for guild_id, prefix in self.prefixes.items()
+        }
+        self.settings = utils.UserSettings(self.pool)
+        await self._listen_for_changes()
+        await self.settings.warm()
+
+        query = await self.pool.fetch("SELECT guild_id FROM auto_render WHERE NOT enabled")
+        self.render_disabled = {x['guild_id'] for x in query}
+
+        await self.beatmaps.start()
+
+        self.loop_lag.start()
+        self.tree.error(self._on_app_command_error)
+        utils.REGISTRY.gauge("aswo_cache_entries", "Entries held by each in-memory cache", ("cache",), collect=self._cache_sizes)
+
+    def _cache_sizes(self) -> typing.Dict[typing.Tuple[str, ...], int]:
+        return {
+            ("responses",): len(self.cache),
+            ("views",): len(self.views),
+            ("guilds",): len(self.guilds),
+            ("users",): len(self.users),
+            ("messages",): len(self.cached_messages),
+        }
+
+    def _observe_command(self, interaction: discord.Interaction, status: str):
+        # created_at comes from the interaction's snowflake, so this includes the trip from Discord.
+        name = interaction.command.qualified_name if interaction.command is not None else "unknown"
+        utils.COMMAND_LATENCY.observe((discord.utils.utcnow() - interaction.created_at).total_seconds(), name, status)
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command: typing.Any):
+        self._observe_command(interaction, "ok")
+
+    async def _on_app_command_error(self, interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+        self._observe_command(interaction, "error")
+        if isinstance(error, discord.app_commands.MissingPermissions) and not interaction.response.is_done():
+            return await interaction.response.send_message(str(error), ephemeral=True)
+        await discord.app_commands.CommandTree.on_error(self.tree, interaction, error)
 
     async def get_context(self, message, *, cls=utils.Context ):
         return await super().get_context(message, cls=cls)
@@ -1,110 +1,230 @@
 from __future__ import annotations
+import aiohttp
+import asyncio
 import datetime
 import logging
-from typing import Optional
+from typing import Dict, Optional, Tuple
 import discord
 from discord.ext import commands
 from discord import app_commands
 from bot import Aswo
 import re
-from utils import default, error_codes, URL_RE
-import socketio
-from .views import UserView, RecentView
+import config
+from utils import default, error_codes, InvalidReplay, ReplayHeader, RenderCache, RenderJob, QueuedRender, RenderQueue, RenderQueueFull, read_replay, replay_hash, beatmap_ttl, read_json, RenderDispatcher, RenderFailed, SkinCatalog, ORDR_API, REGISTRY
+from .views import UserView, RecentView, UserSelect, RecentDropdown
 
 logger = logging.getLogger(__name__)
 
 class osu(commands.Cog):
     def __init__(self, bot: Aswo):
         self.bot = bot
-        self.cached_skins = {}
     
     replay = app_commands.Group(name="replay", description="Allows you to control various aspects of replay uploading")
 
     async def cog_load(self):
-        self.sio = socketio.AsyncClient()
+        self.renders = RenderDispatcher(session=self.bot.ordr_session, limiter=self.bot.ordr_limiter)
+        await self.renders.start()
+        self.render_cache = RenderCache(self.bot.pool, self.renders)
+        self.render_queue = RenderQueue(
+            self.bot.pool,
+            cache=self.render_cache,
+            dispatcher=self.renders,
+            submit=self.submit_render,
+            notify=self.notify_render,
+            progress=self.render_progress,
+            **getattr(config, "RENDER_QUEUE", {})
+        )
+        await self.render_queue.start(self._owns)
+        REGISTRY.gauge("aswo_pending_renders", "Replays waiting in the render queue, rendering, and renders waited on by o!rdr events", ("state",), collect=self._render_counts)
+        self.skins = SkinCatalog(session=self.bot.ordr_session, limiter=self.bot.ordr_limiter)
+        await self.skins.start()
+        # Lets dropdowns sent before a restart route back to us, their state is rehydrated through bot.views.
+        self.bot.add_dynamic_items(UserSelect, RecentDropdown)
+
+    async def cog_unload(self):
+        REGISTRY.unregister("aswo_pending_renders")
+        await self.render_queue.close()
+        await self.renders.close()
+        await self.skins.close()
+        self.bot.remove_dynamic_items(UserSelect, RecentDropdown)
+        logger.info("Osu cog has been unloaded! o!rdr disconnected")
+
+    async def fetch_user(self, user: str):
+        return await self.bot.osu.fetch_user(user)
+
+    async def fetch_beatmap(self, beatmap: str):
+        return await self.bot.cache.get_or_fetch("beatmap", str(beatmap), lambda: self.bot.beatmaps.get(int(beatmap)), ttl=beatmap_ttl)
+
+    async def submit_render(self, replay_url: str, skin: int) -> dict:
+        async with self.bot.ordr_limiter.request(self.bot.ordr_session, "POST", f"{ORDR_API}/renders", data={"replayURL": replay_url, "username":"Aswo", "resolution":"1280x720", "skin": skin,"verificationKey":self.bot.replay_key}) as resp:
+            ordr_json = await read_json(resp)
+
+        logger.info(ordr_json)
+        if ordr_json['errorCode'] not in error_codes:
+            # Listen before anything else is awaited so a fast render can't slip past us.
+            self.renders.register(ordr_json['renderID'])
+
+        return ordr_json
+
+    def _render_counts(self) -> Dict[Tuple[str, ...], int]:
+        return {
+            ("queued",): len(self.render_queue),
+            ("rendering",): self.render_queue.running,
+            ("subscribed",): len(self.renders),
+            ("edits",): len(self.bot.edits),
+        }
+
+    def _owns(self, guild_id: Optional[int]) -> bool:
+        # Every cluster resumes the render jobs of its own shards, DMs belong to shard 0.
+        if self.bot.shard_ids is None or self.bot.shard_count is None:
+            return True
+        return ((guild_id or 0) >> 22) % self.bot.shard_count in self.bot.shard_ids
+
+    def render_message(self, mention: str, video_url: Optional[str], error: Optional[BaseException]) -> str:
+        if isinstance(error, RenderFailed):
+            return error_codes.get(error.error_code, str(error))
+        if isinstance(error, asyncio.TimeoutError):
+            return f"Sorry {mention}, your render is taking too long so i stopped waiting for it :("
+        if error is not None:
+            return f"Sorry {mention}, something went wrong while rendering your replay :("
+
+        return f"Here's your rendered video {mention}!\n{video_url}"
+
+    async def notify_render(self, job: QueuedRender, video_url: Optional[str], error: Optional[BaseException]):
+        if error is not None and not isinstance(error, (RenderFailed, asyncio.TimeoutError)):
+            logger.warning(f"Render job {job.job_id} failed: {error}")
+
+        await self.bot.edits.edit(job.channel_id, job.message_id, self.render_message(f"<@{job.user_id}>", video_url, error))
+
+    def render_progress(self, job: QueuedRender, data: dict):
+        # Progress comes in every few seconds per render, the coalescer only sends the latest one.
+        self.bot.edits.submit(job.channel_id, job.message_id, f"Your replay is being rendered! {data.get('progress', '')}\nIll ping you when its finished!")
+
+    async def check_replay(self, replay: discord.Attachment) -> Optional[ReplayHeader]:
+        """Raises :class:`InvalidReplay` for replays o!rdr would reject, reading no more of the file than it has to."""
         try:
-            await self.sio.connect('https://ordr-ws.issou.best')
-        except socketio.exceptions.ConnectionError:
-            pass
-    
+            async with self.bot.session.get(replay.url) as resp:
+                resp.raise_for_status()
+                return await read_replay(resp.content.iter_chunked(16384))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # o!rdr downloads the file itself, so let it have a go instead of guessing.
+            logger.warning(f"Could not download {replay.filename} to check it: {e}")
+            return None
+
+    async def prepare_render(self, replay: discord.Attachment, skin: int) -> Tuple[Optional[str], Optional[RenderJob]]:
+        """Checks the replay and returns its hash, with the finished render if this replay was already rendered with this skin."""
+        header = await self.check_replay(replay)
+        if header is None:
+            return None, None
+
+        key = replay_hash(header)
+        job = await self.render_cache.find(key, skin)
+        return key, job if job is not None and job.video_url is not None else None
+
+    async def queue_render(self, replay: discord.Attachment, key: Optional[str], skin: int, *, user_id: int, guild_id: Optional[int], message: discord.Message):
+        try:
+            ahead = await self.render_queue.enqueue(
+                user_id=user_id,
+                guild_id=guild_id,
+                channel_id=message.channel.id,
+                message_id=message.id,
+                replay_url=replay.url,
+                replay_hash=key,
+                skin_id=skin
+            )
+        except RenderQueueFull as e:
+            return await self.bot.edits.edit(message.channel.id, message.id, str(e))
+
+        if ahead:
+            self.bot.edits.submit(message.channel.id, message.id, f"{message.content}\nAbout {ahead} replays are ahead of yours in the queue.")
+
+    @staticmethod
+    def find_replay(message: discord.Message) -> Optional[discord.Attachment]:
+        # Only looks at filenames, attachment URLs carry query strings so they can't be trusted to end in .osr
+        for attachment in message.attachments:
+            if attachment.filename.lower().endswith('.osr'):
+                return attachment
+
+        return None
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        if not message.attachments:
+            return
+
+        if message.guild is not None and message.guild.id in self.bot.render_disabled:
+            return
+
+        replay = self.find_replay(message)
+        if replay is None:
+            return
+
+        skin = (await self.bot.settings.get(message.author.id)).skin_id or 1
+        self.bot.logger.info(f"Skin : {skin}")
+
         try:
-            osr = message.attachments[0].url
-            if osr.endswith('.osr') or URL_RE.findall(message.content):
-                skin = await self.bot.pool.fetchval("SELECT skin_id FROM replay_config WHERE user_id = $1", message.author.id) or 1
-
-
-                self.bot.logger.info(f"Skin : {skin}")
-
-                async with self.bot.session.post("https://apis.issou.best/ordr/renders", data={"replayURL":osr, "username":"Aswo", "resolution":"1280x720", "skin": skin,"verificationKey":self.bot.replay_key}) as resp:
-                    ordr_json = await resp.json()
-                
-                if ordr_json['errorCode'] in error_codes:
-                    return await message.channel.send(error_codes.get(ordr_json['errorCode']))
-                    
-                mes = await message.channel.send("Osu replay file detected, a rendered replay will be sent shortly! May take a bit so relax :D!\nIll ping you when its finished!")
-                render_id = ordr_json['renderID']
-
-                @self.sio.event
-                async def render_done_json(data):
-                    if data['renderID'] == render_id:
-                        data = data
-                        self.bot.logger.info(data)
-                        await mes.edit(content=f"Here's your rendered video {message.author.mention}!\n{data['videoUrl']}")
-
-                await self.sio.wait()
-        except IndexError:
-            pass
+            key, job = await self.prepare_render(replay, skin)
+        except InvalidReplay as e:
+            return await message.channel.send(error_codes.get(e.error_code, str(e)))
+
+        if job is not None:
+            return await message.channel.send(f"Here's your rendered video {message.author.mention}!\n{job.video_url}")
+            
+        mes = await message.channel.send("Osu replay file detected, a rendered replay will be sent shortly! May take a bit so relax :D!\nIll ping you when its finished!")
+        await self.queue_render(replay, key, skin, user_id=message.author.id, guild_id=message.guild and message.guild.id, message=mes)
         
     @app_commands.command()
     async def recent(self, interaction: discord.Interaction, user: Optional[str]):
-        user_query = await self.bot.pool.fetchrow("SELECT osu_username FROM osu_user WHERE user_id = $1", interaction.user.id) 
+        osu_username = (await self.bot.settings.get(interaction.user.id)).osu_username
         try:
-            if user_query is None and user is None:
-                user = await self.bot.osu.fetch_user(interaction.user.display_name)
-            elif user_query is not None and user is None:
-                user = await self.bot.osu.fetch_user(user_query.get("osu_username"))
+            if osu_username is None and user is None:
+                user = await self.fetch_user(interaction.user.display_name)
+            elif osu_username is not None and user is None:
+                user = await self.fetch_user(osu_username)
             else:
-                user = await self.bot.osu.fetch_user(user)
+                user = await self.fetch_user(user)
         except Exception as e:
             return await interaction.response.send_message(f"{e}", ephemeral=True)
 
-        recents = await self.bot.osu.fetch_user_score(user.id, type="recent", limit=5, include_fails=True)
+        # A cold sync is a couple of rate limited API calls, more than Discord waits for a response.
+        await interaction.response.defer()
+        try:
+            await self.bot.scores.sync(user.id)
+            recents = await self.bot.scores.recent(user.id, limit=5)
+        except Exception as e:
+            logger.warning(f"Could not get recent plays for osu! user {user.id}: {e}")
+            return await interaction.followup.send(f"Couldn't get {user.username}'s recent plays right now, try again in a bit!", ephemeral=True)
 
-        await interaction.response.send_message(view=RecentView(recents))
+        if not recents:
+            return await interaction.followup.send(f"{user.username} has no recent plays!")
+
+        await interaction.followup.send(view=RecentView(user.id, recents))
 
 
     @app_commands.command()
     async def user(self, interaction: discord.Interaction, username: str = None):
         """Gets info on osu account"""
 
-        user_query = await self.bot.pool.fetchrow("SELECT osu_username FROM osu_user WHERE user_id = $1", interaction.user.id) 
+        osu_username = (await self.bot.settings.get(interaction.user.id)).osu_username
         try:
-            if user_query is None and username is None:
-                user = await self.bot.osu.fetch_user(interaction.user.display_name)
-            elif user_query is not None and username is None:
-                user = await self.bot.osu.fetch_user(user_query.get("osu_username"))
+            if osu_username is None and username is None:
+                user = await self.fetch_user(interaction.user.display_name)
+            elif osu_username is not None and username is None:
+                user = await self.fetch_user(osu_username)
             else:
-                user = await self.bot.osu.fetch_user(username)
+                user = await self.fetch_user(username)
         except Exception as e:
             return await interaction.response.send_message(f"{e}", ephemeral=True)
 
 
-        ss_text = user.rank['ss']
-        ssh_text = user.rank['ssh']
-        s_text = user.rank['s']
-        sh_text = user.rank['sh']
-        a_text = user.rank['a']
-        profile_order ='\n ​ ​ ​ ​ ​ ​ ​ ​  - '.join(x for x in user.profile_order)
-        profile_order = profile_order.replace("_", " ")
         joined_date = datetime.datetime.fromisoformat(user.data.get('join_date'))
         country_code = user.country_code if user.country_code not in ["XX", "xx"] else None
         
+        self.bot.views.set(("user", user.id), user)
         view = UserView(interaction.user.id,user)
     
     
-        embed = discord.Embed(description=f"**{user.country_emoji if user.country_code not in ['XX', 'xx'] else 'No country'}  | Profile for [{user.username}](https://osu.ppy.sh/users/{user.id})**\n\n▹ **Bancho Rank**: #{user.global_rank:,} ({country_code}#{user.country_rank:,})\n▹ **Join Date**: {discord.utils.format_dt(joined_date)}\n▹ **PP**: {int(user.pp):,} **Acc**: {user.accuracy}%\n▹ **Ranks**: ``SS {ss_text:,}`` | ``SSH {ssh_text:,}`` | ``S {s_text:,}`` | ``SH {sh_text:,}`` | ``A {a_text:,}``\n▹ **Profile Order**: \n** ​ ​ ​ ​ ​ ​ ​ ​  - {profile_order}**", color=0x2F3136)
+        embed = discord.Embed(description=f"**{user.country_emoji if user.country_code not in ['XX', 'xx'] else 'No country'}  | Profile for [{user.username}](https://osu.ppy.sh/users/{user.id})**\n\n▹ **Bancho Rank**: #{user.global_rank:,} ({country_code}#{user.country_rank:,})\n▹ **Join Date**: {discord.utils.format_dt(joined_date)}\n▹ **PP**: {int(user.pp):,} **Acc**: {user.accuracy}%\n▹ **Ranks**: {user.ranks}\n▹ **Profile Order**: \n** ​ ​ ​ ​ ​ ​ ​ ​  - {user.profile_order}**", color=0x2F3136)
         embed.set_thumbnail(url=user.avatar_url)
         await interaction.response.send_message(embed=embed, view=view)
 
@@ -122,14 +242,14 @@ class osu(commands.Cog):
         
 
         try:
-            rbeatmap = await self.bot.osu.fetch_beatmap(beatmapid)
+            rbeatmap = await self.fetch_beatmap(beatmapid)
         except Exception as e:
             return await  itr.response.send_message(f"{e}", ephemeral=True)
         
         ranked = discord.utils.format_dt(rbeatmap.ranked_date, style = "R") if rbeatmap.ranked_date else "Not ranked!"
         updated = discord.utils.format_dt(rbeatmap.last_updated, style = "R") if rbeatmap.last_updated else "Has not been updated"
         submitted = discord.utils.format_dt(rbeatmap.submitted_date, style = "R") if rbeatmap.submitted_date else "Not Submitted!"
-        creator = await self.bot.osu.fetch_user(rbeatmap.creator)
+        creator = await self.fetch_user(rbeatmap.creator)
 
 
         embed = discord.Embed(title=f"Info on {rbeatmap.title}", color=0x2F3136)
@@ -144,29 +264,23 @@ class osu(commands.Cog):
     @replay.command(description="Allows control on replay settings")
     @app_commands.describe(skin_id = "ID of a skin | https://ordr.issou.best/skins")
     async def config(self, itr: discord.Interaction, skin_id: int):
-        try: 
-            async with self.bot.session.get("https://apis.issou.best/ordr/skins", params={"pageSize": 400, "page":1}) as resp:
-                skins = (await resp.json())['skins']
-                self.bot.logger.info((await resp.json())['maxSkins'])
-
-            query = """
-                INSERT INTO replay_config (skin_id, user_id) VALUES($1, $2)
-                ON CONFLICT(user_id) DO 
-                UPDATE SET skin_id = excluded.skin_id
-                RETURNING skin_id
-            """
-            
-            await self.bot.pool.execute(query, skin_id, itr.user.id)
-            skin_info = {skin['id']:{'preview': skin['highResPreview'], 'skin':skin['skin'], 'download': skin['url'], "author": skin['author']} for skin in skins}
-            try:
-                skin = skin_info[skin_id]
-            except KeyError:
+        try:
+            # Discord only waits 3 seconds for the response, so don't wait out a slow first skin load.
+            await asyncio.wait_for(self.skins.wait_until_ready(), timeout=2.5)
+        except asyncio.TimeoutError:
+            return await itr.response.send_message("The skin list is still loading, try again in a few seconds!", ephemeral=True)
+
+        try:
+            skin = self.skins.get(skin_id)
+            if skin is None:
                 return await itr.response.send_message("That skin is not accessable or for some reason the ordr api did not give us it, Sorry!", ephemeral=True)
 
+            await self.bot.settings.set_skin_id(itr.user.id, skin_id)
+
             embed = discord.Embed(title=f"Succesfully made replay skin to {skin['skin']}!")
-            embed.add_field(name='Download link', value=f"[Click here to download]({skin['download']})")
+            embed.add_field(name='Download link', value=f"[Click here to download]({skin['url']})")
             embed.add_field(name="Author", value=skin['author'])
-            embed.set_image(url=skin['preview'])
+            embed.set_image(url=skin['highResPreview'])
 
             return await itr.response.send_message(embed=embed)
 
@@ -175,66 +289,58 @@ class osu(commands.Cog):
 
     @config.autocomplete('skin_id')
     async def id(self, itr: discord.Interaction, current: str):
-        if current in self.cached_skins:
-            if current == '':
-                return self.cached_skins
-            
-            return self.cached_skins[current]
-
-        async with self.bot.session.get("https://apis.issou.best/ordr/skins", params={"pageSize": 400, "page":1}) as resp:
-            skins = (await resp.json())['skins']
-
-        if current == '':
-            return [app_commands.Choice(name=skin['skin'], value=skin['id']) for skin in skins[:25]]
-
-        self.cached_skins[current] = [app_commands.Choice(name=skin['skin'], value=skin['id']) for skin in skins]
-         
-        return [app_commands.Choice(name=skin['skin'], value=skin['id']) for skin in skins if skin['id'] is int(current)]
+        return [app_commands.Choice(name=skin['skin'][:100], value=skin['id']) for skin in self.skins.search(current)]
 
     @replay.command()
     async def upload(self, itr: discord.Interaction, file: discord.Attachment):
-        skin = await self.bot.pool.fetchval("SELECT skin_id FROM replay_config WHERE user_id = $1", itr.user.id) or 1
-
-        async with self.bot.session.post("https://apis.issou.best/ordr/renders", data={"replayURL": file.url, "username":"Aswo", "resolution":"1280x720", "skin": skin,"verificationKey":self.bot.replay_key}) as resp:
-            ordr_json = await resp.json()
-            logger.info(ordr_json)
-                
-        if ordr_json['errorCode'] in error_codes:
-            return await itr.response.send_message(error_codes.get(ordr_json['errorCode']))
-            
-        mes = await itr.response.send_message("Osu replay file detected, a rendered replay will be sent shortly! May take a bit so relax :D!\nIll ping you when its finished!")
-        render_id = ordr_json['renderID']
+        # Checking the replay downloads and parses it, which can take longer than Discord waits for a response.
+        await itr.response.defer()
+        skin = (await self.bot.settings.get(itr.user.id)).skin_id or 1
 
-        @self.sio.event
-        async def render_done_json(data):
-            if data['renderID'] == render_id:
-                data = data
-                self.bot.logger.info(data)
-                await itr.edit_original_response(content=f"Here's your rendered video {itr.user.mention}!\n{data['videoUrl']}")
+        try:
+            key, job = await self.prepare_render(file, skin)
+        except InvalidReplay as e:
+            return await itr.followup.send(error_codes.get(e.error_code, str(e)))
 
-        await self.sio.wait()
+        if job is not None:
+            return await itr.followup.send(f"Here's your rendered video {itr.user.mention}!\n{job.video_url}")
+            
+        message = await itr.followup.send("Osu replay file detected, a rendered replay will be sent shortly! May take a bit so relax :D!\nIll ping you when its finished!", wait=True)
+        await self.queue_render(file, key, skin, user_id=itr.user.id, guild_id=itr.guild_id, message=message)
 
 
+    @replay.command()
+    # guild_only and default_permissions only work on top level commands and groups, not on these subcommands.
+    @app_commands.checks.has_permissions(manage_guild=True)
+    @app_commands.describe(enabled="Whether replays posted in this server get rendered automatically")
+    async def autorender(self, itr: discord.Interaction, enabled: bool):
+        """Turns automatic rendering of posted .osr files on or off for this server"""
+        if itr.guild_id is None:
+            return await itr.response.send_message("This can only be turned on or off in a server!", ephemeral=True)
+
+        query = """
+            INSERT INTO auto_render (guild_id, enabled) VALUES($1, $2)
+            ON CONFLICT(guild_id) DO 
+            UPDATE SET enabled = excluded.enabled
+        """
+        await self.bot.pool.execute(query, itr.guild_id, enabled)
+
+        if enabled:
+            self.bot.render_disabled.discard(itr.guild_id)
+        else:
+            self.bot.render_disabled.add(itr.guild_id)
+
+        await itr.response.send_message(f"Automatic replay rendering is now {'on' if enabled else 'off'} for this server!")
+
     @app_commands.command()
     async def set_user(self, interaction: discord.Interaction, username: str): 
         """Allows you to set your username""" 
         try:
-            query = """
-                INSERT INTO osu_user (osu_username, user_id) VALUES($1, $2)
-                ON CONFLICT(user_id) DO 
-                UPDATE SET osu_username = excluded.osu_username
-            """
-
-            await self.bot.pool.execute(query, username, interaction.user.id)
+            await self.bot.settings.set_osu_username(interaction.user.id, username)
 
             await interaction.response.send_message(f"Sucessfullly set your osu username to: {username}")
         except Exception as e:
             return await interaction.response.send_message(f"Oh No! an error occured!\n\nError Class: **{e.__class__.__name__}**\n{default.traceback_maker(err=e)}If you're a coder and you think this is a fatal error, DM Sawsha#0598!", ephemeral=True)
 
 async def setup(bot: Aswo):
-    await bot.add_cog(osu(bot))	
-
-async def teardown(bot: Aswo):
-    cog = osu(bot)
-    await cog.sio.disconnect()
-    logger.info("Osu cog has been teardowned! sio disconnected")
+    await bot.add_cog(osu(bot))
@@ -14,13 +14,7 @@ class testinng(commands.Cog):
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
     async def setprefix(self, ctx: Context, prefix: str):
-        query = """
-            INSERT INTO prefix (guild_id, prefix) VALUES($1, $2)
-            ON CONFLICT(guild_id) DO 
-            UPDATE SET prefix = excluded.prefix
-        """
-        await self.bot.pool.execute(query, ctx.guild.id, prefix)
-        self.bot.prefixes[ctx.guild.id] = prefix
+        await self.bot.set_prefix(ctx.guild.id, prefix)
         await ctx.send(f'Succesfully made the guild prefix: ``{prefix.replace("/""/", "")}``')
 
     @commands.command()
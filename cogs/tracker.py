@@ -0,0 +1,171 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+import discord
+from discord import app_commands
+from discord.ext import commands, tasks
+import config
+from bot import Aswo
+from utils import Priority, StoredScore, SyncResult, TrackSchedule, current_priority
+
+logger = logging.getLogger(__name__)
+
+
+class tracker(commands.Cog):
+    """Polls the recent plays of linked users who opted in and posts new ones to the guild's tracking channel"""
+    track = app_commands.Group(name="track", description="Posts your new osu! plays to this server's tracking channel", guild_only=True)
+
+    def __init__(self, bot: Aswo):
+        self.bot = bot
+        # TRACKER is a dict of utils.TrackSchedule kwargs, e.g. {"budget": 60, "max_interval": 3600}
+        self.schedule = TrackSchedule(**getattr(config, "TRACKER", {}))
+        self.channels: Dict[int, int] = {}
+        self.targets: Dict[int, Set[Tuple[int, int]]] = {}
+        self._primed: Set[int] = set()
+
+    async def cog_load(self):
+        for row in await self.bot.pool.fetch("SELECT guild_id, channel_id FROM tracking_channel"):
+            self.channels[row['guild_id']] = row['channel_id']
+
+        for row in await self.bot.pool.fetch("SELECT guild_id, user_id, osu_user_id FROM tracked_user"):
+            if self._owns(row['guild_id']):
+                self._add_target(row['osu_user_id'], row['guild_id'], row['user_id'], interval=self.schedule.max_interval)
+
+        logger.info(f"Tracking {len(self.schedule)} osu! users")
+        self.poller.start()
+
+    async def cog_unload(self):
+        self.poller.cancel()
+
+    def _owns(self, guild_id: int) -> bool:
+        # Clusters only track the guilds on their own shards.
+        if self.bot.shard_ids is None or self.bot.shard_count is None:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in self.bot.shard_ids
+
+    def _add_target(self, osu_user_id: int, guild_id: int, user_id: int, *, interval: Optional[float] = None):
+        self.targets.setdefault(osu_user_id, set()).add((guild_id, user_id))
+        self.schedule.add(osu_user_id, interval=interval)
+
+    def _remove_target(self, guild_id: int, user_id: int):
+        for osu_user_id, targets in list(self.targets.items()):
+            targets.discard((guild_id, user_id))
+            if not targets:
+                del self.targets[osu_user_id]
+                self.schedule.remove(osu_user_id)
+
+    @tasks.loop(seconds=5)
+    async def poller(self):
+        current_priority.set(Priority.BACKGROUND)
+        users = self.schedule.due()
+        if not users:
+            return
+
+        # Only the tracker's own syncs count, /recent fetching at the same time doesn't come out of its budget.
+        requests = await asyncio.gather(*(self.poll(osu_user_id) for osu_user_id in users))
+        self.schedule.charge(sum(max(n - 1, 0) for n in requests))
+
+    @poller.before_loop
+    async def before_poller(self):
+        await self.bot.wait_until_ready()
+
+    async def poll(self, osu_user_id: int) -> int:
+        """Posts ``osu_user_id``'s new plays and returns how many osu! requests that took."""
+        result = SyncResult(0, 0)
+        try:
+            # The first sync imports history, none of that is new to anyone.
+            primed = osu_user_id in self._primed or await self.bot.scores.cursor(osu_user_id) is not None
+            result = await self.bot.scores.sync(osu_user_id, force=True)
+            self._primed.add(osu_user_id)
+
+            if primed and result.new:
+                plays = await self.bot.scores.recent(osu_user_id, limit=result.new, passed_only=True)
+                await self.post(osu_user_id, plays[:3])
+        except Exception as e:
+            logger.warning(f"Tracking osu! user {osu_user_id} failed: {e}")
+        finally:
+            self.schedule.done(osu_user_id, result.new)
+        return result.requests
+
+    async def post(self, osu_user_id: int, plays: List[StoredScore]):
+        if not plays:
+            return
+
+        embeds = [self.play_embed(score) for score in plays]
+        # A copy, since /track enable and disable can change the targets while we wait on a send.
+        for guild_id, user_id in list(self.targets.get(osu_user_id, ())):
+            channel = self.bot.get_channel(self.channels.get(guild_id))
+            if channel is None:
+                continue
+
+            try:
+                await channel.send(f"New play from <@{user_id}>!", embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+            except discord.HTTPException as e:
+                logger.warning(f"Could not post osu! user {osu_user_id}'s plays in guild {guild_id}: {e}")
+
+    @staticmethod
+    def play_embed(score: StoredScore) -> discord.Embed:
+        embed = discord.Embed(
+            title=f"{score.artist} - {score.title} [{score.version}]",
+            url=f"https://osu.ppy.sh/b/{score.beatmap_id}",
+            description=(
+                f"▹ **{score.rank}** | {score.accuracy * 100:,.2f}% | {score.pp or 0:,.0f}pp\n"
+                f"▹ {score.score:,} | x{score.max_combo:,} | {'+' + ''.join(score.mods) if score.mods else 'NM'}"
+            ),
+            timestamp=score.created_at,
+            color=0x2F3136,
+        )
+        return embed
+
+    @track.command()
+    # default_permissions is ignored on subcommands, only the group's guild_only applies.
+    @app_commands.checks.has_permissions(manage_guild=True)
+    @app_commands.describe(channel="Where new plays get posted")
+    async def channel(self, interaction: discord.Interaction, channel: discord.TextChannel):
+        """Sets the channel tracked plays are posted to"""
+        query = """
+            INSERT INTO tracking_channel (guild_id, channel_id) VALUES($1, $2)
+            ON CONFLICT(guild_id) DO
+            UPDATE SET channel_id = excluded.channel_id
+        """
+        await self.bot.pool.execute(query, interaction.guild_id, channel.id)
+        self.channels[interaction.guild_id] = channel.id
+        await interaction.response.send_message(f"New plays will be posted in {channel.mention}!", ephemeral=True)
+
+    @track.command()
+    async def enable(self, interaction: discord.Interaction):
+        """Posts your new plays to this server's tracking channel"""
+        osu_username = (await self.bot.settings.get(interaction.user.id)).osu_username
+        if osu_username is None:
+            return await interaction.response.send_message("Link your osu! account with /set_user first!", ephemeral=True)
+
+        try:
+            user = await self.bot.osu.fetch_user(osu_username)
+        except Exception as e:
+            return await interaction.response.send_message(f"{e}", ephemeral=True)
+
+        query = """
+            INSERT INTO tracked_user (guild_id, user_id, osu_user_id) VALUES($1, $2, $3)
+            ON CONFLICT(guild_id, user_id) DO
+            UPDATE SET osu_user_id = excluded.osu_user_id
+        """
+        await self.bot.pool.execute(query, interaction.guild_id, interaction.user.id, user.id)
+        self._remove_target(interaction.guild_id, interaction.user.id)
+        self._add_target(user.id, interaction.guild_id, interaction.user.id)
+
+        message = f"Now tracking {user.username}!"
+        if interaction.guild_id not in self.channels:
+            message += " Nothing will be posted until someone with Manage Server runs /track channel though."
+        await interaction.response.send_message(message, ephemeral=True)
+
+    @track.command()
+    async def disable(self, interaction: discord.Interaction):
+        """Stops posting your plays in this server"""
+        await self.bot.pool.execute("DELETE FROM tracked_user WHERE guild_id = $1 AND user_id = $2", interaction.guild_id, interaction.user.id)
+        self._remove_target(interaction.guild_id, interaction.user.id)
+        await interaction.response.send_message("Your plays won't be posted here anymore.", ephemeral=True)
+
+
+async def setup(bot: Aswo):
+    await bot.add_cog(tracker(bot))
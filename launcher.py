@@ -1,16 +1,34 @@
 from bot import Aswo
 import asyncio
 import discord
-import aiohttp
 import config
-import osu
 import os
 import asyncpg
+import utils
+from utils.old_osu import Osu
 
 discord.utils.setup_logging()
 
-async def main():
-    async with aiohttp.ClientSession() as session, asyncpg.create_pool(config.POSTGRES_URI) as pool, osu.Client(client_id=config.OSU_CLIENT_ID, client_secret=config.OSU_CLIENT_SECRET) as osu_client,Aswo(session=session, osu=osu_client,pool=pool ) as bot:
+async def main(*, cluster_id: int = None, shard_ids: list = None, shard_count: int = None, health = None):
+    # HTTP_POOLS maps "default", "osu" and "ordr" to utils.PoolConfig fields, e.g. {"osu": {"limit_per_host": 10}}
+    pools = utils.HTTPPools(getattr(config, "HTTP_POOLS", None))
+    # Every cluster builds its pool from the same POSTGRES_POOL kwargs, e.g. {"min_size": 2, "max_size": 10}
+    pool_config = getattr(config, "POSTGRES_POOL", {})
+    # CACHE_MODE is "full" (members, presences, chunking) or "lean", CACHE_OPTIONS overrides single utils.CacheProfile fields
+    cache_mode = getattr(config, "CACHE_MODE", "full")
+    cache_options = getattr(config, "CACHE_OPTIONS", None)
+    # METRICS is {"host": ..., "port": ...} for the Prometheus endpoint, every cluster listens on port + cluster_id. Leave it out to turn it off
+    metrics_config = getattr(config, "METRICS", None)
+    async with pools, asyncpg.create_pool(config.POSTGRES_URI, init=utils.instrument_connection, **pool_config) as pool,Aswo(pools=pools, osu=Osu(client_id=config.OSU_CLIENT_ID, client_secret=config.OSU_CLIENT_SECRET, session=pools.session("osu")), pool=pool, shard_ids=shard_ids, shard_count=shard_count, cache_mode=cache_mode, cache_options=cache_options) as bot:
+        if health is not None:
+            bot.cluster = utils.ClusterReporter(bot, cluster_id=cluster_id, queue=health)
+            bot.cluster.start()
+
+        if metrics_config is not None:
+            port = metrics_config.get("port", 9100) + (cluster_id or 0)
+            bot.metrics_server = utils.MetricsServer(host=metrics_config.get("host", "127.0.0.1"), port=port)
+            await bot.metrics_server.start()
+
         await bot.load_extension("jishaku")
         exts = [
             f"cogs.{ext if not ext.endswith('.py') else ext[:-3]}"
@@ -22,6 +40,15 @@ async def main():
         
         await bot.start(config.TOKEN, reconnect=True)
 
-    
 
-asyncio.run(main())
+def run_cluster(**kwargs):
+    asyncio.run(main(**kwargs))
+
+
+if __name__ == "__main__":
+    clusters = getattr(config, "CLUSTERS", 1)
+    if clusters <= 1:
+        asyncio.run(main())
+    else:
+        shard_count = getattr(config, "SHARD_COUNT", None) or asyncio.run(utils.recommended_shards(config.TOKEN))
+        utils.ClusterSupervisor(run_cluster, shard_count=shard_count, clusters=clusters).run()
\ No newline at end of file
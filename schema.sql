@@ -14,3 +14,139 @@ CREATE TABLE replay_config (
    	user_id BIGINT PRIMARY KEY,
     skin_id INT
 );
+
+CREATE TABLE auto_render (
+    guild_id BIGINT PRIMARY KEY,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+CREATE TABLE osu_beatmap_ref (
+    beatmap_id BIGINT PRIMARY KEY,
+    beatmapset_id BIGINT NOT NULL,
+    artist TEXT NOT NULL,
+    title TEXT NOT NULL,
+    version TEXT NOT NULL,
+    creator TEXT,
+    mode TEXT NOT NULL,
+    status TEXT,
+    difficulty_rating REAL
+);
+
+CREATE TABLE osu_score (
+    score_id BIGINT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    beatmap_id BIGINT NOT NULL REFERENCES osu_beatmap_ref (beatmap_id),
+    mode TEXT NOT NULL,
+    score BIGINT NOT NULL,
+    pp REAL,
+    accuracy REAL NOT NULL,
+    max_combo INT NOT NULL,
+    rank TEXT NOT NULL,
+    mods TEXT[] NOT NULL DEFAULT '{}',
+    passed BOOLEAN NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL
+);
+
+-- recent plays, top plays and per map comparisons
+CREATE INDEX osu_score_user_created_idx ON osu_score (user_id, created_at DESC);
+CREATE INDEX osu_score_user_pp_idx ON osu_score (user_id, pp DESC) WHERE passed;
+CREATE INDEX osu_score_beatmap_idx ON osu_score (beatmap_id, user_id, score DESC) WHERE passed;
+
+CREATE TABLE osu_score_cursor (
+    user_id BIGINT PRIMARY KEY,
+    last_created_at TIMESTAMPTZ,
+    last_score_id BIGINT,
+    synced_at TIMESTAMPTZ,
+    best_synced_at TIMESTAMPTZ
+);
+
+CREATE TABLE tracking_channel (
+    guild_id BIGINT PRIMARY KEY,
+    channel_id BIGINT NOT NULL
+);
+
+CREATE TABLE tracked_user (
+    guild_id BIGINT,
+    user_id BIGINT,
+    osu_user_id BIGINT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+CREATE TABLE beatmapsets (
+    beatmapset_id BIGINT PRIMARY KEY,
+    artist TEXT NOT NULL,
+    title TEXT NOT NULL,
+    creator TEXT NOT NULL,
+    user_id BIGINT,
+    status TEXT NOT NULL,
+    nsfw BOOLEAN NOT NULL DEFAULT FALSE,
+    favourite_count INT,
+    play_count BIGINT,
+    ranked_date TIMESTAMPTZ,
+    submitted_date TIMESTAMPTZ,
+    covers JSONB NOT NULL DEFAULT '{}',
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE beatmaps (
+    beatmap_id BIGINT PRIMARY KEY,
+    beatmapset_id BIGINT NOT NULL REFERENCES beatmapsets (beatmapset_id),
+    version TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL,
+    difficulty_rating REAL,
+    cs REAL,
+    ar REAL,
+    accuracy REAL,
+    drain REAL,
+    bpm REAL,
+    total_length INT,
+    hit_length INT,
+    max_combo INT,
+    passcount BIGINT,
+    playcount BIGINT,
+    checksum TEXT,
+    url TEXT,
+    last_updated TIMESTAMPTZ,
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX beatmaps_beatmapset_idx ON beatmaps (beatmapset_id);
+CREATE INDEX beatmaps_checksum_idx ON beatmaps (checksum);
+-- only maps that can still change are ever refreshed
+CREATE INDEX beatmaps_refresh_idx ON beatmaps (status, fetched_at) WHERE status NOT IN ('ranked', 'approved', 'loved');
+
+CREATE TABLE render_cache (
+    replay_hash TEXT,
+    skin_id INT,
+    render_id BIGINT NOT NULL,
+    video_url TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (replay_hash, skin_id)
+);
+
+CREATE INDEX render_cache_render_idx ON render_cache (render_id);
+
+CREATE TABLE render_job (
+    job_id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    guild_id BIGINT,
+    channel_id BIGINT NOT NULL,
+    message_id BIGINT,
+    replay_url TEXT NOT NULL,
+    replay_hash TEXT,
+    skin_id INT NOT NULL,
+    -- queued, rendering, done or failed
+    status TEXT NOT NULL DEFAULT 'queued',
+    render_id BIGINT,
+    video_url TEXT,
+    error_code INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    submitted_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+
+-- only unfinished jobs are read back, on startup
+CREATE INDEX render_job_open_idx ON render_job (job_id) WHERE status IN ('queued', 'rendering');
+-- finished jobs are pruned after a while
+CREATE INDEX render_job_finished_idx ON render_job (finished_at) WHERE status IN ('done', 'failed');
@@ -2,4 +2,18 @@ from .subclasses import *
 from .default import *
 from .osu_errors import *
 from .constants import *
-from .helpers import *
\ No newline at end of file
+from .helpers import *
+from .http import *
+from .ordr import *
+from .ratelimit import *
+from .cache import *
+from .settings import *
+from .cluster import *
+from .cachemode import *
+from .scores import *
+from .tracker import *
+from .beatmaps import *
+from .osr import *
+from .renderqueue import *
+from .edits import *
+from .metrics import *
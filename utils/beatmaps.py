@@ -0,0 +1,254 @@
+from __future__ import annotations
+import asyncio
+import datetime
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from asyncpg import Pool, Record
+from . import old_osu
+from .ratelimit import Priority, current_priority
+
+logger = logging.getLogger(__name__)
+
+# The most maps osu!'s /beatmaps endpoint returns per request.
+BATCH_SIZE = 50
+
+# How long a map that can still change is served from the mirror before it's fetched again.
+# Ranked, approved and loved maps are never refreshed.
+REFRESH_INTERVALS: Dict[str, datetime.timedelta] = {
+    "qualified": datetime.timedelta(hours=1),
+    "pending": datetime.timedelta(hours=6),
+    "wip": datetime.timedelta(hours=6),
+    "graveyard": datetime.timedelta(days=7),
+}
+
+
+def _date(value: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+
+
+def _iso(value: Optional[datetime.datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _status(value: Any) -> str:
+    return str(getattr(value, "name", value)).lower()
+
+
+def _beatmapset_row(data: dict) -> Tuple:
+    return (
+        data['id'],
+        data['artist'],
+        data['title'],
+        data['creator'],
+        data.get('user_id'),
+        _status(data['status']),
+        data.get('nsfw', False),
+        data.get('favourite_count'),
+        data.get('play_count'),
+        _date(data.get('ranked_date')),
+        _date(data.get('submitted_date')),
+        json.dumps(data.get('covers') or {}),
+    )
+
+
+def _beatmap_row(data: dict) -> Tuple:
+    return (
+        data['id'],
+        data['beatmapset_id'],
+        data['version'],
+        data['mode'],
+        _status(data['status']),
+        data.get('difficulty_rating'),
+        data.get('cs'),
+        data.get('ar'),
+        data.get('accuracy'),
+        data.get('drain'),
+        data.get('bpm'),
+        data.get('total_length'),
+        data.get('hit_length'),
+        data.get('max_combo'),
+        data.get('passcount'),
+        data.get('playcount'),
+        data.get('checksum'),
+        data.get('url'),
+        _date(data.get('last_updated')),
+    )
+
+
+def beatmap_from_row(record: Record) -> old_osu.Beatmap:
+    """Builds a :class:`old_osu.Beatmap` from a ``beatmaps`` row joined with its ``beatmapsets`` row."""
+    return old_osu.Beatmap({
+        "id": record['beatmap_id'],
+        "beatmapset_id": record['beatmapset_id'],
+        "version": record['version'],
+        "mode": record['mode'],
+        "status": record['status'],
+        "difficulty_rating": record['difficulty_rating'],
+        "cs": record['cs'],
+        "ar": record['ar'],
+        "accuracy": record['accuracy'],
+        "drain": record['drain'],
+        "bpm": record['bpm'],
+        "total_length": record['total_length'],
+        "hit_length": record['hit_length'],
+        "max_combo": record['max_combo'],
+        "passcount": record['passcount'],
+        "playcount": record['playcount'],
+        "checksum": record['checksum'],
+        "url": record['url'],
+        "last_updated": _iso(record['last_updated']),
+        "beatmapset": {
+            "id": record['beatmapset_id'],
+            "artist": record['artist'],
+            "title": record['title'],
+            "creator": record['creator'],
+            "user_id": record['user_id'],
+            "status": record['set_status'],
+            "nsfw": record['nsfw'],
+            "favourite_count": record['favourite_count'],
+            "play_count": record['set_play_count'],
+            "ranked_date": _iso(record['ranked_date']),
+            "submitted_date": _iso(record['submitted_date']),
+            "covers": json.loads(record['covers']),
+        },
+    })
+
+
+BEATMAP_QUERY = """
+    SELECT b.*, s.artist, s.title, s.creator, s.user_id, s.status AS set_status, s.nsfw, s.favourite_count,
+           s.play_count AS set_play_count, s.ranked_date, s.submitted_date, s.covers
+    FROM beatmaps b JOIN beatmapsets s USING (beatmapset_id)
+"""
+
+
+class BeatmapMirror:
+    """Mirrors beatmap and beatmapset metadata into Postgres.
+
+    Maps are fetched from the API the first time someone asks for them and served
+    from the database after that. Ranked, approved and loved maps can't change so
+    they're never fetched again. Everything else is refreshed in the background once
+    it's older than its :data:`REFRESH_INTERVALS` entry.
+    """
+    def __init__(self, pool: Pool, *, osu: Any, refresh_every: float = 300.0, refresh_batch: int = 50):
+        self.pool = pool
+        self.osu = osu
+        self.refresh_every = refresh_every
+        self.refresh_batch = refresh_batch
+        self.hits = 0
+        self.misses = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def get(self, beatmap_id: int) -> Any:
+        """Returns the map from the mirror, fetching and storing it first if it isn't there yet."""
+        record = await self.pool.fetchrow(f"{BEATMAP_QUERY} WHERE b.beatmap_id = $1", beatmap_id)
+        if record is not None:
+            self.hits += 1
+            return beatmap_from_row(record)
+
+        self.misses += 1
+        return await self.fetch(beatmap_id)
+
+    async def get_by_checksum(self, checksum: str) -> Optional[old_osu.Beatmap]:
+        record = await self.pool.fetchrow(f"{BEATMAP_QUERY} WHERE b.checksum = $1", checksum)
+        return beatmap_from_row(record) if record is not None else None
+
+    async def fetch(self, beatmap_id: int) -> Any:
+        beatmap = await self.osu.fetch_beatmap(beatmap_id)
+        await self.store([beatmap.data])
+        return beatmap
+
+    async def store(self, payloads: Iterable[dict]):
+        """Upserts full beatmap payloads (with ``beatmapset``) into the mirror."""
+        payloads = list(payloads)
+        if not payloads:
+            return
+
+        sets = {data['beatmapset']['id']: _beatmapset_row(data['beatmapset']) for data in payloads}
+        maps = {data['id']: _beatmap_row(data) for data in payloads}
+
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.executemany("""
+                INSERT INTO beatmapsets (beatmapset_id, artist, title, creator, user_id, status, nsfw, favourite_count,
+                                         play_count, ranked_date, submitted_date, covers)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12::JSONB)
+                ON CONFLICT (beatmapset_id) DO
+                UPDATE SET artist = excluded.artist, title = excluded.title, creator = excluded.creator, status = excluded.status,
+                           nsfw = excluded.nsfw, favourite_count = excluded.favourite_count, play_count = excluded.play_count,
+                           ranked_date = excluded.ranked_date, covers = excluded.covers, fetched_at = now()
+            """, list(sets.values()))
+            await conn.executemany("""
+                INSERT INTO beatmaps (beatmap_id, beatmapset_id, version, mode, status, difficulty_rating, cs, ar, accuracy,
+                                      drain, bpm, total_length, hit_length, max_combo, passcount, playcount, checksum, url, last_updated)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
+                ON CONFLICT (beatmap_id) DO
+                UPDATE SET version = excluded.version, status = excluded.status, difficulty_rating = excluded.difficulty_rating,
+                           cs = excluded.cs, ar = excluded.ar, accuracy = excluded.accuracy, drain = excluded.drain,
+                           bpm = excluded.bpm, total_length = excluded.total_length, hit_length = excluded.hit_length,
+                           max_combo = excluded.max_combo, passcount = excluded.passcount, playcount = excluded.playcount,
+                           checksum = excluded.checksum, last_updated = excluded.last_updated, fetched_at = now()
+            """, list(maps.values()))
+
+    async def backfill(self, beatmap_ids: Iterable[int]) -> int:
+        """Fetches every map in ``beatmap_ids`` that isn't mirrored yet and returns how many were added."""
+        query = "SELECT id FROM unnest($1::BIGINT[]) AS u(id) WHERE NOT EXISTS (SELECT 1 FROM beatmaps WHERE beatmap_id = u.id)"
+        missing = [row['id'] for row in await self.pool.fetch(query, list(set(beatmap_ids)))]
+        token = current_priority.set(Priority.BACKGROUND)
+        try:
+            return await self._fetch_many(missing)
+        finally:
+            current_priority.reset(token)
+
+    async def _fetch_many(self, beatmap_ids: List[int]) -> int:
+        fetched = 0
+        for start in range(0, len(beatmap_ids), BATCH_SIZE):
+            chunk = beatmap_ids[start:start + BATCH_SIZE]
+            # Asked for together, the client's batch loader turns the whole chunk into one /beatmaps request.
+            results = await asyncio.gather(*(self.osu.fetch_beatmap(beatmap_id) for beatmap_id in chunk), return_exceptions=True)
+
+            payloads = []
+            for beatmap_id, result in zip(chunk, results):
+                if isinstance(result, BaseException):
+                    logger.warning(f"Could not mirror beatmap {beatmap_id}: {result}")
+                else:
+                    payloads.append(result.data)
+
+            await self.store(payloads)
+            fetched += len(payloads)
+        return fetched
+
+    async def refresh_due(self) -> int:
+        """Refetches up to ``refresh_batch`` maps that are past their refresh interval, oldest first."""
+        statuses, intervals = zip(*REFRESH_INTERVALS.items())
+        query = """
+            SELECT b.beatmap_id FROM beatmaps b
+            JOIN unnest($1::TEXT[], $2::INTERVAL[]) AS r(status, every) ON r.status = b.status
+            WHERE b.fetched_at < now() - r.every
+            ORDER BY b.fetched_at
+            LIMIT $3
+        """
+        due = [row['beatmap_id'] for row in await self.pool.fetch(query, list(statuses), list(intervals), self.refresh_batch)]
+        return await self._fetch_many(due)
+
+    async def _refresh_loop(self):
+        current_priority.set(Priority.BACKGROUND)
+        while True:
+            try:
+                refreshed = await self.refresh_due()
+                if refreshed:
+                    logger.info(f"Refreshed {refreshed} mirrored beatmaps")
+            except Exception as e:
+                logger.warning(f"Refreshing mirrored beatmaps failed: {e}")
+
+            await asyncio.sleep(self.refresh_every)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
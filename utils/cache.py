@@ -0,0 +1,370 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
+
+from .ratelimit import Priority, current_priority
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+MISSING: Any = object()
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded mapping that throws away the least recently used key once full.
+
+    ``None`` is a valid value, use :data:`MISSING` to tell a miss apart from it.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: K, default: Any = MISSING) -> Optional[V]:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: K, default: Any = MISSING) -> Optional[V]:
+        """Same as :meth:`get` but doesn't touch the LRU order or the counters."""
+        return self._data.get(key, default)
+
+    def set(self, key: K, value: V):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K, default: Any = None) -> Optional[V]:
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one in-flight call.
+
+    Every caller gets the same result or exception. A caller being cancelled
+    doesn't cancel the shared call for everyone else.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fetch: Callable[[], Awaitable[V]]) -> V:
+        future = self._inflight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fetch())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+        _retrieve(future)
+
+
+class BatchLoader(Generic[K, V]):
+    """Collects single key loads made close together and fetches them in batches.
+
+    Keys asked for within ``window`` seconds of the first one (or on the same loop
+    iteration when it's 0) are handed to ``load_many`` together, at most
+    ``max_batch`` at a time, and every caller gets its own value back. Keys that
+    ``load_many`` doesn't return raise whatever ``missing`` builds for them.
+    """
+    def __init__(
+        self,
+        load_many: Callable[[List[K]], Awaitable[Dict[K, V]]],
+        *,
+        max_batch: int = 50,
+        window: float = 0.0,
+        missing: Callable[[K], Exception] = KeyError
+    ):
+        self.load_many = load_many
+        self.max_batch = max_batch
+        self.window = window
+        self.missing = missing
+        self.batches = 0
+        self.loads = 0
+        self._pending: Dict[K, asyncio.Future[V]] = {}
+        self._handle: Optional[asyncio.Handle] = None
+
+    async def load(self, key: K) -> V:
+        self.loads += 1
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(_retrieve)
+            self._pending[key] = future
+
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._handle is None:
+                loop = asyncio.get_running_loop()
+                self._handle = loop.call_later(self.window, self._dispatch) if self.window else loop.call_soon(self._dispatch)
+
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        pending, self._pending = list(self._pending.items()), {}
+        for index in range(0, len(pending), self.max_batch):
+            asyncio.create_task(self._run(dict(pending[index:index + self.max_batch])))
+
+    async def _run(self, batch: Dict[K, asyncio.Future[V]]):
+        self.batches += 1
+        try:
+            results = await self.load_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in batch.items():
+            if future.done():
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(self.missing(key))
+
+
+def _retrieve(future: asyncio.Future):
+    # Marks the exception as retrieved, callers that are still around get it through shield.
+    if not future.cancelled():
+        future.exception()
+
+
+def freeze(value: Any) -> Hashable:
+    """Turns request params into something hashable so they can be used as a key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class CachePolicy(NamedTuple):
+    ttl: float
+    """Seconds a value is served without being refetched"""
+    stale: float
+    """Seconds after ``ttl`` that the old value is still served while it gets refetched"""
+    maxsize: int
+
+
+class _Entry:
+    __slots__ = ("value", "fresh_until", "stale_until")
+
+    def __init__(self, value: Any, ttl: float, stale: float):
+        now = time.monotonic()
+        self.value = value
+        self.fresh_until = now + ttl
+        self.stale_until = now + ttl + stale
+
+
+# Ranked, approved and loved maps can't change anymore, so they're kept for a week.
+LOCKED_BEATMAP_STATUSES = {"ranked", "approved", "loved"}
+LOCKED_BEATMAP_TTL = 7 * 24 * 60 * 60.0
+
+
+def beatmap_ttl(beatmap: Any) -> Optional[float]:
+    status = getattr(beatmap.status, "name", beatmap.status)
+    if str(status).lower() in LOCKED_BEATMAP_STATUSES:
+        return LOCKED_BEATMAP_TTL
+    return None
+
+
+class ResponseCache:
+    """Caches API models per resource kind with stale-while-revalidate.
+
+    Fresh values are returned as is. Once a value is past its ttl but still within
+    its stale window it's returned straight away and refetched in the background,
+    only one refetch per key runs at a time. Anything older is fetched inline.
+    """
+    DEFAULT_POLICIES: Dict[str, CachePolicy] = {
+        "user": CachePolicy(ttl=120.0, stale=600.0, maxsize=2000),
+        "user_beatmaps": CachePolicy(ttl=300.0, stale=900.0, maxsize=1000),
+        "beatmap": CachePolicy(ttl=600.0, stale=3600.0, maxsize=5000),
+    }
+
+    def __init__(self, policies: Optional[Dict[str, CachePolicy]] = None):
+        self.policies = {**self.DEFAULT_POLICIES, **(policies or {})}
+        self._caches: Dict[str, LRUCache[Hashable, _Entry]] = {
+            kind: LRUCache(policy.maxsize) for kind, policy in self.policies.items()
+        }
+        self._stats: Dict[str, Dict[str, int]] = {
+            kind: {"hits": 0, "stale_hits": 0, "misses": 0} for kind in self.policies
+        }
+        self._inflight = SingleFlight()
+
+    def __len__(self) -> int:
+        return sum(len(cache) for cache in self._caches.values())
+
+    async def get_or_fetch(
+        self,
+        kind: str,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[V]],
+        *,
+        ttl: Optional[Callable[[V], Optional[float]]] = None
+    ) -> V:
+        """Returns the cached value for ``key`` or awaits ``fetch`` to get it.
+
+        ``ttl`` can pick a per value ttl, returning ``None`` falls back to the policy.
+        """
+        stats = self._stats[kind]
+        entry = self._caches[kind].get(key)
+        now = time.monotonic()
+
+        if entry is not MISSING:
+            if now < entry.fresh_until:
+                stats["hits"] += 1
+                return entry.value
+            if now < entry.stale_until:
+                stats["stale_hits"] += 1
+                self._revalidate(kind, key, fetch, ttl)
+                return entry.value
+
+        stats["misses"] += 1
+        return await self._load(kind, key, fetch, ttl)
+
+    def set(self, kind: str, key: Hashable, value: Any, *, ttl: Optional[float] = None):
+        policy = self.policies[kind]
+        self._caches[kind].set(key, _Entry(value, ttl or policy.ttl, policy.stale))
+
+    def invalidate(self, kind: str, key: Hashable):
+        self._caches[kind].pop(key)
+
+    async def _load(self, kind: str, key: Hashable, fetch: Callable[[], Awaitable[V]], ttl: Optional[Callable[[V], Optional[float]]]) -> V:
+        async def load():
+            value = await fetch()
+            self.set(kind, key, value, ttl=ttl(value) if ttl else None)
+            return value
+
+        # Concurrent misses and revalidations for one key all share a single fetch.
+        return await self._inflight.do((kind, key), load)
+
+    def _revalidate(self, kind: str, key: Hashable, fetch: Callable[[], Awaitable[V]], ttl: Optional[Callable[[V], Optional[float]]]):
+        if (kind, key) in self._inflight:
+            return
+
+        async def runner():
+            current_priority.set(Priority.BACKGROUND)
+            try:
+                await self._load(kind, key, fetch, ttl)
+            except Exception as e:
+                logger.warning(f"Revalidating {kind} {key!r} failed, keeping the stale value: {e}")
+
+        asyncio.create_task(runner())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for kind, cache in self._caches.items():
+            counters = self._stats[kind]
+            total = sum(counters.values())
+            served = counters["hits"] + counters["stale_hits"]
+            stats[kind] = {"size": len(cache), **counters, "hit_rate": served / total if total else 0.0}
+
+        return stats
+
+
+class ViewRegistry:
+    """Holds the state behind persistent views, keyed by the IDs stored in their custom_id.
+
+    Views only carry compact keys, so whatever they show is looked up here and
+    ``hydrate`` is awaited on a miss, which is also how views from before a restart
+    come back. At most ``maxsize`` entries are kept and entries nobody has used
+    for ``idle`` seconds are dropped, so memory stays flat however many views exist.
+    """
+    def __init__(self, *, maxsize: int = 2000, idle: float = 1800.0):
+        self.idle = idle
+        self.hydrated = 0
+        self._entries: LRUCache[Hashable, Tuple[Any, float]] = LRUCache(maxsize)
+        self._inflight = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _sweep(self, now: float):
+        # The LRU order is also last use order, so idle entries are all at the front.
+        # This runs on every lookup, so only the entries it drops (and one more) are looked at.
+        while self._entries:
+            key = next(iter(self._entries))
+            if now - self._entries.peek(key)[1] < self.idle:
+                break
+            self._entries.pop(key)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        now = time.monotonic()
+        self._sweep(now)
+        entry = self._entries.get(key)
+        if entry is MISSING:
+            return default
+
+        self._entries.set(key, (entry[0], now))
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        self._sweep(now)
+        self._entries.set(key, (value, now))
+
+    async def get_or_hydrate(self, key: Hashable, hydrate: Callable[[], Awaitable[V]]) -> V:
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        async def load():
+            value = await hydrate()
+            self.hydrated += 1
+            self.set(key, value)
+            return value
+
+        return await self._inflight.do(key, load)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._entries), "hydrated": self.hydrated, "hit_rate": self._entries.hit_rate}
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import functools
+import operator
+from typing import Any, Dict, NamedTuple, Optional
+import discord
+
+# What each feature actually needs from the gateway. Lean mode enables the union of
+# these and nothing else, so add an entry here before relying on a new intent.
+FEATURE_INTENTS: Dict[str, discord.Intents] = {
+    # Slash commands, the replay group and the osu views only need guilds to resolve channels.
+    "slash_commands": discord.Intents(guilds=True),
+    # on_message reads attachments, which are part of the privileged message content.
+    "replay_detection": discord.Intents(guilds=True, guild_messages=True, message_content=True),
+    # >> prefixed commands (jishaku, setprefix, raw).
+    "prefix_commands": discord.Intents(guilds=True, guild_messages=True, dm_messages=True, message_content=True),
+}
+
+
+class CacheProfile(NamedTuple):
+    intents: discord.Intents
+    member_cache_flags: discord.MemberCacheFlags
+    chunk_guilds_at_startup: bool
+    max_messages: Optional[int]
+
+    def options(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+def full_intents() -> discord.Intents:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    intents.typing = False
+    intents.presences = True
+    return intents
+
+
+def cache_profile(mode: str = "full", **overrides: Any) -> CacheProfile:
+    """Builds the intents and cache settings for ``mode``.
+
+    ``full`` is how the bot has always run: members and presences with every guild
+    chunked at startup. ``lean`` only enables what :data:`FEATURE_INTENTS` asks for,
+    caches no members besides ourselves, never chunks and keeps no message cache.
+    Any :class:`CacheProfile` field can be overridden.
+    """
+    if mode == "full":
+        intents = full_intents()
+        profile = CacheProfile(
+            intents=intents,
+            member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+            chunk_guilds_at_startup=True,
+            max_messages=1000,
+        )
+    elif mode == "lean":
+        profile = CacheProfile(
+            intents=functools.reduce(operator.or_, FEATURE_INTENTS.values()),
+            member_cache_flags=discord.MemberCacheFlags.none(),
+            chunk_guilds_at_startup=False,
+            max_messages=None,
+        )
+    else:
+        raise ValueError(f"Unknown cache mode {mode!r}, pick full or lean")
+
+    return profile._replace(**overrides)
@@ -0,0 +1,194 @@
+from __future__ import annotations
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+import aiohttp
+
+if TYPE_CHECKING:
+    from bot import Aswo
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterHealth(NamedTuple):
+    cluster_id: int
+    pid: int
+    status: str
+    shard_ids: Tuple[int, ...]
+    guilds: int
+    latency: float
+    timestamp: float
+
+
+def shard_ranges(shard_count: int, clusters: int) -> List[List[int]]:
+    """Splits ``shard_count`` shards into ``clusters`` contiguous ranges of (almost) equal size"""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for cluster_id in range(clusters):
+        end = start + size + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shards(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}) as resp:
+            data = await resp.json()
+
+    logger.info(f"Discord recommends {data['shards']} shards, max identify concurrency {data['session_start_limit']['max_concurrency']}")
+    return data['shards']
+
+
+class ClusterReporter:
+    """Runs inside a cluster and sends its health to the parent process every ``interval`` seconds"""
+    def __init__(self, bot: Aswo, *, cluster_id: int, queue: multiprocessing.Queue, interval: float = 30.0):
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.queue = queue
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def send(self, status: str):
+        latencies = [latency for _, latency in self.bot.latencies if latency == latency]  # skips NaN
+        self.queue.put_nowait(ClusterHealth(
+            cluster_id=self.cluster_id,
+            pid=os.getpid(),
+            status=status,
+            shard_ids=tuple(self.bot.shard_ids or ()),
+            guilds=len(self.bot.guilds),
+            latency=sum(latencies) / len(latencies) if latencies else float("nan"),
+            timestamp=time.time(),
+        ))
+
+    async def _run(self):
+        self.send("starting")
+        await self.bot.wait_until_ready()
+        self.send("ready")
+
+        while True:
+            await asyncio.sleep(self.interval)
+            self.send("healthy" if not self.bot.is_closed() else "closed")
+
+
+class ClusterSupervisor:
+    """Starts one process per shard range and keeps them running.
+
+    Clusters are started one after another and each has to report ready before
+    the next begins, so only one process is identifying at any time and the
+    identify concurrency Discord gives us is never exceeded. Clusters that die
+    are started again after ``restart_delay`` seconds, doubling every time one
+    dies again up to ``max_restart_delay``, so a cluster that crashes on start
+    doesn't hammer the gateway. A cluster that ran for ``healthy_after`` seconds
+    starts over at ``restart_delay``. Ones that stop reporting are logged.
+    """
+    def __init__(
+        self,
+        target: Callable[..., Any],
+        *,
+        shard_count: int,
+        clusters: int,
+        ready_timeout: float = 300.0,
+        interval: float = 30.0,
+        restart_delay: float = 5.0,
+        max_restart_delay: float = 300.0,
+        healthy_after: float = 600.0
+    ):
+        self.target = target
+        self.shard_count = shard_count
+        self.ranges = shard_ranges(shard_count, clusters)
+        self.ready_timeout = ready_timeout
+        self.interval = interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.healthy_after = healthy_after
+        self.health: Dict[int, ClusterHealth] = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._queue: multiprocessing.Queue = self._context.Queue()
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._failures: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+
+    def run(self):
+        try:
+            for cluster_id in range(len(self.ranges)):
+                self._start(cluster_id)
+            self._monitor()
+        finally:
+            for process in self._processes.values():
+                process.terminate()
+            for process in self._processes.values():
+                process.join(10)
+
+    def _start(self, cluster_id: int):
+        shard_ids = self.ranges[cluster_id]
+        process = self._context.Process(
+            target=self.target,
+            name=f"aswo-cluster-{cluster_id}",
+            kwargs={"cluster_id": cluster_id, "shard_ids": shard_ids, "shard_count": self.shard_count, "health": self._queue},
+        )
+        process.start()
+        self._processes[cluster_id] = process
+        self._started_at[cluster_id] = time.monotonic()
+        logger.info(f"Started cluster {cluster_id} (pid {process.pid}) with shards {shard_ids[0]}-{shard_ids[-1]}")
+
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline and process.is_alive():
+            health = self._receive(deadline - time.monotonic())
+            if health is not None and health.cluster_id == cluster_id and health.status == "ready":
+                return
+
+        logger.warning(f"Cluster {cluster_id} didn't report ready in time, starting the next one anyway")
+
+    def _receive(self, timeout: float) -> Optional[ClusterHealth]:
+        try:
+            health: ClusterHealth = self._queue.get(timeout=max(timeout, 0.0))
+        except queue.Empty:
+            return None
+
+        self.health[health.cluster_id] = health
+        logger.info(f"Cluster {health.cluster_id}: {health.status}, {health.guilds} guilds, {health.latency * 1000:.0f}ms")
+        return health
+
+    def _schedule_restart(self, cluster_id: int, exitcode: Optional[int]):
+        if time.monotonic() - self._started_at[cluster_id] >= self.healthy_after:
+            self._failures[cluster_id] = 0
+
+        failures = self._failures.get(cluster_id, 0)
+        delay = min(self.restart_delay * 2 ** min(failures, 16), self.max_restart_delay)
+        self._failures[cluster_id] = failures + 1
+        self._restart_at[cluster_id] = time.monotonic() + delay
+        logger.error(f"Cluster {cluster_id} exited with code {exitcode}, restarting it in {delay:.0f} seconds")
+
+    def _monitor(self):
+        while True:
+            # Wake up early when a restart is due before the next report.
+            wait = min([self.interval, *(at - time.monotonic() for at in self._restart_at.values())])
+            self._receive(wait)
+
+            for cluster_id, process in list(self._processes.items()):
+                if not process.is_alive():
+                    if cluster_id not in self._restart_at:
+                        self._schedule_restart(cluster_id, process.exitcode)
+                    if time.monotonic() >= self._restart_at[cluster_id]:
+                        del self._restart_at[cluster_id]
+                        self._start(cluster_id)
+                    continue
+
+                health = self.health.get(cluster_id)
+                if health is not None and time.time() - health.timestamp > self.interval * 3:
+                    logger.warning(f"Cluster {cluster_id} hasn't reported in {time.time() - health.timestamp:.0f} seconds")
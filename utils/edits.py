@@ -0,0 +1,203 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import discord
+from .cache import LRUCache, MISSING
+from .ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingEdit:
+    __slots__ = ("content", "final", "waiters")
+
+    def __init__(self, content: str, final: bool):
+        self.content = content
+        self.final = final
+        self.waiters: List[asyncio.Future[None]] = []
+
+
+class EditCoalescer:
+    """Batches message edits so live progress can be shown without running into Discord's rate limits.
+
+    Only the newest content of a message is kept, anything it replaces before being
+    sent is dropped. Every channel is flushed at most once per ``interval`` seconds
+    and its edits go through a :class:`RateLimiter` per channel, since Discord buckets
+    message edits by channel. On top of that ``global_rate`` keeps all of them under
+    the global limit. Channel limiters are kept for the ``max_channels`` most recently
+    edited channels, so a ``Retry-After`` is still honoured after the channel's queue
+    has emptied. Edits sent with :meth:`edit` are final, progress that shows up
+    for the message while one is waiting or going out is ignored. Renders stop
+    reporting progress before their final edit is made, so nothing has to be
+    remembered about a message once its final edit is through.
+    """
+    def __init__(
+        self,
+        edit: Callable[[int, int, str], Awaitable[Any]],
+        *,
+        interval: float = 5.0,
+        rate: float = 1.0,
+        burst: int = 5,
+        global_rate: float = 40.0,
+        max_channels: int = 10_000
+    ):
+        self._edit = edit
+        self.interval = interval
+        self.rate = rate
+        self.burst = burst
+        self.limiter = RateLimiter("Discord edits", rate=global_rate, burst=int(global_rate))
+        self.submitted = 0
+        self.superseded = 0
+        self.sent = 0
+        self.failed = 0
+        self._pending: Dict[int, OrderedDict[int, _PendingEdit]] = {}
+        self._buckets: LRUCache[int, RateLimiter] = LRUCache(maxsize=max_channels)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._finishing: Dict[Tuple[int, int], int] = {}
+        # Messages that are gone or that we lost access to, forgetting one only costs a failed edit.
+        self._gone: LRUCache[Tuple[int, int], None] = LRUCache(maxsize=5000)
+
+    def __len__(self) -> int:
+        return sum(len(edits) for edits in self._pending.values())
+
+    def submit(self, channel_id: int, message_id: int, content: str):
+        """Schedules a progress edit, replacing whatever is still waiting to be sent for that message."""
+        self.submitted += 1
+        key = (channel_id, message_id)
+        if key in self._finishing or key in self._gone:
+            self.superseded += 1
+            return
+
+        self._put(channel_id, message_id, content, final=False)
+
+    async def edit(self, channel_id: int, message_id: int, content: str):
+        """Schedules a final edit and waits until it's been sent."""
+        self.submitted += 1
+        future = asyncio.get_running_loop().create_future()
+        self._put(channel_id, message_id, content, final=True).waiters.append(future)
+        await future
+
+    def _put(self, channel_id: int, message_id: int, content: str, *, final: bool) -> _PendingEdit:
+        edits = self._pending.setdefault(channel_id, OrderedDict())
+        pending = edits.get(message_id)
+        if pending is None:
+            pending = edits[message_id] = _PendingEdit(content, False)
+        else:
+            # The message keeps its place in line, only what it's going to say changes.
+            self.superseded += 1
+            if pending.final and not final:
+                return pending
+            pending.content = content
+
+        if final and not pending.final:
+            pending.final = True
+            key = (channel_id, message_id)
+            self._finishing[key] = self._finishing.get(key, 0) + 1
+        if channel_id not in self._tasks:
+            self._tasks[channel_id] = asyncio.create_task(self._flush_loop(channel_id))
+        return pending
+
+    async def _flush_loop(self, channel_id: int):
+        bucket = self._bucket(channel_id)
+        batch: OrderedDict[int, _PendingEdit] = OrderedDict()
+        try:
+            while self._pending.get(channel_id):
+                started = time.monotonic()
+                batch = self._pending.pop(channel_id)
+                while batch:
+                    message_id, pending = next(iter(batch.items()))
+                    await self._send(channel_id, message_id, pending, bucket)
+                    del batch[message_id]
+
+                await asyncio.sleep(max(self.interval - (time.monotonic() - started), 0.0))
+        finally:
+            del self._tasks[channel_id]
+            # Empty unless the loop was cancelled or failed, whatever it didn't get to wakes its waiters.
+            for message_id, pending in [*batch.items(), *self._pending.pop(channel_id, {}).items()]:
+                self._settle(channel_id, message_id, pending, asyncio.CancelledError())
+
+    def _bucket(self, channel_id: int) -> RateLimiter:
+        bucket = self._buckets.get(channel_id)
+        if bucket is MISSING:
+            if len(self._buckets) >= self._buckets.maxsize:
+                self._evict_bucket()
+            bucket = RateLimiter(f"Discord edits in {channel_id}", rate=self.rate, burst=self.burst)
+            self._buckets.set(channel_id, bucket)
+        return bucket
+
+    def _evict_bucket(self):
+        # Least recently used first, but not one that's flushing or still paused by a 429.
+        for channel_id in self._buckets:
+            if channel_id not in self._tasks and not self._buckets.peek(channel_id).paused_for:
+                self._buckets.pop(channel_id)
+                return
+
+    async def _send(self, channel_id: int, message_id: int, pending: _PendingEdit, bucket: RateLimiter):
+        key = (channel_id, message_id)
+        newer = self._pending.get(channel_id, {}).get(message_id)
+        if not pending.final and (newer is not None or key in self._finishing or key in self._gone):
+            # Replaced while this batch was going out, only the newest content is sent.
+            self.superseded += 1
+            return
+
+        await bucket.acquire()
+        await self.limiter.acquire()
+        try:
+            await self._edit(channel_id, message_id, pending.content)
+        except Exception as e:
+            status = e.status if isinstance(e, discord.HTTPException) else None
+            if status == 429 and e.response is not None:
+                bucket.update(status, e.response.headers)
+
+            if status == 429 and not pending.final and newer is None:
+                # Try again next flush unless newer progress replaces it first.
+                self._pending.setdefault(channel_id, OrderedDict()).setdefault(message_id, pending)
+                return
+
+            self.failed += 1
+            if status in (403, 404):
+                # The message or our access to it is gone, nothing else is going to get through.
+                self._gone.set(key, None)
+            logger.warning(f"Could not edit message {message_id} in {channel_id}: {e}")
+            self._settle(channel_id, message_id, pending, e)
+            return
+
+        self.sent += 1
+        self._settle(channel_id, message_id, pending, None)
+
+    def _settle(self, channel_id: int, message_id: int, pending: _PendingEdit, error: Optional[BaseException]):
+        if pending.final:
+            key = (channel_id, message_id)
+            count = self._finishing.get(key, 0) - 1
+            if count > 0:
+                self._finishing[key] = count
+            else:
+                self._finishing.pop(key, None)
+
+        for future in pending.waiters:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            elif isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+        pending.waiters.clear()
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self),
+            "channels": len(self._tasks),
+            "submitted": self.submitted,
+            "superseded": self.superseded,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
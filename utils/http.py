@@ -0,0 +1,144 @@
+from __future__ import annotations
+import json
+import logging
+from typing import Any, Dict, NamedTuple, Optional, Union
+import aiohttp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+logger = logging.getLogger(__name__)
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """Decodes JSON with orjson when it's installed and the stdlib otherwise."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_json(data: bytes, *path: Union[str, int]) -> Any:
+    """Decodes ``data``, or only the value found at ``path`` inside it.
+
+    With pysimdjson installed only the requested subtree gets turned into Python
+    objects, otherwise the whole document is decoded and the rest dropped right away.
+    That only pays off when the subtree is a small part of the body (see
+    ``benchmarks/decode.py``), for most of a body just decode all of it.
+    """
+    if not path:
+        return json_loads(data)
+
+    if simdjson is not None:
+        pointer = "".join(f"/{str(key).replace('~', '~0').replace('/', '~1')}" for key in path)
+        value = simdjson.Parser().parse(data).at_pointer(pointer)
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+        return value
+
+    value = json_loads(data)
+    for key in path:
+        value = value[key]
+    return value
+
+
+async def read_json(resp: aiohttp.ClientResponse, *path: Union[str, int]) -> Any:
+    """Reads and decodes a response body, see :func:`decode_json` for ``path``."""
+    return decode_json(await resp.read(), *path)
+
+
+class PoolConfig(NamedTuple):
+    limit: int = 100
+    limit_per_host: int = 20
+    keepalive_timeout: float = 30.0
+    ttl_dns_cache: int = 300
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    total_timeout: float = 60.0
+
+
+class HTTPPools:
+    """One aiohttp session and connector per upstream, so a slow host can't take every connection.
+
+    ``configs`` maps a pool name to :class:`PoolConfig` fields, anything left out uses
+    the defaults. ``default`` is for Discord-side helpers, ``osu`` for osu.ppy.sh and
+    ``ordr`` for apis.issou.best. Aiohttp doesn't pipeline HTTP/1.1 requests, so reuse
+    comes from keep-alive, which :meth:`stats` reports per pool.
+    """
+    NAMES = ("default", "osu", "ordr")
+
+    def __init__(self, configs: Optional[Dict[str, Dict[str, Any]]] = None):
+        configs = configs or {}
+        self.configs: Dict[str, PoolConfig] = {name: PoolConfig(**configs.get(name, {})) for name in self.NAMES}
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def __aenter__(self) -> HTTPPools:
+        for name, config in self.configs.items():
+            self._sessions[name] = self._create_session(name, config)
+        return self
+
+    async def __aexit__(self, *args: Any):
+        await self.close()
+
+    def session(self, name: str) -> aiohttp.ClientSession:
+        return self._sessions[name]
+
+    def _create_session(self, name: str, config: PoolConfig) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=config.limit,
+            limit_per_host=config.limit_per_host,
+            keepalive_timeout=config.keepalive_timeout,
+            ttl_dns_cache=config.ttl_dns_cache,
+            use_dns_cache=True,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config.total_timeout,
+            sock_connect=config.connect_timeout,
+            sock_read=config.read_timeout,
+        )
+
+        stats = self._stats[name] = {"requests": 0, "created": 0, "reused": 0, "queued": 0}
+        trace = aiohttp.TraceConfig()
+
+        def counter(key: str):
+            async def on_event(*args: Any):
+                stats[key] += 1
+            return on_event
+
+        trace.on_request_start.append(counter("requests"))
+        trace.on_connection_create_end.append(counter("created"))
+        trace.on_connection_reuseconn.append(counter("reused"))
+        trace.on_connection_queued_start.append(counter("queued"))
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace])
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for name, session in self._sessions.items():
+            stats = self._stats[name]
+            connections = stats["created"] + stats["reused"]
+            connector = session.connector
+            result[name] = {
+                **stats,
+                "reuse_rate": stats["reused"] / connections if connections else 0.0,
+                # aiohttp doesn't expose these publicly, they're only for the stats.
+                "in_use": len(getattr(connector, "_acquired", ())),
+                "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()),
+                "limit": connector.limit if connector else 0,
+            }
+        return result
@@ -0,0 +1,268 @@
+from __future__ import annotations
+import asyncio
+import bisect
+import logging
+import re
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RENDER_BUCKETS = (15.0, 30.0, 60.0, 120.0, 180.0, 300.0, 450.0, 600.0, 900.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Counts observations into fixed buckets, one set of buckets per combination of label values.
+
+    Observing is a bisect and two additions, the cumulative counts Prometheus wants
+    are only worked out when the registry is scraped.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), *, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            # counts per bucket (the last one is +Inf), then the sum
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observes how long the block took, awaits inside it included."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge:
+    """A value that's set directly or, with ``collect``, read from the live object every scrape.
+
+    ``collect`` returns either one number or a mapping of label values to numbers.
+    """
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        *,
+        collect: Optional[Callable[[], Union[float, Dict[LabelValues, float]]]] = None
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def samples(self) -> Iterator[str]:
+        values = self._values
+        if self.collect is not None:
+            try:
+                collected = self.collect()
+            except Exception as e:
+                logger.warning(f"Could not collect {self.name}: {e}")
+                return
+            values = collected if isinstance(collected, dict) else {(): collected}
+
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Union[Histogram, Gauge]] = {}
+
+    def __len__(self) -> int:
+        return len(self._metrics)
+
+    def register(self, metric: Union[Histogram, Gauge]) -> Union[Histogram, Gauge]:
+        """Adds ``metric``, replacing one with the same name so reloaded cogs don't register twice."""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), **kwargs: Any) -> Histogram:
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (), **kwargs: Any) -> Gauge:
+        return self.register(Gauge(name, help, labels, **kwargs))
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = MetricsRegistry()
+
+COMMAND_LATENCY = REGISTRY.histogram(
+    "aswo_command_seconds", "Time from a slash command being invoked to it finishing", ("command", "status")
+)
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    "aswo_upstream_seconds", "Latency of requests to osu! and o!rdr, not counting time spent waiting for the rate limiter", ("upstream", "endpoint")
+)
+QUERY_LATENCY = REGISTRY.histogram(
+    "aswo_query_seconds", "Latency of Postgres queries by statement and table", ("query",)
+)
+RENDER_LATENCY = REGISTRY.histogram(
+    "aswo_render_seconds", "Time from a replay being submitted to o!rdr to its render finishing", ("status",), buckets=RENDER_BUCKETS
+)
+LOOP_LAG = REGISTRY.gauge("aswo_event_loop_lag_seconds", "How late the event loop woke up a sleeping task, last and worst since the previous scrape", ("window",))
+
+
+_VERB_RE = re.compile(r"^\s*(?:WITH\b.*?\)\s*)?(\w+)", re.IGNORECASE | re.DOTALL)
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|JOIN)\s+(\w+)", re.IGNORECASE)
+_UPDATE_RE = re.compile(r"\s+(\w+)")
+_query_labels: Dict[str, str] = {}
+
+
+def query_label(query: str) -> str:
+    """Turns a query into a short label like ``SELECT osu_score``, so every query text doesn't become its own series."""
+    label = _query_labels.get(query)
+    if label is None:
+        verb = _VERB_RE.match(query)
+        if verb is None:
+            label = "OTHER"
+        else:
+            # UPDATE names its table straight away, everything else after FROM or INTO.
+            table = _UPDATE_RE.match(query, verb.end()) if verb.group(1).upper() == "UPDATE" else _TABLE_RE.search(query, verb.end())
+            label = f"{verb.group(1).upper()} {table.group(1)}" if table else verb.group(1).upper()
+        # Queries are string constants, so this stays as small as the number of distinct queries.
+        if len(_query_labels) < 2048:
+            _query_labels[query] = label
+    return label
+
+
+_NUMERIC_SEGMENT_RE = re.compile(r"(?<=/)\d+(?=/|$)")
+_route_labels: Set[str] = set()
+
+
+def route_label(path: str) -> str:
+    """Labels a request path for callers that didn't give a route template.
+
+    Numeric segments become ``{id}``. Names can't be told apart from
+    fixed segments, so once 256 labels exist anything new is labelled ``other``.
+    """
+    label = _NUMERIC_SEGMENT_RE.sub("{id}", path)
+    if label not in _route_labels:
+        if len(_route_labels) >= 256:
+            return "other"
+        _route_labels.add(label)
+    return label
+
+
+def _log_query(record: Any):
+    QUERY_LATENCY.observe(record.elapsed, query_label(record.query))
+
+
+async def instrument_connection(conn: Any):
+    """``init`` for :func:`asyncpg.create_pool`, times every query the connection runs."""
+    conn.add_query_logger(_log_query)
+
+
+class LoopLagMonitor:
+    """Sleeps for ``interval`` over and over and records how much later than asked it woke up."""
+    def __init__(self, *, interval: float = 0.5):
+        self.interval = interval
+        self.last = 0.0
+        self.worst = 0.0
+        self._task: Optional[asyncio.Task] = None
+        LOOP_LAG.collect = self._collect
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _collect(self) -> Dict[LabelValues, float]:
+        values = {("last",): self.last, ("max",): self.worst}
+        self.worst = 0.0
+        return values
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(time.perf_counter() - start - self.interval, 0.0)
+            self.worst = max(self.worst, self.last)
+
+
+class MetricsServer:
+    """Serves a :class:`MetricsRegistry` on ``GET /metrics`` for Prometheus to scrape."""
+    def __init__(self, registry: MetricsRegistry = REGISTRY, *, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -1,15 +1,108 @@
 from __future__ import annotations
+import asyncio
 import datetime
 import logging
-from typing import Dict, List, Union
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 import aiohttp
+from .cache import BatchLoader, ResponseCache, SingleFlight, beatmap_ttl, freeze
 from .default import date
+from .http import read_json
 from .osu_errors import *
+from .ratelimit import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+class TokenManager:
+    """Caches the client credentials token until shortly before it expires.
+
+    Only one refresh runs at a time, every other caller waits on it. Once the token
+    gets within ``early_refresh`` seconds of expiring, a refresh is started in the
+    background while callers keep using the current token.
+    """
+    def __init__(
+        self,
+        *,
+        client_id: int,
+        client_secret: str,
+        session: aiohttp.ClientSession,
+        token_url: str,
+        refresh_margin: float = 60.0,
+        early_refresh: float = 300.0
+    ):
+        self.id = client_id
+        self.secret = client_secret
+        self.session = session
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.early_refresh = early_refresh
+        self._token: Optional[str] = None
+        self._expires_at: float = 0.0
+        self._refresh_task: Optional[asyncio.Task[str]] = None
+
+    @property
+    def expires_in(self) -> float:
+        return max(self._expires_at - time.monotonic(), 0.0)
+
+    def is_valid(self) -> bool:
+        return self._token is not None and self.expires_in > self.refresh_margin
+
+    async def get(self) -> str:
+        if not self.is_valid():
+            return await asyncio.shield(self._refresh())
+
+        if self.expires_in <= self.early_refresh:
+            self._refresh()
+
+        return self._token
+
+    def invalidate(self, token: str):
+        # Another caller may have already replaced the rejected token.
+        if self._token == token:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _refresh(self) -> asyncio.Task[str]:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch_token())
+            self._refresh_task.add_done_callback(self._log_failure)
+
+        return self._refresh_task
+
+    def _log_failure(self, task: asyncio.Task[str]):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Refreshing the osu! token failed", exc_info=task.exception())
+
+    async def _fetch_token(self) -> str:
+        data = {
+            "client_id": self.id,
+            "client_secret": self.secret,
+            'grant_type':'client_credentials',
+            'scope':"public",
+        }
+
+        async with self.session.post(self.token_url, data=data) as response:
+            json = await read_json(response)
+
+        if 'access_token' not in json:
+            raise NoTokenReceived(f"osu! did not give us a token: {json.get('error', response.status)}")
+
+        self._token = json['access_token']
+        self._expires_at = time.monotonic() + json['expires_in']
+        logger.info(f"Refreshed osu! token, expires in {json['expires_in']} seconds")
+        return self._token
+
+
 class Osu:
-    def __init__(self, *, client_id: int, client_secret: str, session: aiohttp.ClientSession):
+    def __init__(
+        self,
+        *,
+        client_id: int,
+        client_secret: str,
+        session: aiohttp.ClientSession,
+        cache: Optional[ResponseCache] = None,
+        limiter: Optional[RateLimiter] = None
+    ):
         self.id = client_id
         self.secret = client_secret
         self.session: aiohttp.ClientSession = session
@@ -18,67 +111,82 @@ class Osu:
         self.beatmap_types = ['favourite', 'graveyard', 'loved', 'most_played', 'pending', 'ranked']
         self.special_types = ['most_played']
         self.score_types = ['best', 'firsts', 'recent']
+        self.tokens = TokenManager(client_id=client_id, client_secret=client_secret, session=session, token_url=self.TOKEN_URL)
+        self.cache = cache or ResponseCache()
+        self._inflight = SingleFlight()
+        # osu! asks for 60 requests a minute, anything over that is burst headroom.
+        self.limiter = limiter or RateLimiter("osu!", rate=1.0, burst=60)
+        self._beatmaps: BatchLoader[int, Beatmap] = BatchLoader(
+            self._get_beatmaps,
+            max_batch=50,
+            window=0.005,
+            missing=lambda _: NoBeatMapFound("No beatmap was found by that ID!")
+        )
     
-    async def _request(self, method: str, url: str, **kwargs):
-        async with self.session.request(method, url,**kwargs) as resp:
-            json = await resp.json()
+    async def _request(self, method: str, endpoint: str, *, route: Optional[str] = None, **kwargs):
+        if method != "GET":
+            return await self._send_request(method, endpoint, route=route, **kwargs)
 
-        return json
-    async def get_token(self):
-        data = {
-            "client_id": self.id,
-            "client_secret": self.secret,
-            'grant_type':'client_credentials',
-            'scope':"public",
-        }
+        # Identical GETs that overlap share one round trip, errors included.
+        key = (method, endpoint, freeze(kwargs))
+        return await self._inflight.do(key, lambda: self._send_request(method, endpoint, route=route, **kwargs))
 
-        async with self.session.post(self.TOKEN_URL,data=data) as response:
-            return (await response.json())['access_token']
-    
-    async def make_headers(self):
-        authorization = await self.get_token()
-        headers = {
+    async def _send_request(self, method: str, endpoint: str, *, route: Optional[str] = None, **kwargs):
+        # A 401 means the cached token was revoked or expired early, so get a new one and retry once.
+        for attempt in range(2):
+            token = await self.tokens.get()
+            headers = self._headers(token)
+
+            async with self.limiter.request(self.session, method, self.API_URL + endpoint, headers=headers, route=route, **kwargs) as resp:
+                if resp.status == 401 and attempt == 0:
+                    self.tokens.invalidate(token)
+                    continue
+
+                json = await read_json(resp)
+
+            return json
+
+    async def get_token(self) -> str:
+        return await self.tokens.get()
+
+    def _headers(self, token: str) -> Dict[str, str]:
+        return {
             "Content-Type": "application/json",
             "Accept": "application/json",
-            "Authorization": f"Bearer {authorization}"
+            "Authorization": f"Bearer {token}"
         }
-
-        return headers
+    
+    async def make_headers(self):
+        return self._headers(await self.get_token())
 
     async def fetch_user(self, user: Union[str, int]) -> User:
-        headers = await self.make_headers()
+        return await self.cache.get_or_fetch("user", str(user).lower(), lambda: self._fetch_user(user))
 
+    async def _fetch_user(self, user: Union[str, int]) -> User:
         params = {
             "limit":5
         }
-        json = await self._request("GET", url=self.API_URL+f"/users/{user}", headers=headers, params=params)
+        json = await self._request("GET", f"/users/{user}", route="/users/{user}", params=params)
 
         if 'error' in json.keys() and json['error'] is None:
             raise NoUserFound("No user was found by that name!")
 
-        return TestUser(json)
+        return User(json)
 
     async def tests(self, method: str, /, endpoint: str, params: dict = None):
-        headers = await self.make_headers()
-        async with self.session.request(method, self.API_URL + endpoint, params=params, headers=headers) as resp:
-            json = await resp.json()
-
-        return json
+        return await self._request(method, endpoint, params=params)
 
     async def fetch_user_score(self, user: Union[str, int], /, type: str, limit: int = 1, include_fails: bool = False):
         if type not in self.score_types:
             types = ', '.join(self.score_types)
             raise WrongType(f"Score type must be in {types}")
 
-        headers = await self.make_headers()
-
         params = {
             "limit": limit,
             "include_fails": f"{0 if include_fails is not True else 1}"
         }
 
-        async with self.session.get(self.API_URL+f"/users/{user}/scores/{type}", headers=headers, params=params) as response:
-            json = await response.json()
+        json = await self._request("GET", f"/users/{user}/scores/{type}", route=f"/users/{{user}}/scores/{type}", params=params)
 
         beatmaps = []
 
@@ -88,7 +196,10 @@ class Osu:
         return beatmaps
 
     async def fetch_user_beatmaps(self, /, user: str, type: str, limit: int) -> List[Beatmapset]:
-        headers = await self.make_headers()
+        key = (str(user).lower(), type, limit)
+        return await self.cache.get_or_fetch("user_beatmaps", key, lambda: self._fetch_user_beatmaps(user, type, limit))
+
+    async def _fetch_user_beatmaps(self, user: str, type: str, limit: int) -> List[Beatmapset]:
         params = {
             "limit": limit
         }
@@ -97,8 +208,7 @@ class Osu:
             types = ', '.join(self.beatmap_types)
             raise WrongType(f"Beatmap type must be in {types}")
 
-        async with self.session.get(self.API_URL + f"/users/{user}/beatmapsets/{type}",headers=headers,params=params) as response:
-            json = await response.json()
+        json = await self._request("GET", f"/users/{user}/beatmapsets/{type}", route=f"/users/{{user}}/beatmapsets/{type}", params=params)
     
         beatmaps = []
         
@@ -110,65 +220,157 @@ class Osu:
                 
         return beatmaps
     
-    async def get_beatmap(self, beatmap: Union[str, int]): 
-        headers = await self.make_headers()
+    async def get_beatmap(self, beatmap: Union[str, int]) -> Beatmap:
+        return await self.cache.get_or_fetch("beatmap", str(beatmap), lambda: self._get_beatmap(beatmap), ttl=beatmap_ttl)
 
-        async with self.session.get(self.API_URL+f"/beatmaps/{beatmap}", headers=headers) as resp:
-            json = await resp.json()
+    async def fetch_beatmap(self, beatmap: Union[str, int]) -> Beatmap:
+        """:meth:`get_beatmap` without the response cache, for callers that keep maps themselves like :class:`BeatmapMirror`"""
+        return await self._get_beatmap(beatmap)
 
-        if 'error' in json.keys():
+    async def _get_beatmap(self, beatmap: Union[str, int]) -> Beatmap:
+        try:
+            beatmap_id = int(beatmap)
+        except ValueError:
             raise NoBeatMapFound("No beatmap was found by that ID!")
 
-        return Beatmap(json)
+        return await self._beatmaps.load(beatmap_id)
+
+    async def _get_beatmaps(self, beatmap_ids: List[int]) -> Dict[int, Beatmap]:
+        params = [("ids[]", beatmap_id) for beatmap_id in beatmap_ids]
+        json = await self._request("GET", "/beatmaps", params=params)
+
+        return {beatmap['id']: Beatmap(beatmap) for beatmap in json.get('beatmaps', [])}
+
+    async def get_beatmaps(self, beatmaps: Iterable[Union[str, int]]) -> List[Beatmap]:
+        """Gets full beatmaps for e.g. every score from :meth:`fetch_user_score` in one request per 50 maps"""
+        return list(await asyncio.gather(*(self.get_beatmap(beatmap) for beatmap in beatmaps)))
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(value.replace('Z', '')) if value else None
+
+
+class _Field:
+    """A model attribute that's parsed from the payload the first time it's read.
+
+    The parsed value is kept in a hidden slot that :class:`_ModelMeta` adds for
+    every field, so reading it again is a plain slot lookup. Meant for values that
+    cost something to build (dates, nested models, formatted strings).
+    """
+    __slots__ = ("parse", "name", "slot")
+
+    def __init__(self, parse: Callable[[dict], Any]):
+        self.parse = parse
+
+    def __set_name__(self, owner: type, name: str):
+        self.name = name
+
+    def __get__(self, instance: Optional[_Model], owner: type) -> Any:
+        if instance is None:
+            return self
+
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            value = self.parse(instance._data)
+            self.slot.__set__(instance, value)
+            return value
+
+
+class _Key:
+    """A model attribute that reads straight from the payload, for values that need no parsing."""
+    __slots__ = ("path", "default")
+
+    def __init__(self, *path: str, default: Any = None):
+        self.path = path
+        self.default = default
+
+    def __get__(self, instance: Optional[_Model], owner: type) -> Any:
+        if instance is None:
+            return self
+
+        value = instance._data
+        for key in self.path:
+            if not value:
+                return self.default
+            value = value.get(key)
+
+        return self.default if value is None else value
+
 
+field = _Key
+
+
+class _ModelMeta(type):
+    def __new__(mcs, name: str, bases: tuple, namespace: Dict[str, Any]):
+        fields = [key for key, value in namespace.items() if isinstance(value, _Field)]
+        namespace['__slots__'] = (*namespace.get('__slots__', ()), *(f"_f_{key}" for key in fields))
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        for key in fields:
+            namespace[key].slot = cls.__dict__[f"_f_{key}"]
+
+        cls._slots = (*getattr(cls, '_slots', ()), *(f"_f_{key}" for key in fields))
+        return cls
+
+
+class _Model(metaclass=_ModelMeta):
+    """Base for the osu! models, keeps the payload and parses fields from it on demand."""
+    __slots__ = ("_data",)
+    _slots: tuple
 
-class _BaseUser:
-    __slots__ = (
-        "username",
-        "id",
-        "is_bot",
-        "avatar_url"
-    )
     def __init__(self, data: dict):
-        self._upate(data)
+        self._data = data
 
     def _update(self, data: dict):
-        self.username = data['username']
-        self.id = data['id']
-        self.is_bot = data['is_bot']
-        self.avatar_url = data['avatar_url']
+        self._data = data
+        for slot in self._slots:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                pass
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self._data
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        return self._data
+
+
+class _BaseUser(_Model):
+    username = field('username')
+    id = field('id')
+    is_bot = field('is_bot')
+    avatar_url = field('avatar_url')
 
 
 class TestUser(_BaseUser):
-    def __init__(self, data: dict):
-        super().__init__(data)
-        self.discord = data['discord']
-
-
-
-class User:
-    def __init__(self, data):
-        self.data = data
-        self.username = data['username']
-        self.global_rank = data.get('statistics').get("global_rank") if data.get('statistics').get("global_rank") is not None else 0
-        self.pp = data.get("statistics").get("pp")  if data.get('statistics') else "None"
-        self._rank = data.get("statistics").get("grade_counts") if data.get('statistics') else "None"
-        self.accuracy = f"{data.get('statistics').get('hit_accuracy'):,.2f}"  if data.get('statistics') else "None"
-        self.country_rank = data.get('statistics').get("country_rank") if data.get('statistics').get("country_rank") is not None else 0
-        self._profile_order = data['profile_order'] if data['profile_order'] else "Cant Get Profile Order!"
-        self.country_emoji = f":flag_{data.get('country_code').lower()}:" if data.get("country_code") else "None"
-        self.country_code = data.get("country_code") if data.get("country_code") else "None"
-        self._country = data.get("country")
-        self.avatar_url = data.get("avatar_url")
-        self.id = data.get("id")
-        self.playstyle = data.get("playstyle") 
-        self.playmode = data.get("playmode")
-        self.max_combo = data.get("statistics").get("maximum_combo")
-        self.level = data.get("statistics").get("level")
-        self.follower_count = data.get("follower_count")
-        self.total_hits = data.get("statistics").get("total_hits")
-        self.total_score = data.get("statistics").get("total_score")
-        self.play_count = data.get("statistics").get("play_count")
+    discord = field('discord')
+
+
+class User(_Model):
+    username = field('username')
+    global_rank = field("statistics", "global_rank", default=0)
+    pp = _Field(lambda data: data['statistics'].get("pp") if data.get('statistics') else "None")
+    _rank = _Field(lambda data: data['statistics'].get("grade_counts") if data.get('statistics') else "None")
+    accuracy = _Field(lambda data: f"{data['statistics'].get('hit_accuracy'):,.2f}" if data.get('statistics') else "None")
+    country_rank = field("statistics", "country_rank", default=0)
+    _profile_order = _Field(lambda data: data.get('profile_order') or "Cant Get Profile Order!")
+    country_emoji = _Field(lambda data: f":flag_{data['country_code'].lower()}:" if data.get("country_code") else "None")
+    country_code = _Field(lambda data: data.get("country_code") or "None")
+    _country = field("country")
+    avatar_url = field("avatar_url")
+    id = field("id")
+    playstyle = field("playstyle")
+    playmode = field("playmode")
+    max_combo = field("statistics", "maximum_combo")
+    level = field("statistics", "level")
+    follower_count = field("follower_count")
+    total_hits = field("statistics", "total_hits")
+    total_score = field("statistics", "total_score")
+    play_count = field("statistics", "play_count")
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} username: {self.username!r}, id: {self.id}>"
@@ -200,36 +402,30 @@ class User:
     def country(self):
         return [self._country['code'], self._country['name']]
 
-    @property
-    def raw(self) -> Dict[str, any]:
-        return self.data
-
-class Beatmap:
-    def __init__(self, data):
-        self.data = data
-        self.artist = data['beatmapset']['artist']
-        self.title = data['beatmapset']['title']
-        self.beatmapset = data['beatmapset']
-        self.beatmapset_id = data['beatmapset_id']
-        self.difficulty_rating = data['difficulty_rating']
-        self.id = data['id']
-        self.mode = data['mode']
-        self.status = data['status']
-        self.difficulty = data['version']
-        self.cs = data['cs']
-        self.drain = data['drain']
-        self.last_updated = datetime.datetime.fromisoformat(data['last_updated'].replace('Z', '')) if data['last_updated'] else None
-        self.pass_count = data['passcount']
-        self.play_count = data['playcount']
-        self.url = data['url']    
-        self.favorite_count = data['beatmapset']['favourite_count']
-        self.nsfw = data['beatmapset']['nsfw']
-        self.ranked_date = datetime.datetime.fromisoformat(data['beatmapset']['ranked_date'].replace('Z', '')) if data['beatmapset']['ranked_date'] else None
-        self.submitted_date = datetime.datetime.fromisoformat(data['beatmapset']['submitted_date'].replace('Z', ''))  if data['beatmapset']['submitted_date'] else None
-        self.max_combo = data['max_combo']
-        self.creator = data['beatmapset']['creator']
-        self.ar = data['ar']
-        self.bpm = data['bpm']
+class Beatmap(_Model):
+    artist = field('beatmapset', 'artist')
+    title = field('beatmapset', 'title')
+    beatmapset = field('beatmapset')
+    beatmapset_id = field('beatmapset_id')
+    difficulty_rating = field('difficulty_rating')
+    id = field('id')
+    mode = field('mode')
+    status = field('status')
+    difficulty = field('version')
+    cs = field('cs')
+    drain = field('drain')
+    last_updated = _Field(lambda data: _parse_date(data.get('last_updated')))
+    pass_count = field('passcount')
+    play_count = field('playcount')
+    url = field('url')
+    favorite_count = field('beatmapset', 'favourite_count')
+    nsfw = field('beatmapset', 'nsfw')
+    ranked_date = _Field(lambda data: _parse_date(data['beatmapset'].get('ranked_date')))
+    submitted_date = _Field(lambda data: _parse_date(data['beatmapset'].get('submitted_date')))
+    max_combo = field('max_combo')
+    creator = field('beatmapset', 'creator')
+    ar = field('ar')
+    bpm = field('bpm')
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} title: {self.title!r}, artist: {self.artist!r}>"
@@ -241,54 +437,36 @@ class Beatmap:
         cover_data = self.data['beatmapset']['covers'][cover]
         return cover_data
 
-class BeatmapCompact:
-    __slots__ = (
-        "beatmapset_id",
-        "difficulty_rating",
-        "id",
-        "mode",
-        "status",
-        "total_length",
-        "user_id",
-        "version"
-    )
-    def __init__(self, data: dict):
-        keys = {k: v for k, v in data.items() if k in self.__slots__}
-        for k,v in keys.items():
-            setattr(self, k, v)
-            continue
-
-
-
-class Beatmapset:
-    __slots__ = (
-        "artist",
-        "artist_unicode",
-        "creator",
-        "favourite_count",
-        "hype",
-        "id",
-        "nsfw",
-        "offset",
-        "play_count",
-        "preview_url",
-        "source",
-        "spotlight",
-        "status",
-        "title",
-        'title_unicode',
-        "track_id",
-        "user_id",
-        "video",
-    )
-
-    def __init__(self, data: dict):
-        keys = {k: v for k, v in data.items() if k in self.__slots__}
-        for k,v in keys.items():
-            setattr(self, k, v)
-            continue
-
-        self.data = data
+class BeatmapCompact(_Model):
+    beatmapset_id = field("beatmapset_id")
+    difficulty_rating = field("difficulty_rating")
+    id = field("id")
+    mode = field("mode")
+    status = field("status")
+    total_length = field("total_length")
+    user_id = field("user_id")
+    version = field("version")
+
+
+class Beatmapset(_Model):
+    artist = field("artist")
+    artist_unicode = field("artist_unicode")
+    creator = field("creator")
+    favourite_count = field("favourite_count")
+    hype = field("hype")
+    id = field("id")
+    nsfw = field("nsfw")
+    offset = field("offset")
+    play_count = field("play_count")
+    preview_url = field("preview_url")
+    source = field("source")
+    spotlight = field("spotlight")
+    status = field("status")
+    title = field("title")
+    title_unicode = field('title_unicode')
+    track_id = field("track_id")
+    user_id = field("user_id")
+    video = field("video")
 
     def covers(self, cover: str) -> str:
         if cover not in self.data['covers']:
@@ -298,12 +476,30 @@ class Beatmapset:
         cover_data = self.data['covers'][cover]
         return cover_data
 
-class Score:
-    def __init__(self, data: dict):
-        keys = {k: v for k, v in data.items()}
-        for k, v in keys.items():
-            setattr(self, k, v)
-            continue
-
-        self.beatmapset = Beatmapset(data['beatmapset'])
-        self.beatmap = BeatmapCompact(data['beatmap'])
\ No newline at end of file
+class Score(_Model):
+    accuracy = field("accuracy")
+    best_id = field("best_id")
+    created_at = field("created_at")
+    id = field("id")
+    max_combo = field("max_combo")
+    mode = field("mode")
+    mods = field("mods")
+    passed = field("passed")
+    perfect = field("perfect")
+    pp = field("pp")
+    rank = field("rank")
+    score = field("score")
+    statistics = field("statistics")
+    user_id = field("user_id")
+    beatmapset = _Field(lambda data: Beatmapset(data['beatmapset']))
+    beatmap = _Field(lambda data: BeatmapCompact(data['beatmap']))
+
+    def __getattr__(self, name: str) -> Any:
+        # Scores used to copy every key of the payload onto themselves, keep the rarer ones reachable.
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(f"{self.__class__.__name__!r} object has no attribute {name!r}") from None
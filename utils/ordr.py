@@ -0,0 +1,376 @@
+from __future__ import annotations
+import asyncio
+import bisect
+import datetime
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+import aiohttp
+import socketio
+from asyncpg import Pool
+from .cache import SingleFlight
+from .constants import error_codes
+from .http import read_json
+from .osu_errors import RenderFailed
+from .ratelimit import Priority, RateLimiter, current_priority
+
+logger = logging.getLogger(__name__)
+
+ORDR_API = "https://apis.issou.best/ordr"
+ORDR_WS = "https://ordr-ws.issou.best"
+
+
+class RenderDispatcher:
+    """Owns the o!rdr websocket and hands finished renders to whoever is waiting on them.
+
+    o!rdr broadcasts every render on the same socket, so events are matched against
+    ``pending`` by renderID and everything else is ignored. After a reconnect the
+    pending renders are looked up over HTTP in case they finished while we were away.
+    """
+    def __init__(self, *, session: aiohttp.ClientSession, limiter: RateLimiter, timeout: float = 840.0):
+        self.session = session
+        self.limiter = limiter
+        self.timeout = timeout
+        self.pending: Dict[int, asyncio.Future[dict]] = {}
+        self.progress: Dict[int, List[Callable[[dict], Any]]] = {}
+        self.sio = socketio.AsyncClient(reconnection=True, reconnection_delay_max=30)
+        self._connect_task: Optional[asyncio.Task] = None
+        self._has_connected = False
+
+        self.sio.on('connect', self._on_connect)
+        self.sio.on('disconnect', self._on_disconnect)
+        self.sio.on('render_progress_json', self._on_render_progress)
+        self.sio.on('render_done_json', self._on_render_done)
+        self.sio.on('render_failed_json', self._on_render_failed)
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    @property
+    def connected(self) -> bool:
+        return self.sio.connected
+
+    async def start(self):
+        # Connecting is retried in the background so o!rdr being down doesn't block startup.
+        self._connect_task = asyncio.create_task(self.sio.connect(ORDR_WS, transports=['websocket'], retry=True))
+
+    async def close(self):
+        if self._connect_task is not None:
+            self._connect_task.cancel()
+
+        for future in list(self.pending.values()):
+            future.cancel()
+
+        await self.sio.disconnect()
+
+    def register(self, render_id: int) -> asyncio.Future[dict]:
+        """Starts listening for ``render_id``, call this as soon as the render is submitted."""
+        future = self.pending.get(render_id)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[render_id] = future
+
+        handle = loop.call_later(self.timeout, self._expire, render_id)
+        future.add_done_callback(lambda f: self._cleanup(render_id, f, handle))
+        return future
+
+    def on_progress(self, render_id: int, callback: Callable[[dict], Any]):
+        """Calls ``callback`` with every ``render_progress_json`` payload for ``render_id`` until it's done."""
+        if render_id in self.pending:
+            self.progress.setdefault(render_id, []).append(callback)
+
+    async def wait_for(self, render_id: int) -> dict:
+        """Waits for the render to finish and returns the ``render_done_json`` payload.
+
+        Raises :class:`RenderFailed` if o!rdr reports an error and
+        :class:`asyncio.TimeoutError` if nothing arrives within ``timeout`` seconds.
+        """
+        return await asyncio.shield(self.register(render_id))
+
+    def _cleanup(self, render_id: int, future: asyncio.Future[dict], handle: asyncio.TimerHandle):
+        handle.cancel()
+        if self.pending.get(render_id) is future:
+            del self.pending[render_id]
+            self.progress.pop(render_id, None)
+
+        # Mark the exception as retrieved, every waiter gets it through shield anyway.
+        if not future.cancelled():
+            future.exception()
+
+    def _expire(self, render_id: int):
+        future = self.pending.get(render_id)
+        if future is not None and not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    def _resolve(self, render_id: int, data: dict):
+        future = self.pending.get(render_id)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    async def _on_render_progress(self, data: dict):
+        for callback in self.progress.get(data['renderID'], ()):
+            try:
+                callback(data)
+            except Exception as e:
+                logger.warning(f"Progress callback for render {data['renderID']} failed: {e}")
+
+    async def _on_render_done(self, data: dict):
+        self._resolve(data['renderID'], data)
+
+    async def _on_render_failed(self, data: dict):
+        future = self.pending.get(data['renderID'])
+        if future is not None and not future.done():
+            future.set_exception(RenderFailed(data.get('errorCode'), data.get('errorMessage')))
+
+    async def _on_connect(self):
+        if self._has_connected:
+            logger.info(f"Reconnected to o!rdr, checking {len(self.pending)} pending renders")
+            asyncio.create_task(self.resync())
+        else:
+            logger.info("Connected to o!rdr")
+
+        self._has_connected = True
+
+    async def _on_disconnect(self, *args):
+        logger.warning(f"Lost connection to o!rdr with {len(self.pending)} pending renders")
+
+    async def resync(self):
+        """Looks up every pending render over HTTP and resolves the ones that already finished."""
+        current_priority.set(Priority.BACKGROUND)
+        for render_id in list(self.pending):
+            try:
+                async with self.limiter.request(self.session, "GET", f"{ORDR_API}/renders", params={"renderID": render_id}) as resp:
+                    renders = (await read_json(resp))['renders']
+            except (aiohttp.ClientError, KeyError, ValueError) as e:
+                logger.warning(f"Could not look up render {render_id}: {e}")
+                continue
+
+            if renders and renders[0].get('videoUrl') and renders[0].get('progress') == "Done.":
+                self._resolve(render_id, renders[0])
+
+
+class RenderJob(NamedTuple):
+    render_id: Optional[int]
+    video_url: Optional[str]
+    """Set when the render was already done, nothing has to be waited on"""
+    error_code: Optional[int]
+
+
+class RenderCache:
+    """Remembers which replay was rendered with which skin in the ``render_cache`` table.
+
+    Replays are keyed by :func:`replay_hash`, so a replay that's posted again gets its
+    finished video straight away and one that's still rendering gets attached to that
+    render instead of being submitted again. Identical replays submitted at the same
+    time in this process share one submission, and if another process won that race
+    o!rdr answers with error 29 and the row it wrote is used instead.
+    """
+    def __init__(self, pool: Pool, dispatcher: RenderDispatcher, *, max_age: float = 30 * 86400.0):
+        self.pool = pool
+        self.dispatcher = dispatcher
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self.pending_age = datetime.timedelta(seconds=dispatcher.timeout)
+        self.hits = 0
+        self.misses = 0
+        self._inflight = SingleFlight()
+        self._recording: Set[asyncio.Task] = set()
+
+    async def find(self, replay_hash: str, skin: int) -> Optional[RenderJob]:
+        row = await self.pool.fetchrow(
+            "SELECT render_id, video_url, now() - created_at AS age FROM render_cache WHERE replay_hash = $1 AND skin_id = $2",
+            replay_hash, skin,
+        )
+        if row is None or row['age'] > (self.max_age if row['video_url'] else self.pending_age):
+            return None
+
+        if row['video_url'] is None:
+            self.dispatcher.register(row['render_id'])
+        return RenderJob(row['render_id'], row['video_url'], None)
+
+    async def get_or_submit(self, replay_hash: Optional[str], skin: int, submit: Callable[[], Awaitable[Dict[str, Any]]]) -> RenderJob:
+        """Returns the cached or in flight render for the replay, or calls ``submit`` to start one.
+
+        ``submit`` has to return o!rdr's response to ``POST /renders``. Replays without
+        a hash (because they couldn't be read) are always submitted.
+        """
+        if replay_hash is None:
+            return await self._submit(None, skin, submit)
+
+        return await self._inflight.do((replay_hash, skin), lambda: self._get_or_submit(replay_hash, skin, submit))
+
+    async def _get_or_submit(self, replay_hash: str, skin: int, submit: Callable[[], Awaitable[Dict[str, Any]]]) -> RenderJob:
+        job = await self.find(replay_hash, skin)
+        if job is not None:
+            self.hits += 1
+            return job
+
+        self.misses += 1
+        job = await self._submit(replay_hash, skin, submit)
+        if job.error_code == 29:
+            return await self.find(replay_hash, skin) or job
+        return job
+
+    async def _submit(self, replay_hash: Optional[str], skin: int, submit: Callable[[], Awaitable[Dict[str, Any]]]) -> RenderJob:
+        ordr_json = await submit()
+        if ordr_json['errorCode'] in error_codes:
+            return RenderJob(None, None, ordr_json['errorCode'])
+
+        render_id = ordr_json['renderID']
+        future = self.dispatcher.register(render_id)
+        if replay_hash is not None:
+            query = """
+                INSERT INTO render_cache (replay_hash, skin_id, render_id) VALUES ($1, $2, $3)
+                ON CONFLICT (replay_hash, skin_id) DO
+                UPDATE SET render_id = excluded.render_id, video_url = NULL, created_at = now()
+            """
+            await self.pool.execute(query, replay_hash, skin, render_id)
+            future.add_done_callback(lambda f: self._start_recording(render_id, f))
+
+        return RenderJob(render_id, None, None)
+
+    def _start_recording(self, render_id: int, future: asyncio.Future[dict]):
+        # The loop only keeps weak references to tasks, so hold on to it until it's done.
+        task = asyncio.create_task(self._record(render_id, future))
+        self._recording.add(task)
+        task.add_done_callback(self._recording.discard)
+
+    async def _record(self, render_id: int, future: asyncio.Future[dict]):
+        try:
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                # Failed or timed out, the next post of this replay should try again.
+                await self.pool.execute("DELETE FROM render_cache WHERE render_id = $1 AND video_url IS NULL", render_id)
+            else:
+                await self.pool.execute("UPDATE render_cache SET video_url = $2 WHERE render_id = $1", render_id, future.result()['videoUrl'])
+        except Exception as e:
+            logger.warning(f"Could not record the result of render {render_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "shared": self._inflight.shared}
+
+
+class SkinCatalog:
+    """Keeps every o!rdr skin in memory and refreshes the list every ``ttl`` seconds.
+
+    Lookups by ID are a dict hit. Searching uses a sorted list of lowercased names for
+    prefix matches and one newline joined haystack for substring matches, so
+    autocomplete never has to touch the network.
+    """
+    def __init__(self, *, session: aiohttp.ClientSession, limiter: RateLimiter, ttl: float = 3600.0, page_size: int = 400):
+        self.session = session
+        self.limiter = limiter
+        self.ttl = ttl
+        self.page_size = page_size
+        self.skins: Dict[int, dict] = {}
+        self._order: List[dict] = []
+        self._names: List[Tuple[str, int]] = []
+        self._ids: List[str] = []
+        self._haystack = ""
+        self._offsets: List[int] = []
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.skins)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    def get(self, skin_id: int) -> Optional[dict]:
+        return self.skins.get(skin_id)
+
+    async def _refresh_loop(self):
+        current_priority.set(Priority.BACKGROUND)
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Anything that ends this loop would leave /replay config waiting on the skins until a restart.
+                logger.warning(f"Could not refresh the o!rdr skin list: {e!r}")
+
+            # Until the first load works, retry well before the next scheduled refresh.
+            await asyncio.sleep(self.ttl if self.ready else min(self.ttl, 30.0))
+
+    async def refresh(self):
+        skins: List[dict] = []
+        page = 1
+        while True:
+            async with self.limiter.request(self.session, "GET", f"{ORDR_API}/skins", params={"pageSize": self.page_size, "page": page}) as resp:
+                json = await read_json(resp)
+
+            skins.extend(json['skins'])
+            if not json['skins'] or len(skins) >= json['maxSkins']:
+                break
+            page += 1
+
+        self._build(skins)
+        self._ready.set()
+        logger.info(f"Loaded {len(skins)} o!rdr skins")
+
+    def _build(self, skins: List[dict]):
+        names = sorted((skin['skin'].lower(), skin['id']) for skin in skins)
+
+        offsets = []
+        position = 0
+        for name, _ in names:
+            offsets.append(position)
+            position += len(name) + 1
+
+        # Everything is built first and swapped in at once so searches never see a half built index.
+        self._order = skins
+        self.skins = {skin['id']: skin for skin in skins}
+        self._names = names
+        self._ids = sorted(str(skin['id']) for skin in skins)
+        self._haystack = "\n".join(name for name, _ in names)
+        self._offsets = offsets
+
+    def search(self, query: str, *, limit: int = 25) -> List[dict]:
+        query = query.strip().lower()
+        if not query:
+            return self._order[:limit]
+
+        found: Dict[int, dict] = {}
+
+        def add(skin_id: int) -> bool:
+            found.setdefault(skin_id, self.skins[skin_id])
+            return len(found) >= limit
+
+        if query.isdigit():
+            index = bisect.bisect_left(self._ids, query)
+            while index < len(self._ids) and self._ids[index].startswith(query):
+                if add(int(self._ids[index])):
+                    return list(found.values())
+                index += 1
+
+        index = bisect.bisect_left(self._names, (query,))
+        while index < len(self._names) and self._names[index][0].startswith(query):
+            if add(self._names[index][1]):
+                return list(found.values())
+            index += 1
+
+        if "\n" in query:
+            return list(found.values())
+
+        position = self._haystack.find(query)
+        while position != -1:
+            index = bisect.bisect_right(self._offsets, position) - 1
+            if add(self._names[index][1]):
+                break
+            position = self._haystack.find(query, self._offsets[index] + len(self._names[index][0]) + 1)
+
+        return list(found.values())
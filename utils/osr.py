@@ -0,0 +1,194 @@
+from __future__ import annotations
+import datetime
+import hashlib
+import lzma
+import re
+import struct
+from typing import AsyncIterator, Iterable, NamedTuple
+from .osu_errors import InvalidReplay
+
+# Mods o!rdr refuses to render, as bit flags from the replay header.
+MOD_AUTOPLAY = 1 << 11
+MOD_CINEMA = 1 << 22
+MOD_TARGET_PRACTICE = 1 << 23
+INCOMPATIBLE_MODS = MOD_TARGET_PRACTICE
+
+# Names o!rdr accepts, anything else fails with error 12.
+USERNAME_RE = re.compile(r"^[A-Za-z0-9 _\-\[\]]{1,32}$")
+
+# Every replay starts with two frames osu! writes itself and can end with the RNG seed frame.
+SPECIAL_FRAMES = 3
+MIN_FRAMES = 8
+
+_TICKS_EPOCH = datetime.datetime(1, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ReplayHeader(NamedTuple):
+    mode: int
+    version: int
+    beatmap_md5: str
+    player_name: str
+    replay_md5: str
+    count_300: int
+    count_100: int
+    count_50: int
+    count_geki: int
+    count_katu: int
+    count_miss: int
+    score: int
+    max_combo: int
+    perfect: bool
+    mods: int
+    timestamp: datetime.datetime
+    data_length: int
+    frames: int
+    """Input frames in the part of the replay data that was decompressed, not the whole replay"""
+
+
+class _Stream:
+    """Reads fixed size values from chunks as they arrive, without waiting for the whole file."""
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self._position = 0
+
+    async def read(self, size: int) -> bytes:
+        while len(self._buffer) - self._position < size:
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                raise InvalidReplay(5, "The replay ends before its header does") from None
+
+            # Drop what's been read so the buffer never holds more than a chunk or two.
+            del self._buffer[:self._position]
+            self._position = 0
+            self._buffer += chunk
+
+        data = bytes(self._buffer[self._position:self._position + size])
+        self._position += size
+        return data
+
+    async def chunks(self, size: int) -> AsyncIterator[bytes]:
+        """Yields the next ``size`` bytes piece by piece, as they come in."""
+        while size > 0:
+            if self._position == len(self._buffer):
+                try:
+                    self._buffer = bytearray(await self._chunks.__anext__())
+                except StopAsyncIteration:
+                    return
+                self._position = 0
+
+            piece = bytes(self._buffer[self._position:self._position + size])
+            self._position += len(piece)
+            size -= len(piece)
+            yield piece
+
+    async def unpack(self, fmt: str) -> tuple:
+        return struct.unpack(fmt, await self.read(struct.calcsize(fmt)))
+
+    async def uleb128(self) -> int:
+        value = shift = 0
+        while True:
+            byte = (await self.read(1))[0]
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+            if shift > 35:
+                raise InvalidReplay(5, "A string in the replay has a broken length")
+
+    async def string(self) -> str:
+        marker = (await self.read(1))[0]
+        if marker == 0x00:
+            return ""
+        if marker != 0x0B:
+            raise InvalidReplay(5, f"Expected a string in the replay, got byte {marker:#x}")
+
+        try:
+            return (await self.read(await self.uleb128())).decode("utf-8")
+        except UnicodeDecodeError:
+            raise InvalidReplay(5, "A string in the replay isn't valid UTF-8") from None
+
+
+async def _count_frames(stream: _Stream, length: int) -> int:
+    # Only the start of the LZMA block is decompressed, enough to tell there's actual input.
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    frames = 0
+    try:
+        async for piece in stream.chunks(length):
+            frames += decompressor.decompress(piece, max_length=16384).count(b",")
+            if frames >= MIN_FRAMES + SPECIAL_FRAMES or decompressor.eof:
+                break
+    except lzma.LZMAError:
+        raise InvalidReplay(5, "The replay data isn't valid LZMA") from None
+
+    return max(frames - SPECIAL_FRAMES, 0)
+
+
+async def read_replay(chunks: AsyncIterator[bytes]) -> ReplayHeader:
+    """Parses an .osr file from ``chunks`` and raises :class:`InvalidReplay` if o!rdr would reject it.
+
+    Parsing stops as soon as the replay is known to be good or bad, so a replay
+    for another mode is turned away after its first byte and the input data is
+    only decompressed until a handful of frames turn up.
+    """
+    stream = _Stream(chunks)
+    mode, version = await stream.unpack("<bi")
+    if mode not in (0, 1, 2, 3):
+        raise InvalidReplay(5, f"Unknown game mode {mode}, this isn't an osu! replay")
+    if mode != 0:
+        raise InvalidReplay(6)
+
+    beatmap_md5 = await stream.string()
+    player_name = await stream.string()
+    replay_md5 = await stream.string()
+    counts = await stream.unpack("<hhhhhh")
+    score, max_combo, perfect, mods = await stream.unpack("<ihbi")
+    await stream.string()  # life bar graph
+    ticks, data_length = await stream.unpack("<qi")
+
+    if not USERNAME_RE.match(player_name):
+        raise InvalidReplay(12)
+    if mods & (MOD_AUTOPLAY | MOD_CINEMA):
+        raise InvalidReplay(11)
+    if mods & INCOMPATIBLE_MODS:
+        raise InvalidReplay(26)
+    if data_length <= 0:
+        raise InvalidReplay(7)
+
+    frames = await _count_frames(stream, data_length)
+    if frames == 0:
+        raise InvalidReplay(25)
+
+    try:
+        timestamp = _TICKS_EPOCH + datetime.timedelta(microseconds=ticks // 10)
+    except OverflowError:
+        raise InvalidReplay(5, "The replay has an impossible timestamp") from None
+
+    return ReplayHeader(
+        mode, version, beatmap_md5, player_name, replay_md5, *counts,
+        score, max_combo, bool(perfect), mods, timestamp, data_length, frames,
+    )
+
+
+async def _iterate(data: Iterable[bytes]) -> AsyncIterator[bytes]:
+    for chunk in data:
+        yield chunk
+
+
+async def parse_replay(data: bytes) -> ReplayHeader:
+    """Same as :func:`read_replay` for a replay that's already in memory."""
+    return await read_replay(_iterate((data,)))
+
+
+def replay_hash(header: ReplayHeader) -> str:
+    """Identifies a replay by its content, so copies of one file posted in different places match.
+
+    osu! stores a hash of the play in the header. Some third party clients leave it
+    empty, for those the fields that make a play unique are hashed instead.
+    """
+    if header.replay_md5:
+        return header.replay_md5
+
+    fields = (header.beatmap_md5, header.player_name, header.score, header.max_combo, header.mods, header.timestamp.isoformat(), header.data_length)
+    return hashlib.md5("|".join(map(str, fields)).encode()).hexdigest()
@@ -12,4 +12,22 @@ class NoBeatMapFound(OsuBaseException):
 
 class WrongType(OsuBaseException):
     """Returned when an wrong type for a Score or Beatmap is found"""
-    pass
\ No newline at end of file
+    pass
+
+class NoTokenReceived(OsuBaseException):
+    """Raised when the osu! oauth endpoint doesn't give back an access token"""
+    pass
+
+class RenderFailed(OsuBaseException):
+    """Raised when o!rdr reports that a render has failed"""
+    def __init__(self, error_code: int, message: str = None):
+        self.error_code = error_code
+        super().__init__(message or f"Render failed with error code {error_code}")
+
+class InvalidReplay(RenderFailed):
+    """Raised when a replay is rejected locally, ``error_code`` is the o!rdr code it would have failed with"""
+    pass
+
+class RenderQueueFull(OsuBaseException):
+    """Raised when a user already has as many replays queued as they're allowed"""
+    pass
@@ -0,0 +1,180 @@
+from __future__ import annotations
+import asyncio
+import enum
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import aiohttp
+from .metrics import UPSTREAM_LATENCY, route_label
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    AUTOCOMPLETE = 1
+    BACKGROUND = 2
+
+
+current_priority: ContextVar[Priority] = ContextVar("current_priority", default=Priority.INTERACTIVE)
+"""Priority used for outbound requests made from the current task.
+
+Tasks copy the context they were created in, so set this at the top of a
+background task or autocomplete callback and every request below it follows.
+"""
+
+
+class RateLimiter:
+    """Token bucket shared by every request to one upstream.
+
+    Requests that can't get a token straight away wait in a priority queue, so
+    slash commands go before autocomplete and both go before background work.
+    ``Retry-After`` and ``X-RateLimit-*`` headers from responses pause or drain
+    the bucket so we back off as soon as the upstream tells us to.
+    """
+    def __init__(self, name: str, *, rate: float, burst: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.throttled = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: List[Tuple[int, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+        self._drainer: Optional[asyncio.Task] = None
+        self._waits: Dict[Priority, List[float]] = {priority: [0, 0.0, 0.0] for priority in Priority}
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} name: {self.name!r}, queued: {self.queue_depth}>"
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    @property
+    def paused_for(self) -> float:
+        """Seconds left until a ``Retry-After`` stops holding requests back."""
+        return max(self._paused_until - time.monotonic(), 0.0)
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def _delay(self) -> float:
+        now = self._refill()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self, priority: Optional[Priority] = None):
+        priority = current_priority.get() if priority is None else priority
+        start = time.monotonic()
+
+        if not self._queue and self._delay() == 0.0:
+            self._tokens -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (priority, next(self._counter), future))
+            if self._drainer is None or self._drainer.done():
+                self._drainer = asyncio.create_task(self._drain())
+
+            await future
+
+        self._record(priority, time.monotonic() - start)
+
+    async def _drain(self):
+        while self._queue:
+            if self._queue[0][2].done():
+                # The waiter was cancelled, it doesn't need a token anymore.
+                heapq.heappop(self._queue)
+                continue
+
+            delay = self._delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self._tokens -= 1
+            heapq.heappop(self._queue)[2].set_result(None)
+
+    def _record(self, priority: Priority, waited: float):
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    def update(self, status: int, headers: Any):
+        """Adjusts the bucket from a response's status and rate limit headers."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.isdigit():
+            self._refill()
+            self._tokens = min(self._tokens, float(remaining))
+
+        if status != 429:
+            return
+
+        self.throttled += 1
+        retry_after = headers.get("Retry-After")
+        try:
+            delay = float(retry_after) if retry_after is not None else 1 / self.rate
+        except ValueError:
+            delay = 1 / self.rate
+
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning(f"{self.name} rate limited us, pausing requests for {delay:.2f} seconds")
+
+    @asynccontextmanager
+    async def request(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        url: str,
+        *,
+        priority: Optional[Priority] = None,
+        retries: int = 2,
+        route: Optional[str] = None,
+        **kwargs: Any
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Sends a request once a token is free, retrying up to ``retries`` times on 429.
+
+        ``route`` is the path template the latency is recorded under, like
+        ``/users/{user}``. Without one the path goes through :func:`route_label`.
+        """
+        endpoint = f"{method} {route or route_label(urlsplit(url).path)}"
+        for attempt in range(retries + 1):
+            await self.acquire(priority)
+            with UPSTREAM_LATENCY.time(self.name, endpoint):
+                resp = await session.request(method, url, **kwargs)
+            self.update(resp.status, resp.headers)
+
+            if resp.status == 429 and attempt < retries:
+                resp.release()
+                continue
+
+            try:
+                yield resp
+            finally:
+                resp.release()
+            return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "tokens": round(self._tokens, 2),
+            "paused_for": self.paused_for,
+            "throttled": self.throttled,
+            "waits": {
+                priority.name.lower(): {"count": count, "total": total, "max": longest}
+                for priority, (count, total, longest) in self._waits.items()
+            },
+        }
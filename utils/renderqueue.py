@@ -0,0 +1,325 @@
+from __future__ import annotations
+import asyncio
+import collections
+import datetime
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set
+from asyncpg import Pool, PostgresError, Record
+from .metrics import RENDER_LATENCY
+from .ordr import RenderCache, RenderDispatcher
+from .osu_errors import RenderFailed, RenderQueueFull
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedRender(NamedTuple):
+    job_id: int
+    user_id: int
+    guild_id: Optional[int]
+    channel_id: int
+    message_id: Optional[int]
+    """The status message that gets edited once the render is done"""
+    replay_url: str
+    replay_hash: Optional[str]
+    skin_id: int
+    render_id: Optional[int]
+
+    @classmethod
+    def from_record(cls, record: Record) -> QueuedRender:
+        return cls(*(record[field] for field in cls._fields))
+
+
+class FairQueue:
+    """Round robin over guilds and then over the users in each guild.
+
+    One user flooding a channel with replays only gets every n-th slot, where n is
+    the number of users (and guilds) waiting, instead of blocking everyone behind them.
+    """
+    def __init__(self):
+        self._guilds: collections.OrderedDict[int, collections.OrderedDict[int, Deque[QueuedRender]]] = collections.OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def count(self, user_id: int) -> int:
+        return sum(len(users.get(user_id, ())) for users in self._guilds.values())
+
+    def ahead(self, job: QueuedRender) -> int:
+        """How many queued jobs round robin serves before ``job``.
+
+        This goes by the order alone, so a job can move up when the users and guilds in
+        front of it are at their cap.
+        """
+        users = self._guilds[job.guild_id or 0]
+        nth = users[job.user_id].index(job)
+
+        # The job is the ``turn``-th one its guild gets to, every other user in the guild
+        # has that many turns before it (one more if they're in front).
+        user_index = list(users).index(job.user_id)
+        turn = nth + sum(
+            min(len(jobs), nth + 1 if index < user_index else nth)
+            for index, jobs in enumerate(users.values()) if index != user_index
+        )
+
+        guild_index = list(self._guilds).index(job.guild_id or 0)
+        return turn + sum(
+            min(sum(map(len, other.values())), turn + 1 if index < guild_index else turn)
+            for index, other in enumerate(self._guilds.values()) if index != guild_index
+        )
+
+    def push(self, job: QueuedRender):
+        users = self._guilds.setdefault(job.guild_id or 0, collections.OrderedDict())
+        users.setdefault(job.user_id, collections.deque()).append(job)
+        self._size += 1
+
+    def pop(self, eligible: Callable[[QueuedRender], bool]) -> Optional[QueuedRender]:
+        """Takes the next job whose user and guild have room, skipping the ones that don't."""
+        for guild_id, users in self._guilds.items():
+            for user_id, jobs in users.items():
+                if not eligible(jobs[0]):
+                    continue
+
+                job = jobs.popleft()
+                self._size -= 1
+
+                # Whoever was just served goes to the back of the line.
+                users.move_to_end(user_id)
+                if not jobs:
+                    del users[user_id]
+                self._guilds.move_to_end(guild_id)
+                if not users:
+                    del self._guilds[guild_id]
+                return job
+
+        return None
+
+
+class RenderQueue:
+    """Submits queued replays to o!rdr with a fixed number of workers and remembers them in ``render_job``.
+
+    At most ``workers`` renders run at once, at most ``per_user`` of them for one
+    user and ``per_guild`` for one guild, and nobody can have more than
+    ``max_queued`` replays waiting. Jobs are picked with :class:`FairQueue`.
+    Everything is written to Postgres first, so :meth:`start` picks queued jobs back
+    up after a restart and waits for the ones o!rdr was already rendering. Finished
+    jobs are deleted ``keep_finished`` seconds after they're done.
+    """
+    def __init__(
+        self,
+        pool: Pool,
+        *,
+        cache: RenderCache,
+        dispatcher: RenderDispatcher,
+        submit: Callable[[str, int], Awaitable[Dict[str, Any]]],
+        notify: Callable[[QueuedRender, Optional[str], Optional[BaseException]], Awaitable[None]],
+        progress: Optional[Callable[[QueuedRender, dict], Any]] = None,
+        workers: int = 8,
+        per_user: int = 1,
+        per_guild: int = 3,
+        max_queued: int = 5,
+        keep_finished: float = 7 * 86400.0,
+        prune_every: float = 3600.0
+    ):
+        self.pool = pool
+        self.cache = cache
+        self.dispatcher = dispatcher
+        self.submit = submit
+        self.notify = notify
+        self.progress = progress
+        self.workers = workers
+        self.per_user = per_user
+        self.per_guild = per_guild
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.prune_every = prune_every
+        self.completed = 0
+        self.failed = 0
+        self._queue = FairQueue()
+        self._resumed: Deque[QueuedRender] = collections.deque()
+        self._running_users: collections.Counter[int] = collections.Counter()
+        self._running_guilds: collections.Counter[int] = collections.Counter()
+        self._changed = asyncio.Condition()
+        self._tasks: List[asyncio.Task] = []
+        self._notifying: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._queue) + len(self._resumed)
+
+    @property
+    def running(self) -> int:
+        return sum(self._running_users.values())
+
+    async def start(self, owns: Callable[[Optional[int]], bool] = lambda guild_id: True):
+        """Picks unfinished jobs back up, ``owns`` filters them down to the guilds this process handles."""
+        records = await self.pool.fetch("SELECT * FROM render_job WHERE status IN ('queued', 'rendering') ORDER BY job_id")
+        for record in records:
+            job = QueuedRender.from_record(record)
+            if not owns(job.guild_id):
+                continue
+            if record['status'] == 'rendering':
+                self.dispatcher.register(job.render_id)
+                self._resumed.append(job)
+            else:
+                self._queue.push(job)
+
+        if self._resumed:
+            # Some of these may have finished while we were down, the socket won't tell us about those.
+            asyncio.create_task(self.dispatcher.resync())
+
+        logger.info(f"Resumed {len(self._resumed)} rendering and {len(self._queue)} queued replays")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._prune_loop()))
+
+    async def prune(self) -> int:
+        """Deletes jobs that finished more than ``keep_finished`` seconds ago and returns how many."""
+        status = await self.pool.execute(
+            "DELETE FROM render_job WHERE status IN ('done', 'failed') AND finished_at < now() - $1::INTERVAL",
+            datetime.timedelta(seconds=self.keep_finished),
+        )
+        return int(status.split()[-1])
+
+    async def _prune_loop(self):
+        while True:
+            try:
+                pruned = await self.prune()
+                if pruned:
+                    logger.info(f"Pruned {pruned} finished render jobs")
+            except (OSError, PostgresError) as e:
+                logger.warning(f"Could not prune finished render jobs: {e}")
+            await asyncio.sleep(self.prune_every)
+
+    async def close(self):
+        # Jobs stay in the table as they are and get picked up by the next start.
+        for task in self._tasks:
+            task.cancel()
+
+    async def enqueue(
+        self,
+        *,
+        user_id: int,
+        guild_id: Optional[int],
+        channel_id: int,
+        message_id: Optional[int],
+        replay_url: str,
+        replay_hash: Optional[str],
+        skin_id: int
+    ) -> int:
+        """Queues a replay and returns about how many jobs are ahead of it, see :meth:`FairQueue.ahead`.
+
+        Raises :class:`RenderQueueFull` if the user already has ``max_queued`` replays waiting.
+        """
+        if self._queue.count(user_id) >= self.max_queued:
+            raise RenderQueueFull(f"You already have {self.max_queued} replays waiting, wait for those to finish first!")
+
+        query = """
+            INSERT INTO render_job (user_id, guild_id, channel_id, message_id, replay_url, replay_hash, skin_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING job_id
+        """
+        job_id = await self.pool.fetchval(query, user_id, guild_id, channel_id, message_id, replay_url, replay_hash, skin_id)
+
+        job = QueuedRender(job_id, user_id, guild_id, channel_id, message_id, replay_url, replay_hash, skin_id, None)
+        async with self._changed:
+            self._queue.push(job)
+            # Resumed jobs always go first.
+            ahead = len(self._resumed) + self._queue.ahead(job)
+            self._changed.notify()
+        return ahead
+
+    def _eligible(self, job: QueuedRender) -> bool:
+        if self._running_users[job.user_id] >= self.per_user:
+            return False
+        return job.guild_id is None or self._running_guilds[job.guild_id] < self.per_guild
+
+    def _next(self) -> Optional[QueuedRender]:
+        if self._resumed:
+            return self._resumed.popleft()
+        return self._queue.pop(self._eligible)
+
+    async def _worker(self):
+        while True:
+            async with self._changed:
+                job = self._next()
+                while job is None:
+                    await self._changed.wait()
+                    job = self._next()
+
+                self._running_users[job.user_id] += 1
+                if job.guild_id is not None:
+                    self._running_guilds[job.guild_id] += 1
+
+            try:
+                await self._run(job)
+            finally:
+                async with self._changed:
+                    self._running_users[job.user_id] -= 1
+                    if job.guild_id is not None:
+                        self._running_guilds[job.guild_id] -= 1
+                    # A user or guild that was at its cap might have room now.
+                    self._changed.notify_all()
+
+    async def _run(self, job: QueuedRender):
+        # Jobs resumed after a restart were submitted by an earlier process, their render time is unknown.
+        submitted = None
+        try:
+            if job.render_id is None:
+                result = await self.cache.get_or_submit(job.replay_hash, job.skin_id, lambda: self.submit(job.replay_url, job.skin_id))
+                if result.error_code is not None:
+                    raise RenderFailed(result.error_code)
+                if result.video_url is not None:
+                    return await self._finish(job, result.video_url, None)
+
+                job = job._replace(render_id=result.render_id)
+                submitted = time.perf_counter()
+                await self.pool.execute(
+                    "UPDATE render_job SET status = 'rendering', render_id = $2, submitted_at = now() WHERE job_id = $1",
+                    job.job_id, job.render_id,
+                )
+
+            if self.progress is not None:
+                self.dispatcher.on_progress(job.render_id, lambda data: self.progress(job, data))
+
+            data = await self.dispatcher.wait_for(job.render_id)
+            await self._finish(job, data['videoUrl'], None, submitted)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._finish(job, None, e, submitted)
+
+    async def _finish(self, job: QueuedRender, video_url: Optional[str], error: Optional[BaseException], submitted: Optional[float] = None):
+        if error is None:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+        if submitted is not None:
+            RENDER_LATENCY.observe(time.perf_counter() - submitted, "done" if error is None else "failed")
+
+        try:
+            await self.pool.execute(
+                "UPDATE render_job SET status = $2, video_url = $3, error_code = $4, finished_at = now() WHERE job_id = $1",
+                job.job_id, "done" if error is None else "failed", video_url, getattr(error, "error_code", None),
+            )
+        except Exception as e:
+            logger.warning(f"Could not finish render job {job.job_id}: {e}")
+
+        # Telling the user can wait on a Discord edit flush, which shouldn't keep the worker from the next job.
+        task = asyncio.create_task(self._notify(job, video_url, error))
+        self._notifying.add(task)
+        task.add_done_callback(self._notifying.discard)
+
+    async def _notify(self, job: QueuedRender, video_url: Optional[str], error: Optional[BaseException]):
+        try:
+            await self.notify(job, video_url, error)
+        except Exception as e:
+            logger.warning(f"Could not tell the user about render job {job.job_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
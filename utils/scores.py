@@ -0,0 +1,312 @@
+from __future__ import annotations
+import datetime
+import logging
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+from asyncpg import Pool, Record
+from .cache import LRUCache, MISSING, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# The most plays /users/{id}/scores/recent hands out in one request.
+MAX_RECENT = 100
+
+
+class StoredScore(NamedTuple):
+    score_id: Optional[int]
+    """``None`` for failed plays, osu! doesn't give those an ID so they're only kept in memory"""
+    user_id: int
+    beatmap_id: int
+    beatmapset_id: int
+    artist: str
+    title: str
+    version: str
+    mode: str
+    score: int
+    pp: Optional[float]
+    accuracy: float
+    max_combo: int
+    rank: str
+    mods: List[str]
+    passed: bool
+    created_at: datetime.datetime
+
+    @property
+    def id(self) -> Optional[int]:
+        return self.score_id
+
+    @classmethod
+    def from_record(cls, record: Record) -> StoredScore:
+        return cls(*(record[field] for field in cls._fields))
+
+
+class SyncCursor(NamedTuple):
+    created_at: datetime.datetime
+    score_id: int
+
+    def is_before(self, created_at: datetime.datetime, score_id: int) -> bool:
+        return (created_at, score_id) > (self.created_at, self.score_id)
+
+
+class SyncResult(NamedTuple):
+    new: int
+    """How many plays weren't stored before"""
+    requests: int
+    """osu! requests the sync took"""
+
+
+def _timestamp(value: Any) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _mods(value: Optional[Iterable[Any]]) -> List[str]:
+    # Older responses send acronyms, lazer style ones send {"acronym": ...} objects.
+    return [mod if isinstance(mod, str) else mod['acronym'] for mod in value or ()]
+
+
+def _score_row(score: Any) -> Tuple:
+    beatmap = score.beatmap
+    return (
+        score.id,
+        score.user_id,
+        beatmap.id,
+        score.mode,
+        score.score,
+        score.pp,
+        score.accuracy,
+        score.max_combo,
+        score.rank,
+        _mods(score.mods),
+        score.passed,
+        _timestamp(score.created_at),
+    )
+
+
+def _failed_score(score: Any) -> StoredScore:
+    beatmap, beatmapset = score.beatmap, score.beatmapset
+    return StoredScore(
+        None,
+        score.user_id,
+        beatmap.id,
+        beatmapset.id,
+        beatmapset.artist,
+        beatmapset.title,
+        beatmap.version,
+        score.mode,
+        score.score,
+        score.pp,
+        score.accuracy,
+        score.max_combo,
+        score.rank,
+        _mods(score.mods),
+        score.passed,
+        _timestamp(score.created_at),
+    )
+
+
+def _beatmap_row(score: Any) -> Tuple:
+    beatmap, beatmapset = score.beatmap, score.beatmapset
+    return (
+        beatmap.id,
+        beatmapset.id,
+        beatmapset.artist,
+        beatmapset.title,
+        beatmap.version,
+        beatmapset.creator,
+        beatmap.mode,
+        getattr(beatmap.status, "name", beatmap.status),
+        beatmap.difficulty_rating,
+    )
+
+
+SCORE_COLUMNS = """
+    s.score_id, s.user_id, s.beatmap_id, b.beatmapset_id, b.artist, b.title, b.version,
+    s.mode, s.score, s.pp, s.accuracy, s.max_combo, s.rank, s.mods, s.passed, s.created_at
+"""
+
+
+class ScoreStore:
+    """Keeps osu! scores in Postgres and syncs them incrementally from the API.
+
+    Each user has a cursor at the newest play we've stored, and a sync only asks
+    for as many recent plays as it takes to get back to it: a small page first,
+    growing to :data:`MAX_RECENT` only when every play on the page is new. The
+    first sync of a user also imports their top plays, after that new bests come
+    in through their recent plays. Reads never touch the API.
+
+    Failed plays have no ID to store them under, the newest ``page_size`` of them
+    per user are kept in memory from the last sync and merged into :meth:`recent`.
+    """
+    def __init__(
+        self,
+        pool: Pool,
+        *,
+        osu: Any,
+        page_size: int = 10,
+        min_interval: float = 30.0,
+        best_interval: float = 86400.0
+    ):
+        self.pool = pool
+        self.osu = osu
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.best_interval = best_interval
+        self.requests = 0
+        self._inflight = SingleFlight()
+        self._synced: LRUCache[int, float] = LRUCache(10_000)
+        self._failed: LRUCache[int, List[StoredScore]] = LRUCache(10_000)
+
+    async def cursor(self, user_id: int) -> Optional[SyncCursor]:
+        row = await self.pool.fetchrow("SELECT last_created_at, last_score_id FROM osu_score_cursor WHERE user_id = $1", user_id)
+        if row is None or row['last_created_at'] is None:
+            return None
+        return SyncCursor(row['last_created_at'], row['last_score_id'])
+
+    async def sync(self, user_id: int, *, force: bool = False) -> SyncResult:
+        """Stores the plays ``user_id`` made since the last sync and returns how many were new.
+
+        Users synced less than ``min_interval`` seconds ago are skipped unless ``force`` is set.
+        """
+        synced = self._synced.peek(user_id)
+        if not force and synced is not MISSING and time.monotonic() - synced < self.min_interval:
+            return SyncResult(0, 0)
+
+        return await self._inflight.do(user_id, lambda: self._sync(user_id))
+
+    async def _fetch(self, user_id: int, type: str, limit: int) -> List[Any]:
+        self.requests += 1
+        return await self.osu.fetch_user_score(user_id, type=type, limit=limit, include_fails=type == "recent")
+
+    async def _sync(self, user_id: int) -> SyncResult:
+        cursor = await self.cursor(user_id)
+        limit = self.page_size if cursor is not None else MAX_RECENT
+        requests = 0
+
+        while True:
+            requests += 1
+            scores = await self._fetch(user_id, "recent", limit)
+            failed = [score for score in scores if score.id is None]
+            scores = [score for score in scores if score.id is not None]
+            fresh = [score for score in scores if cursor is None or cursor.is_before(_timestamp(score.created_at), score.id)]
+
+            if len(fresh) < len(scores) or len(scores) < limit or limit >= MAX_RECENT:
+                break
+            limit = min(limit * 4, MAX_RECENT)
+
+        best: List[Any] = []
+        best_synced = await self.pool.fetchval("SELECT best_synced_at FROM osu_score_cursor WHERE user_id = $1", user_id)
+        if best_synced is None or datetime.datetime.now(datetime.timezone.utc) - best_synced > datetime.timedelta(seconds=self.best_interval):
+            requests += 1
+            best = await self._fetch(user_id, "best", MAX_RECENT)
+
+        await self.store(user_id, fresh, best, best_synced=bool(best))
+        self._keep_failed(user_id, failed)
+        self._synced.set(user_id, time.monotonic())
+
+        if fresh:
+            logger.info(f"Synced {len(fresh)} new plays for osu! user {user_id}")
+        return SyncResult(len(fresh), requests)
+
+    def _keep_failed(self, user_id: int, scores: Sequence[Any]):
+        kept = {(play.created_at, play.beatmap_id): play for play in self._failed.peek(user_id, [])}
+        for play in map(_failed_score, scores):
+            kept[(play.created_at, play.beatmap_id)] = play
+
+        if kept:
+            self._failed.set(user_id, sorted(kept.values(), key=lambda play: play.created_at, reverse=True)[:self.page_size])
+
+    def get_failed(self, user_id: int, timestamp: int) -> Optional[StoredScore]:
+        """A failed play of ``user_id`` kept from its last sync, looked up by ``created_at`` in whole seconds."""
+        for play in self._failed.peek(user_id, []):
+            if int(play.created_at.timestamp()) == timestamp:
+                return play
+        return None
+
+    async def store(self, user_id: int, recent: Sequence[Any], best: Sequence[Any] = (), *, best_synced: bool = False):
+        """Upserts the scores with their beatmaps and moves the user's cursor up to the newest of ``recent``.
+
+        Top plays can be older than the cursor, so they never move it.
+        """
+        newest = max(((_timestamp(score.created_at), score.id) for score in recent), default=None)
+        scores = [*recent, *best]
+
+        async with self.pool.acquire() as conn, conn.transaction():
+            if scores:
+                await conn.executemany("""
+                    INSERT INTO osu_beatmap_ref (beatmap_id, beatmapset_id, artist, title, version, creator, mode, status, difficulty_rating)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                    ON CONFLICT (beatmap_id) DO
+                    UPDATE SET status = excluded.status, difficulty_rating = excluded.difficulty_rating
+                """, list({row[0]: row for row in map(_beatmap_row, scores)}.values()))
+                await conn.executemany("""
+                    INSERT INTO osu_score (score_id, user_id, beatmap_id, mode, score, pp, accuracy, max_combo, rank, mods, passed, created_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+                    ON CONFLICT (score_id) DO
+                    UPDATE SET pp = excluded.pp
+                """, list({row[0]: row for row in map(_score_row, scores)}.values()))
+
+            await conn.execute("""
+                INSERT INTO osu_score_cursor (user_id, synced_at, best_synced_at) VALUES ($1, now(), CASE WHEN $2 THEN now() END)
+                ON CONFLICT (user_id) DO
+                UPDATE SET synced_at = now(), best_synced_at = COALESCE(excluded.best_synced_at, osu_score_cursor.best_synced_at)
+            """, user_id, best_synced)
+
+            if newest is not None:
+                await conn.execute("""
+                    UPDATE osu_score_cursor SET last_created_at = $2, last_score_id = $3
+                    WHERE user_id = $1 AND (last_created_at IS NULL OR (last_created_at, last_score_id) < ($2, $3))
+                """, user_id, *newest)
+
+    async def get(self, score_id: int) -> Optional[StoredScore]:
+        record = await self.pool.fetchrow(f"""
+            SELECT {SCORE_COLUMNS} FROM osu_score s JOIN osu_beatmap_ref b USING (beatmap_id)
+            WHERE s.score_id = $1
+        """, score_id)
+        return StoredScore.from_record(record) if record is not None else None
+
+    async def recent(self, user_id: int, *, limit: int = 5, passed_only: bool = False) -> List[StoredScore]:
+        records = await self.pool.fetch(f"""
+            SELECT {SCORE_COLUMNS} FROM osu_score s JOIN osu_beatmap_ref b USING (beatmap_id)
+            WHERE s.user_id = $1 AND (s.passed OR NOT $3)
+            ORDER BY s.created_at DESC
+            LIMIT $2
+        """, user_id, limit, passed_only)
+        scores = [StoredScore.from_record(record) for record in records]
+
+        failed = self._failed.peek(user_id, []) if not passed_only else []
+        if failed:
+            scores = sorted([*scores, *failed], key=lambda play: play.created_at, reverse=True)[:limit]
+        return scores
+
+    async def best(self, user_id: int, *, limit: int = 5, mode: str = "osu") -> List[StoredScore]:
+        """The user's highest pp play on each map, highest first, like their profile's top plays."""
+        records = await self.pool.fetch(f"""
+            SELECT * FROM (
+                SELECT DISTINCT ON (s.beatmap_id) {SCORE_COLUMNS}
+                FROM osu_score s JOIN osu_beatmap_ref b USING (beatmap_id)
+                WHERE s.user_id = $1 AND s.mode = $3 AND s.passed AND s.pp IS NOT NULL
+                ORDER BY s.beatmap_id, s.pp DESC
+            ) best
+            ORDER BY pp DESC
+            LIMIT $2
+        """, user_id, limit, mode)
+        return [StoredScore.from_record(record) for record in records]
+
+    async def compare(self, beatmap_id: int, user_ids: Optional[Iterable[int]] = None) -> List[StoredScore]:
+        """Each user's best score on ``beatmap_id``, optionally only for ``user_ids``, best first."""
+        records = await self.pool.fetch(f"""
+            SELECT * FROM (
+                SELECT DISTINCT ON (s.user_id) {SCORE_COLUMNS}
+                FROM osu_score s JOIN osu_beatmap_ref b USING (beatmap_id)
+                WHERE s.beatmap_id = $1 AND s.passed AND ($2::BIGINT[] IS NULL OR s.user_id = ANY($2))
+                ORDER BY s.user_id, s.score DESC
+            ) best
+            ORDER BY score DESC
+        """, beatmap_id, list(user_ids) if user_ids is not None else None)
+        return [StoredScore.from_record(record) for record in records]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "syncs": self._inflight.calls, "shared": self._inflight.shared}
+
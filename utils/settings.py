@@ -0,0 +1,103 @@
+from __future__ import annotations
+import json
+import logging
+from typing import Any, Iterable, NamedTuple, Optional
+from asyncpg import Connection, Pool
+from .cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_CHANNEL = "aswo_settings"
+
+
+class UserConfig(NamedTuple):
+    osu_username: Optional[str]
+    skin_id: Optional[int]
+
+
+class UserSettings:
+    """Write-through cache over the ``osu_user`` and ``replay_config`` tables.
+
+    Users without any rows are cached too, since that's most of the people who
+    trigger a replay render or run ``/user``. Every change is sent on
+    ``SETTINGS_CHANNEL`` so the other bot processes can update their copy with
+    :meth:`on_notify`.
+    """
+    def __init__(self, pool: Pool, *, maxsize: int = 10_000):
+        self.pool = pool
+        self.cache: LRUCache[int, UserConfig] = LRUCache(maxsize)
+
+    async def get(self, user_id: int) -> UserConfig:
+        config = self.cache.get(user_id)
+        if config is not MISSING:
+            return config
+
+        query = """
+            SELECT
+                (SELECT osu_username FROM osu_user WHERE user_id = $1) AS osu_username,
+                (SELECT skin_id FROM replay_config WHERE user_id = $1) AS skin_id
+        """
+        row = await self.pool.fetchrow(query, user_id)
+        config = UserConfig(row['osu_username'], row['skin_id'])
+        self.cache.set(user_id, config)
+        return config
+
+    async def set_osu_username(self, user_id: int, username: str):
+        query = """
+            INSERT INTO osu_user (osu_username, user_id) VALUES($1, $2)
+            ON CONFLICT(user_id) DO 
+            UPDATE SET osu_username = excluded.osu_username
+        """
+        await self._save(query, user_id, osu_username=username)
+
+    async def set_skin_id(self, user_id: int, skin_id: int):
+        query = """
+            INSERT INTO replay_config (skin_id, user_id) VALUES($1, $2)
+            ON CONFLICT(user_id) DO 
+            UPDATE SET skin_id = excluded.skin_id
+        """
+        await self._save(query, user_id, skin_id=skin_id)
+
+    async def _save(self, query: str, user_id: int, **fields: Any):
+        (value,) = fields.values()
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(query, value, user_id)
+            await conn.execute("SELECT pg_notify($1, $2)", SETTINGS_CHANNEL, json.dumps({"user_id": user_id, **fields}))
+
+        self._update(user_id, **fields)
+
+    def on_notify(self, conn: Connection, pid: int, channel: str, payload: str):
+        data = json.loads(payload)
+        self._update(data.pop('user_id'), **data)
+
+    def _update(self, user_id: int, **fields: Any):
+        config = self.cache.peek(user_id)
+        if config is MISSING:
+            # The other column is unknown, so leave it to the next read instead of caching a guess.
+            return
+
+        self.cache.set(user_id, config._replace(**fields))
+
+    async def warm(self, user_ids: Optional[Iterable[int]] = None):
+        """Loads settings in one query, either for ``user_ids`` or for as many linked users as fit."""
+        if user_ids is None:
+            query = """
+                SELECT user_id, o.osu_username, r.skin_id
+                FROM osu_user o FULL OUTER JOIN replay_config r USING (user_id)
+                LIMIT $1
+            """
+            rows = await self.pool.fetch(query, self.cache.maxsize)
+        else:
+            user_ids = list(user_ids)
+            query = """
+                SELECT u.user_id, o.osu_username, r.skin_id
+                FROM unnest($1::BIGINT[]) AS u(user_id)
+                LEFT JOIN osu_user o USING (user_id)
+                LEFT JOIN replay_config r USING (user_id)
+            """
+            rows = await self.pool.fetch(query, user_ids)
+
+        for row in rows:
+            self.cache.set(row['user_id'], UserConfig(row['osu_username'], row['skin_id']))
+
+        logger.info(f"Warmed settings for {len(rows)} users")
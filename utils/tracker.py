@@ -0,0 +1,115 @@
+from __future__ import annotations
+import heapq
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class TrackSchedule:
+    """Decides which tracked osu! users get their recent plays polled next.
+
+    Every user has their own interval: finding new plays drops it back to
+    ``min_interval`` and every empty poll multiplies it by ``backoff`` up to
+    ``max_interval``, so people who are playing right now get polled often and
+    everyone else rarely. On top of that all polls share a budget of ``budget``
+    requests a minute. When more users are due than the budget allows, the ones
+    with the shortest interval go first and the rest wait, so API usage stays flat
+    however many users are tracked and active players still get polled on time.
+    """
+    def __init__(
+        self,
+        *,
+        budget: float = 30.0,
+        min_interval: float = 60.0,
+        max_interval: float = 1800.0,
+        backoff: float = 2.0
+    ):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.polls = 0
+        self._burst = max(1.0, budget / 6)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._heap: List[Tuple[float, int]] = []
+        self._ready: List[Tuple[float, float, int]] = []
+        self._due: Dict[int, float] = {}
+        self._intervals: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    def __contains__(self, osu_user_id: int) -> bool:
+        return osu_user_id in self._intervals
+
+    def _push(self, osu_user_id: int, due: float):
+        self._due[osu_user_id] = due
+        heapq.heappush(self._heap, (due, osu_user_id))
+
+    def add(self, osu_user_id: int, *, interval: Optional[float] = None):
+        """Starts tracking ``osu_user_id``, polling it within ``interval`` seconds (``min_interval`` by default).
+
+        Pass ``max_interval`` when loading a lot of users at once, so they're spread
+        out and start off as idle instead of all competing for the budget.
+        """
+        if osu_user_id in self._intervals:
+            return
+
+        interval = self.min_interval if interval is None else interval
+        self._intervals[osu_user_id] = interval
+        self._push(osu_user_id, time.monotonic() + random.uniform(0, interval))
+
+    def remove(self, osu_user_id: int):
+        # The heap entry is left behind and skipped once it comes up.
+        self._due.pop(osu_user_id, None)
+        self._intervals.pop(osu_user_id, None)
+
+    def due(self) -> List[int]:
+        """Pops the users that are due, as many as the budget has room for."""
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.budget / 60)
+        self._updated = now
+
+        while self._heap and self._heap[0][0] <= now:
+            due, osu_user_id = heapq.heappop(self._heap)
+            if self._due.get(osu_user_id) == due:
+                heapq.heappush(self._ready, (self._intervals[osu_user_id], due, osu_user_id))
+
+        users = []
+        while self._ready and self._tokens >= 1:
+            _, due, osu_user_id = heapq.heappop(self._ready)
+            if self._due.get(osu_user_id) != due:
+                continue
+
+            del self._due[osu_user_id]
+            self._tokens -= 1
+            users.append(osu_user_id)
+
+        self.polls += len(users)
+        return users
+
+    def charge(self, requests: int):
+        """Takes requests beyond the one per poll :meth:`due` already paid for out of the budget."""
+        self._tokens -= max(requests, 0)
+
+    def done(self, osu_user_id: int, found: int):
+        """Reschedules ``osu_user_id`` after a poll that found ``found`` new plays."""
+        if osu_user_id not in self._intervals:
+            return
+
+        interval = self.min_interval if found else min(self._intervals[osu_user_id] * self.backoff, self.max_interval)
+        self._intervals[osu_user_id] = interval
+        # A bit of jitter keeps users added together from staying in lockstep.
+        self._push(osu_user_id, time.monotonic() + interval * random.uniform(0.9, 1.1))
+
+    def stats(self) -> Dict[str, Any]:
+        intervals = list(self._intervals.values())
+        return {
+            "tracked": len(self._intervals),
+            "polls": self.polls,
+            "tokens": round(self._tokens, 2),
+            "waiting": len(self._ready),
+            "active": sum(1 for interval in intervals if interval <= self.min_interval),
+            "average_interval": sum(intervals) / len(intervals) if intervals else 0.0,
+        }